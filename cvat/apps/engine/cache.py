@@ -2,32 +2,372 @@
 #
 # SPDX-License-Identifier: MIT
 
+import math
 import os
+import threading
+import time
+from collections import OrderedDict
 from io import BytesIO
 
+import django_rq
 from diskcache import Cache
 from django.conf import settings
 
 from cvat.apps.engine.media_extractors import (Mpeg4ChunkWriter,
     Mpeg4CompressedChunkWriter, ZipChunkWriter, ZipCompressedChunkWriter)
-from cvat.apps.engine.models import DataChoice
+from cvat.apps.engine.log import slogger
+from cvat.apps.engine.models import Data, DataChoice
 from cvat.apps.engine.prepare import PrepareInfo
 
 
+# A worker which builds a chunk longer than that is considered dead
+CHUNK_LOCK_TIMEOUT = 120 # seconds
+CHUNK_POLL_INTERVAL = 0.1 # seconds
+# A single frame of a chunk which is not cached is decoded from the source
+# video only once in that time, the next request builds the chunk
+SEEK_MARK_TIMEOUT = 600 # seconds
+# Chunks are not evicted in that time after their path was returned, so
+# that the file can still be read or sent by the web server
+CHUNK_PIN_TIMEOUT = 60 # seconds
+# Prefetch jobs which don't finish in that time are not counted anymore
+PREFETCH_TIMEOUT = 600 # seconds
+# The last access time of a task is saved not more often than that
+ACCESS_UPDATE_INTERVAL = 60 # seconds
+# The caches are cleaned a bit below their limits, so that the cleaning
+# doesn't happen on every new chunk
+EVICTION_FACTOR = 0.9
+
+TASKS_KEY = 'chunk_tasks'
+TOTAL_USAGE_KEY = 'chunk_usage'
+EVICTION_LOCK_KEY = 'chunk_eviction_lock'
+
+class MemoryCache:
+    """LRU cache of the worker process limited by the total size of its items"""
+    def __init__(self, size_limit):
+        self.size_limit = size_limit
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def _get_size(self, value):
+        return len(value)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self._stats['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self._stats['hits'] += 1
+            return item[0]
+
+    def put(self, key, value):
+        size = self._get_size(value)
+        if size > self.size_limit:
+            return
+
+        with self._lock:
+            self._remove(key)
+            while self._items and self._size + size > self.size_limit:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._size -= evicted_size
+                self._stats['evictions'] += 1
+            self._items[key] = (value, size)
+            self._size += size
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['items'] = len(self._items)
+            stats['size'] = self._size
+            stats['size_limit'] = self.size_limit
+            return stats
+
+class ChunkMemoryCache(MemoryCache):
+    def _get_size(self, value):
+        chunk, _ = value
+        return len(chunk)
+
+chunk_memory_cache = ChunkMemoryCache(getattr(settings, 'CHUNK_MEMORY_CACHE_SIZE', 128 * 1024 * 1024))
+_saved_access_times = {}
+
+def _get_quality_name(quality):
+    return getattr(quality, 'name', str(quality)).upper()
+
 class CacheInteraction:
+    """Chunks of tasks in the cache mode.
+
+    Hot chunks are kept in the memory of the worker process in front of
+    the disk cache. The disk cache is limited by CHUNK_CACHE_SIZE and the
+    chunks of one task by CHUNK_CACHE_TASK_QUOTA for every quality. When
+    the disk cache is full, original chunks of the most idle tasks are
+    evicted first.
+    """
     def __init__(self):
-        self._cache = Cache(settings.CACHE_ROOT)
+        # the size of the cache is controlled by the quotas, not by diskcache
+        self._cache = Cache(settings.CACHE_ROOT, eviction_policy='none')
 
     def __del__(self):
         self._cache.close()
 
-    def get_buff_mime(self, chunk_number, quality, db_data):
-        chunk, tag = self._cache.get('{}_{}_{}'.format(db_data.id, chunk_number, quality), tag=True)
+    @staticmethod
+    def _get_key(db_data_id, chunk_number, quality):
+        return '{}_{}_{}'.format(db_data_id, chunk_number, quality)
+
+    @staticmethod
+    def _get_usage_key(db_data_id, quality):
+        return 'chunk_usage_{}_{}'.format(db_data_id, _get_quality_name(quality))
+
+    def is_cached(self, chunk_number, quality, db_data_id):
+        return self._get_key(db_data_id, chunk_number, quality) in self._cache
+
+    def mark_sought(self, chunk_number, quality, db_data_id):
+        """Returns True if a frame of the chunk wasn't decoded from the
+        source recently, and remembers that it was
+        """
+        key = '{}_sought'.format(self._get_key(db_data_id, chunk_number, quality))
+        return self._cache.add(key, True, expire=SEEK_MARK_TIMEOUT)
+
+    def _count(self, db_data_id, name):
+        self._cache.incr('chunk_stats_{}_{}'.format(db_data_id, name))
+
+    def _get_chunk_path(self, key):
+        chunk, tag = self._cache.get(key, read=True, tag=True)
+        if chunk is None:
+            return None, None
+        if isinstance(chunk, BytesIO):
+            # chunks saved by previous versions are pickled buffers, they are built again
+            self._cache.delete(key)
+            return None, None
+        with chunk:
+            return chunk.name, tag
+
+    def _save(self, key, buff, mime_type):
+        # chunks are stored as raw files, so that they can be sent without reading
+        self._cache.set(key, buff, read=True, tag=mime_type)
+        chunk_path, tag = self._get_chunk_path(key)
+        if chunk_path is None:
+            raise Exception('The chunk {} cannot be saved in the cache'.format(key))
+        return chunk_path, tag
+
+    @staticmethod
+    def _get_index_key(db_data_id, quality):
+        return 'chunk_index_{}_{}'.format(db_data_id, _get_quality_name(quality))
+
+    def _build_chunk(self, key, chunk_number, quality, db_data):
+        buff, mime_type = self.prepare_chunk_buff(db_data, quality, chunk_number)
+        chunk_path, mime_type = self._save(key, buff, mime_type)
+        self._add_to_index(db_data.id, chunk_number, quality, key, os.path.getsize(chunk_path))
+        self._touch(db_data, force=True)
+        self._schedule_eviction(db_data.id, chunk_number, quality)
+        return chunk_path, mime_type
+
+    def _add_to_index(self, db_data_id, chunk_number, quality, key, size):
+        # The sizes of the cached chunks of every task are kept in an index, so
+        # that the usage is updated incrementally. A chunk which was built by two
+        # workers (after a lock timeout) replaces its previous size.
+        index_key = self._get_index_key(db_data_id, quality)
+        with self._cache.transact():
+            index = self._cache.get(index_key, {})
+            _, previous_size = index.get(chunk_number, (key, 0))
+            index[chunk_number] = (key, size)
+            self._cache.set(index_key, index)
+            self._cache.incr(self._get_usage_key(db_data_id, quality), size - previous_size)
+            self._cache.incr(TOTAL_USAGE_KEY, size - previous_size)
+
+    def _touch(self, db_data, force=False):
+        now = time.time()
+        if not force and now - _saved_access_times.get(db_data.id, 0) < ACCESS_UPDATE_INTERVAL:
+            return
+        _saved_access_times[db_data.id] = now
+        with self._cache.transact():
+            tasks = self._cache.get(TASKS_KEY, {})
+            tasks[db_data.id] = { 'last_access': now }
+            self._cache.set(TASKS_KEY, tasks)
+
+    def _pin(self, key):
+        self._cache.set('{}_pinned'.format(key), True, expire=CHUNK_PIN_TIMEOUT)
 
-        if not chunk:
-            chunk, tag = self.prepare_chunk_buff(db_data, quality, chunk_number)
-            self.save_chunk(db_data.id, chunk_number, quality, chunk, tag)
-        return chunk, tag
+    def _evict(self, db_data_id, chunk_number, quality, force=False):
+        index_key = self._get_index_key(db_data_id, quality)
+        with self._cache.transact():
+            index = self._cache.get(index_key, {})
+            if chunk_number not in index:
+                return
+            key, size = index[chunk_number]
+            if not force and '{}_pinned'.format(key) in self._cache:
+                return
+            del index[chunk_number]
+            self._cache.set(index_key, index)
+            self._cache.delete(key)
+            self._cache.incr(self._get_usage_key(db_data_id, quality), -size)
+            self._cache.incr(TOTAL_USAGE_KEY, -size)
+        self._count(db_data_id, 'evictions')
+
+    def _exceeds_limits(self, db_data_id, quality):
+        quota = settings.CHUNK_CACHE_TASK_QUOTA.get(_get_quality_name(quality))
+        return (quota is not None and \
+                self._cache.get(self._get_usage_key(db_data_id, quality), 0) > quota) or \
+            self._cache.get(TOTAL_USAGE_KEY, 0) > settings.CHUNK_CACHE_SIZE
+
+    def _schedule_eviction(self, db_data_id, chunk_number, quality):
+        if not self._exceeds_limits(db_data_id, quality):
+            return
+        # only one thread cleans the cache at a time, a task which exceeds
+        # its quota meanwhile is cleaned after its next new chunk
+        if self._cache.add(EVICTION_LOCK_KEY, os.getpid(), expire=CHUNK_LOCK_TIMEOUT):
+            _run_in_background(_apply_limits, db_data_id, chunk_number, quality)
+
+    def _apply_task_quota(self, db_data_id, chunk_number, quality):
+        quota = settings.CHUNK_CACHE_TASK_QUOTA.get(_get_quality_name(quality))
+        usage_key = self._get_usage_key(db_data_id, quality)
+        if quota is None or self._cache.get(usage_key, 0) <= quota:
+            return
+
+        # the chunks which are the farthest from the requested one are evicted first
+        index = self._cache.get(self._get_index_key(db_data_id, quality), {})
+        for other_chunk in sorted(index, key=lambda n: -abs(n - chunk_number)):
+            if self._cache.get(usage_key, 0) <= quota * EVICTION_FACTOR:
+                break
+            if other_chunk != chunk_number:
+                self._evict(db_data_id, other_chunk, quality)
+
+    def _apply_size_limit(self, db_data_id, chunk_number, quality):
+        if self._cache.get(TOTAL_USAGE_KEY, 0) <= settings.CHUNK_CACHE_SIZE:
+            return
+
+        tasks = self._cache.get(TASKS_KEY, {})
+        idle_tasks = sorted(tasks, key=lambda data_id: tasks[data_id]['last_access'])
+        for evicted_quality in ('ORIGINAL', 'COMPRESSED'):
+            for data_id in idle_tasks:
+                for other_chunk in self._cache.get(self._get_index_key(data_id, evicted_quality), {}):
+                    if self._cache.get(TOTAL_USAGE_KEY, 0) <= settings.CHUNK_CACHE_SIZE * EVICTION_FACTOR:
+                        return
+                    if (data_id, other_chunk, evicted_quality) != \
+                            (db_data_id, chunk_number, _get_quality_name(quality)):
+                        self._evict(data_id, other_chunk, evicted_quality)
+
+    def remove_data(self, db_data_id):
+        """Removes the chunks and the statistics of the data"""
+        for quality in ('COMPRESSED', 'ORIGINAL'):
+            for chunk_number in list(self._cache.get(self._get_index_key(db_data_id, quality), {})):
+                self._evict(db_data_id, chunk_number, quality, force=True)
+            self._cache.delete(self._get_index_key(db_data_id, quality))
+            self._cache.delete(self._get_usage_key(db_data_id, quality))
+        for name in ('hits', 'misses', 'evictions'):
+            self._cache.delete('chunk_stats_{}_{}'.format(db_data_id, name))
+        with self._cache.transact():
+            tasks = self._cache.get(TASKS_KEY, {})
+            if tasks.pop(db_data_id, None) is not None:
+                self._cache.set(TASKS_KEY, tasks)
+        _saved_access_times.pop(db_data_id, None)
+
+    def get_chunk_path_mime(self, chunk_number, quality, db_data):
+        """Returns the path of the chunk file in the cache and its mime type.
+        The chunk is not evicted for CHUNK_PIN_TIMEOUT seconds.
+        """
+        key = self._get_key(db_data.id, chunk_number, quality)
+        # the chunk is pinned before it's looked up, so it isn't evicted in between
+        self._pin(key)
+        return self._get_or_build_chunk(key, chunk_number, quality, db_data)
+
+    def _get_or_build_chunk(self, key, chunk_number, quality, db_data):
+        chunk_path, tag = self._get_chunk_path(key)
+        if chunk_path:
+            self._count(db_data.id, 'hits')
+            self._touch(db_data)
+            return chunk_path, tag
+        self._count(db_data.id, 'misses')
+
+        # Only one worker builds the chunk, other workers wait for the result.
+        # The lock expires if its holder dies, then another worker builds the chunk.
+        lock_key = '{}_lock'.format(key)
+        deadline = time.monotonic() + CHUNK_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._cache.add(lock_key, os.getpid(), expire=CHUNK_LOCK_TIMEOUT):
+                try:
+                    # the chunk could be saved while the lock was being acquired
+                    chunk_path, tag = self._get_chunk_path(key)
+                    if not chunk_path:
+                        chunk_path, tag = self._build_chunk(key, chunk_number, quality, db_data)
+                    return chunk_path, tag
+                finally:
+                    self._cache.delete(lock_key)
+
+            time.sleep(CHUNK_POLL_INTERVAL)
+            chunk_path, tag = self._get_chunk_path(key)
+            if chunk_path:
+                return chunk_path, tag
+
+        return self._build_chunk(key, chunk_number, quality, db_data)
+
+    def get_chunk_buff_mime(self, chunk_number, quality, db_data):
+        """Returns the chunk in a buffer, hot chunks are read from memory"""
+        key = self._get_key(db_data.id, chunk_number, quality)
+        item = chunk_memory_cache.get(key)
+        if item is None:
+            try:
+                chunk_path, mime_type = self.get_chunk_path_mime(chunk_number, quality, db_data)
+                with open(chunk_path, 'rb') as chunk:
+                    item = (chunk.read(), mime_type)
+            except FileNotFoundError:
+                # the chunk was evicted by another worker before it was pinned
+                chunk_path, mime_type = self.get_chunk_path_mime(chunk_number, quality, db_data)
+                with open(chunk_path, 'rb') as chunk:
+                    item = (chunk.read(), mime_type)
+            chunk_memory_cache.put(key, item)
+        chunk, mime_type = item
+        return BytesIO(chunk), mime_type
+
+    # the name of the method in previous versions
+    get_buff_mime = get_chunk_buff_mime
+
+    def get_stats(self):
+        tasks = self._cache.get(TASKS_KEY, {})
+        stats = {}
+        for data_id, task in tasks.items():
+            hits = self._cache.get('chunk_stats_{}_hits'.format(data_id), 0)
+            misses = self._cache.get('chunk_stats_{}_misses'.format(data_id), 0)
+            stats[data_id] = {
+                'last_access': task['last_access'],
+                'size': {
+                    quality: self._cache.get(self._get_usage_key(data_id, quality), 0)
+                    for quality in ('COMPRESSED', 'ORIGINAL')
+                },
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else None,
+                'evictions': self._cache.get('chunk_stats_{}_evictions'.format(data_id), 0),
+            }
+
+        return {
+            'memory': chunk_memory_cache.stats(),
+            'disk': {
+                'size': self._cache.get(TOTAL_USAGE_KEY, 0),
+                'size_limit': settings.CHUNK_CACHE_SIZE,
+                'data': stats,
+            },
+        }
 
     def prepare_chunk_buff(self, db_data, quality, chunk_number):
         from cvat.apps.engine.frame_provider import FrameProvider # TODO: remove circular dependency
@@ -39,7 +379,9 @@ class CacheInteraction:
         image_quality = 100 if extractor_classes[quality] in [Mpeg4ChunkWriter, ZipChunkWriter] else db_data.image_quality
         mime_type = 'video/mp4' if extractor_classes[quality] in [Mpeg4ChunkWriter, Mpeg4CompressedChunkWriter] else 'application/zip'
 
-        extractor = extractor_classes[quality](image_quality)
+        extractor = extractor_classes[quality](image_quality,
+            settings.VIDEO_CHUNK_ENCODING[_get_quality_name(quality)] \
+                if mime_type == 'video/mp4' else settings.IMAGE_CHUNK_ENCODING)
 
         images = []
         buff = BytesIO()
@@ -56,5 +398,73 @@ class CacheInteraction:
         buff.seek(0)
         return buff, mime_type
 
-    def save_chunk(self, db_data_id, chunk_number, quality, buff, mime_type):
-        self._cache.set('{}_{}_{}'.format(db_data_id, chunk_number, quality), buff, tag=mime_type)
+
+def _run_in_background(target, *args):
+    threading.Thread(target=target, args=args, daemon=True).start()
+
+def _apply_limits(db_data_id, chunk_number, quality):
+    # chunks are evicted off the request thread
+    cache = CacheInteraction()
+    try:
+        cache._apply_task_quota(db_data_id, chunk_number, quality)
+        cache._apply_size_limit(db_data_id, chunk_number, quality)
+    except Exception:
+        slogger.glob.warning('Chunks of the cache cannot be evicted', exc_info=True)
+    finally:
+        cache._cache.delete(EVICTION_LOCK_KEY)
+
+def _get_prefetch_keys(db_data_id, job_id):
+    # the number of scheduled prefetch jobs of the task and the mark of the job
+    return 'cvat:prefetch:{}'.format(db_data_id), 'cvat:{}'.format(job_id)
+
+def _prefetch_chunk(db_data_id, chunk_number, quality, job_id):
+    try:
+        db_data = Data.objects.get(pk=db_data_id)
+        CacheInteraction().get_chunk_path_mime(chunk_number, quality, db_data)
+    finally:
+        counter_key, job_key = _get_prefetch_keys(db_data_id, job_id)
+        connection = django_rq.get_connection('prefetch')
+        with connection.pipeline() as pipe:
+            pipe.decr(counter_key)
+            pipe.delete(job_key)
+            pipe.execute()
+
+def prefetch_chunks(db_data, chunk_number):
+    """Builds the next CHUNK_PREFETCH_COUNT chunks of both qualities in
+    the background, so that they are ready when the client requests them.
+    """
+    from cvat.apps.engine.frame_provider import FrameProvider # TODO: remove circular dependency
+    chunk_count = math.ceil(db_data.size / db_data.chunk_size)
+    next_chunks = range(chunk_number + 1, min(chunk_number + 1 + settings.CHUNK_PREFETCH_COUNT, chunk_count))
+    if not next_chunks:
+        return
+
+    # Jobs are counted per task in Redis instead of listing the queue. The
+    # keys expire, so a dead job doesn't block prefetching of the task forever.
+    queue = django_rq.get_queue('prefetch')
+    connection = queue.connection
+    cache = CacheInteraction()
+    for next_chunk in next_chunks:
+        for quality in (FrameProvider.Quality.COMPRESSED, FrameProvider.Quality.ORIGINAL):
+            if cache.is_cached(next_chunk, quality, db_data.id):
+                continue
+
+            job_id = 'prefetch/{}/{}/{}'.format(db_data.id, next_chunk, quality.name.lower())
+            counter_key, job_key = _get_prefetch_keys(db_data.id, job_id)
+            if not connection.set(job_key, 1, nx=True, ex=PREFETCH_TIMEOUT):
+                continue # the chunk is scheduled already
+
+            with connection.pipeline() as pipe:
+                pipe.incr(counter_key)
+                pipe.expire(counter_key, PREFETCH_TIMEOUT)
+                scheduled_jobs, _ = pipe.execute()
+            if scheduled_jobs > settings.CHUNK_PREFETCH_MAX_JOBS:
+                with connection.pipeline() as pipe:
+                    pipe.decr(counter_key)
+                    pipe.delete(job_key)
+                    pipe.execute()
+                return
+
+            queue.enqueue_call(func=_prefetch_chunk, args=(db_data.id, next_chunk, quality, job_id),
+                job_id=job_id, result_ttl=0, failure_ttl=0)
+            slogger.glob.debug('Chunk {} of data {} is scheduled for prefetching'.format(next_chunk, db_data.id))
@@ -5,6 +5,7 @@ import time
 import torch
 from torch.backends import cudnn
 from matplotlib import colors
+from cvat.apps.engine import model_registry
 from cvat.apps.engine.backbone import EfficientDetBackbone
 from cvat.apps.engine.efficientdet.utils import BBoxTransform, ClipBoxes
 from cvat.apps.engine.efficientdet_utils.utils import preprocess, invert_affine, postprocess, STANDARD_COLORS, standard_to_bgr, get_index_label, plot_one_box
@@ -13,28 +14,47 @@ import os
 import pathlib
 
 os.environ['DISPLAY'] = ':0'
-def efficientcut(frame_img,ROI):
-    #frame_img is a cv2.read output and ROI is a box defined by (xtl,ytl,xbr,ybr) or cv2.rect
-    input_image = np.array(frame_img[ROI[1]:ROI[3], ROI[0]:ROI[2]])
-    compound_coef = 0 # set to the model weights coefficient
-    force_input_size = None  # set None to use default size
 
-    # replace this part with your project's anchor config
-    anchor_ratios = [(1.0, 1.0), (1.4, 0.7), (0.7, 1.4)]
-    anchor_scales = [2 ** 0, 2 ** (1.0 / 3.0), 2 ** (2.0 / 3.0)]
+compound_coef = 0 # set to the model weights coefficient
+force_input_size = None  # set None to use default size
+
+# replace this part with your project's anchor config
+anchor_ratios = [(1.0, 1.0), (1.4, 0.7), (0.7, 1.4)]
+anchor_scales = [2 ** 0, 2 ** (1.0 / 3.0), 2 ** (2.0 / 3.0)]
+
+threshold = 0.2 # used to determine minimum allowable cofidence coefficient
+iou_threshold = 0.2 # used to determine the IOU threshold
+
+use_cuda = True
+use_float16 = False
+cudnn.fastest = True
+cudnn.benchmark = True
+
+obj_list = ['car', 'suv', 'van', 'truck', 'motorcycle', 'bicycle', 'tricycle', 'jeep', # classes
+            'bus']
 
-    threshold = 0.2 # used to determine minimum allowable cofidence coefficient
-    iou_threshold = 0.2 # used to determine the IOU threshold
+color_list = standard_to_bgr(STANDARD_COLORS)
 
-    use_cuda = True
-    use_float16 = False
-    cudnn.fastest = True
-    cudnn.benchmark = True
+device = 'cuda' if use_cuda else 'cpu'
+dtype = torch.float16 if use_float16 else torch.float32
+
+def _load_model(compound_coef):
+    model = EfficientDetBackbone(compound_coef=compound_coef, num_classes=len(obj_list),
+                                ratios=anchor_ratios, scales=anchor_scales)
+    path = os.path.abspath("./")
+    model_path = os.path.join(path,'cvat/apps/engine/efficientdet-d0_best.pth')
+    model.load_state_dict(torch.load(model_path, map_location='cpu')) # add path to weights here
+    return model
 
-    obj_list = ['car', 'suv', 'van', 'truck', 'motorcycle', 'bicycle', 'tricycle', 'jeep', # classes
-                'bus']
+model_registry.register('efficientcut', _load_model)
+
+def efficientcut_model_params():
+    return 'efficientcut', compound_coef, device, dtype
+
+def efficientcut(frame_img,ROI):
+    #frame_img is a cv2.read output and ROI is a box defined by (xtl,ytl,xbr,ybr) or cv2.rect
+    input_image = np.array(frame_img[ROI[1]:ROI[3], ROI[0]:ROI[2]])
 
-    color_list = standard_to_bgr(STANDARD_COLORS)
     # tf bilinear interpolation is different from any other's, just make do
     input_sizes = [512, 640, 768, 896, 1024, 1280, 1280, 1536, 1536]
     input_size = input_sizes[compound_coef] if force_input_size is None else force_input_size
@@ -47,19 +67,7 @@ def efficientcut(frame_img,ROI):
 
     x = x.to(torch.float32 if not use_float16 else torch.float16).permute(0, 3, 1, 2)
 
-    model = EfficientDetBackbone(compound_coef=compound_coef, num_classes=len(obj_list),
-                                ratios=anchor_ratios, scales=anchor_scales)
-    path = os.path.abspath("./")
-    model_path = os.path.join(path,'cvat/apps/engine/efficientdet-d0_best.pth')
-    # print('path',model_path)
-    model.load_state_dict(torch.load(model_path, map_location='cpu')) # add path to weights here
-    model.requires_grad_(False)
-    model.eval()
-
-    if use_cuda:
-        model = model.cuda()
-    if use_float16:
-        model = model.half()
+    model = model_registry.get_model(*efficientcut_model_params())
 
     with torch.no_grad():
         features, regression, classification, anchors = model(x)
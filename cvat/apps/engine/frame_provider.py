@@ -3,16 +3,23 @@
 # SPDX-License-Identifier: MIT
 
 import math
+import os
+import queue
+import threading
 from enum import Enum
 from io import BytesIO
 
 import cv2
 import numpy as np
+from av.video.reformatter import VideoReformatter
+from django.conf import settings
 from PIL import Image
 
-from cvat.apps.engine.cache import CacheInteraction
-from cvat.apps.engine.media_extractors import VideoReader, ZipReader
+from cvat.apps.engine.cache import CacheInteraction, MemoryCache
+from cvat.apps.engine.media_extractors import (ManifestReader, VideoReader,
+    ZipReader, get_manifest_path)
 from cvat.apps.engine.mime_types import mimetypes
+from cvat.apps.engine.prepare import PrepareInfo
 import time
 from cvat.apps.engine.models import DataChoice, StorageMethodChoice
 
@@ -44,6 +51,105 @@ class RandomAccessIterator:
         self.iterator = iter(self.iterable)
         self.pos = -1
 
+def _read_ahead(iterable, size):
+    """Iterates over iterable on a background thread and keeps up to
+    size items ready for the consumer.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as ex:
+            put((done, ex))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, ex = items.get()
+            if item is done:
+                if ex is not None:
+                    raise ex
+                return
+            yield item
+    finally:
+        # stops the producer if the consumer doesn't need more items
+        stop.set()
+
+class FrameCache(MemoryCache):
+    """LRU cache of decoded frames of the worker process. Frames are
+    identified by (data id, frame number, quality, output type).
+    """
+    def _get_size(self, value):
+        frame, _ = value
+        if isinstance(frame, np.ndarray):
+            return frame.nbytes
+        elif isinstance(frame, bytes):
+            return len(frame)
+        return 0
+
+    # Callers can modify the returned frames, so copies are stored and returned
+    @staticmethod
+    def _pack(frame):
+        if isinstance(frame, BytesIO):
+            return frame.getvalue()
+        return frame.copy()
+
+    @staticmethod
+    def _unpack(frame):
+        if isinstance(frame, bytes):
+            return BytesIO(frame)
+        return frame.copy()
+
+    def get(self, key):
+        item = super().get(key)
+        if item is None:
+            return None
+        frame, mime = item
+        return self._unpack(frame), mime
+
+    def put(self, key, frame, mime):
+        super().put(key, (self._pack(frame), mime))
+
+frame_cache = FrameCache(getattr(settings, 'FRAME_CACHE_SIZE', 256 * 1024 * 1024))
+
+# JPEG images are decoded at 1/2, 1/4 or 1/8 of the size by libjpeg itself
+IMREAD_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def _decode_image(image, downscale=1):
+    """Decodes the image into a BGR array. EXIF orientation is ignored
+    as in the chunks read with PIL.
+    """
+    data = image.getbuffer() if isinstance(image, BytesIO) else image.read()
+    array = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+        IMREAD_FLAGS[downscale] | cv2.IMREAD_IGNORE_ORIENTATION)
+    if array is None:
+        image.seek(0)
+        array = np.array(Image.open(image).convert('RGB'))[:, :, ::-1]
+        if downscale > 1:
+            array = cv2.resize(array, (array.shape[1] // downscale, array.shape[0] // downscale),
+                interpolation=cv2.INTER_AREA)
+    return array
+
 class FrameProvider:
     VIDEO_FRAME_EXT = '.PNG'
     VIDEO_FRAME_MIME = 'image/png'
@@ -67,26 +173,39 @@ class FrameProvider:
         def load(self, chunk_id):
             if self.chunk_id != chunk_id:
                 self.chunk_id = chunk_id
-                self.chunk_reader = RandomAccessIterator(
-                    self.reader_class([self.get_chunk_path(chunk_id)]))
+                self.chunk_reader = RandomAccessIterator(self.open(chunk_id))
             return self.chunk_reader
 
+        def open(self, chunk_id):
+            # a new reader for sequential reading, independent of load()
+            return self.reader_class([self.get_chunk_path(chunk_id)])
+
+    class PassthroughChunkLoader(ChunkLoader):
+        # Chunks of original images can be manifests of the source images
+        def get_manifest_path(self, chunk_id):
+            manifest_path = get_manifest_path(self.get_chunk_path(chunk_id))
+            return manifest_path if os.path.exists(manifest_path) else None
+
+        def open(self, chunk_id):
+            manifest_path = self.get_manifest_path(chunk_id)
+            if manifest_path:
+                return ManifestReader([manifest_path])
+            return super().open(chunk_id)
+
     class BuffChunkLoader(ChunkLoader):
-        def __init__(self, reader_class, path_getter, quality, db_data):
+        def __init__(self, reader_class, path_getter, buff_getter, quality, db_data):
             super().__init__(reader_class, path_getter)
+            self.get_chunk_buff = buff_getter
             self.quality = quality
             self.db_data = db_data
 
-        def load(self, chunk_id):
-            if self.chunk_id != chunk_id:
-                self.chunk_id = chunk_id
-                self.chunk_reader = RandomAccessIterator(
-                    self.reader_class([self.get_chunk_path(chunk_id, self.quality, self.db_data)[0]]))
-            return self.chunk_reader
+        def open(self, chunk_id):
+            return self.reader_class([self.get_chunk_buff(chunk_id, self.quality, self.db_data)[0]])
 
     def __init__(self, db_data):
         self._db_data = db_data
         self._loaders = {}
+        self._cache = None
 
         reader_class = {
             DataChoice.IMAGESET: ZipReader,
@@ -95,22 +214,25 @@ class FrameProvider:
 
         if db_data.storage_method == StorageMethodChoice.CACHE:
             cache = CacheInteraction()
+            self._cache = cache
 
             self._loaders[self.Quality.COMPRESSED] = self.BuffChunkLoader(
                 reader_class[db_data.compressed_chunk_type],
-                cache.get_buff_mime,
+                cache.get_chunk_path_mime,
+                cache.get_chunk_buff_mime,
                 self.Quality.COMPRESSED,
                 self._db_data)
             self._loaders[self.Quality.ORIGINAL] = self.BuffChunkLoader(
                 reader_class[db_data.original_chunk_type],
-                cache.get_buff_mime,
+                cache.get_chunk_path_mime,
+                cache.get_chunk_buff_mime,
                 self.Quality.ORIGINAL,
                 self._db_data)
         else:
             self._loaders[self.Quality.COMPRESSED] = self.ChunkLoader(
                 reader_class[db_data.compressed_chunk_type],
                 db_data.get_compressed_chunk_path)
-            self._loaders[self.Quality.ORIGINAL] = self.ChunkLoader(
+            self._loaders[self.Quality.ORIGINAL] = self.PassthroughChunkLoader(
                 reader_class[db_data.original_chunk_type],
                 db_data.get_original_chunk_path)
 
@@ -176,19 +298,23 @@ class FrameProvider:
                 else:
                     raise Exception('unsupported output type')
 
-    def _convert_frame(self, frame, reader_class, out_type):
+    def _convert_frame(self, frame, reader_class, out_type, reformatter=None, downscale=1):
+        """Converts a frame of a chunk to out_type. NUMPY_ARRAY frames are BGR
+        and can be downscaled by 2, 4 or 8. A reformatter keeps the conversion
+        context of video frames between calls.
+        """
         if out_type == self.Type.BUFFER:
             return self._av_frame_to_png_bytes(frame) if reader_class is VideoReader else frame
         elif out_type == self.Type.PIL:
             return frame.to_image() if reader_class is VideoReader else Image.open(frame)
         elif out_type == self.Type.NUMPY_ARRAY:
-            if reader_class is VideoReader:
-                image = frame.to_ndarray(format='bgr24')
-            else:
-                image = np.array(Image.open(frame))
-                if len(image.shape) == 3 and image.shape[2] in {3, 4}:
-                    image[:, :, :3] = image[:, :, 2::-1] # RGB to BGR
-            return image
+            if reader_class is not VideoReader:
+                return _decode_image(frame, downscale)
+            if reformatter is None:
+                reformatter = VideoReformatter()
+            frame = reformatter.reformat(frame, format='bgr24',
+                width=frame.width // downscale, height=frame.height // downscale)
+            return frame.to_ndarray()
         else:
             raise Exception('unsupported output type')
 
@@ -201,9 +327,79 @@ class FrameProvider:
             return self._loaders[quality].get_chunk_path(chunk_number, quality, self._db_data)
         return self._loaders[quality].get_chunk_path(chunk_number)
 
+    def _get_manifest_path(self, chunk_number, quality):
+        loader = self._loaders[quality]
+        if isinstance(loader, self.PassthroughChunkLoader):
+            return loader.get_manifest_path(chunk_number)
+        return None
+
+    def get_passthrough_chunk(self, chunk_number, quality=Quality.ORIGINAL):
+        """Returns a reader of the source images if the chunk is stored
+        as a manifest of them, otherwise None
+        """
+        chunk_number = self._validate_chunk_number(chunk_number)
+        manifest_path = self._get_manifest_path(chunk_number, quality)
+        return ManifestReader([manifest_path]) if manifest_path else None
+
+    def get_passthrough_frame(self, frame_number, quality=Quality.ORIGINAL):
+        """Returns the path of the source image if the frame can be sent
+        as the whole file, otherwise None
+        """
+        _, chunk_number, frame_offset = self._validate_frame_number(frame_number)
+        manifest_path = self._get_manifest_path(chunk_number, quality)
+        if not manifest_path:
+            return None
+        entry = ManifestReader([manifest_path]).get_entry(frame_offset)
+        if entry.offset or entry.size != os.path.getsize(entry.path):
+            return None
+        return entry.path
+
+    def _can_seek_source(self, quality, chunk_number):
+        # The original chunks of a video in the cache are built from the
+        # source video, so a single frame can be decoded from the nearest
+        # key frame of the source without building the whole chunk. Only the
+        # first request to a chunk which is not cached seeks, the next one
+        # builds the chunk. Providers live for one request, so the requests
+        # are counted in the cache.
+        loader = self._loaders[quality]
+        if quality != self.Quality.ORIGINAL or self._cache is None or \
+                loader.reader_class is not VideoReader or loader.chunk_id == chunk_number or \
+                not os.path.exists(self._db_data.get_meta_path()):
+            return False
+        if self._cache.is_cached(chunk_number, quality, self._db_data.id):
+            return False
+        return self._cache.mark_sought(chunk_number, quality, self._db_data.id)
+
     def get_frame(self, frame_number, quality=Quality.ORIGINAL,
             out_type=Type.BUFFER):
-        _, chunk_number, frame_offset = self._validate_frame_number(frame_number)
+        frame_number, chunk_number, _ = self._validate_frame_number(frame_number)
+        if self._can_seek_source(quality, chunk_number):
+            # frames of the source can differ from frames of the chunk, so they are not cached
+            return self._seek_frame(frame_number, out_type)
+
+        # PIL images keep the mode of the source image, so they are not made
+        # from cached BGR arrays. Original frames are mostly read one by one
+        # over the whole task (e.g. by dataset export), which would only
+        # evict other frames from the cache.
+        if out_type == self.Type.PIL or quality == self.Quality.ORIGINAL:
+            return self._decode_frame(frame_number, quality, out_type)
+
+        key = (self._db_data.id, frame_number, quality, out_type)
+        cached = frame_cache.get(key)
+        if cached is None:
+            cached = self._decode_frame(frame_number, quality, out_type)
+            frame_cache.put(key, *cached)
+        return cached
+
+    def _seek_frame(self, frame_number, out_type):
+        meta = PrepareInfo(
+            source_path=os.path.join(self._db_data.get_upload_dirname(), self._db_data.video.path),
+            meta_path=self._db_data.get_meta_path())
+        frame = meta.decode_frame(frame_number, self._db_data)
+        return (self._convert_frame(frame, VideoReader, out_type), self.VIDEO_FRAME_MIME)
+
+    def _decode_frame(self, frame_number, quality, out_type):
+        frame_number, chunk_number, frame_offset = self._validate_frame_number(frame_number)
         loader = self._loaders[quality]
         chunk_reader = loader.load(chunk_number)
         frame, frame_name, _ = chunk_reader[frame_offset]
@@ -214,39 +410,55 @@ class FrameProvider:
         return (frame, mimetypes.guess_type(frame_name))
 
     def get_frames(self, quality=Quality.ORIGINAL, out_type=Type.BUFFER):
+        # one pass over all frames would only evict frames from the cache
         for idx in range(self._db_data.size):
-            yield self.get_frame(idx, quality=quality, out_type=out_type)
+            yield self._decode_frame(idx, quality, out_type)
+
+    def _decode_range(self, frame_start, frame_end, quality, out_type, step, downscale):
+        loader = self._loaders[quality]
+        reformatter = VideoReformatter()
+        chunk_size = self._db_data.chunk_size
+        for chunk_number in range(frame_start // chunk_size, frame_end // chunk_size + 1):
+            chunk_start = chunk_number * chunk_size
+            # the first and the last requested frames in the chunk
+            first = frame_start + math.ceil(max(chunk_start - frame_start, 0) / step) * step
+            last = min(chunk_start + chunk_size - 1, frame_end)
+            if first > last:
+                continue
+
+            for offset, (frame, _, _) in enumerate(loader.open(chunk_number)):
+                frame_number = chunk_start + offset
+                if frame_number > last:
+                    break
+                if frame_number < first or (frame_number - frame_start) % step:
+                    continue
+                yield frame_number, self._convert_frame(frame, loader.reader_class,
+                    out_type, reformatter, downscale)
+
+    def get_frame_range(self, frame_start, frame_end, quality=Quality.ORIGINAL,
+            out_type=Type.BUFFER, step=1, prefetch=0, downscale=1):
+        """Yields (frame number, frame) for every step-th frame from frame_start
+        to frame_end inclusive. Every chunk is decoded once, in order. With
+        prefetch > 0 up to prefetch frames are decoded ahead on a background thread.
+        NUMPY_ARRAY frames can be decoded at 1/downscale of the size (2, 4 or 8).
+        The range is empty if frame_start is beyond the last frame.
+        """
+        step = max(int(step), 1)
+        if downscale not in IMREAD_FLAGS:
+            raise Exception('Unsupported downscale factor: {}'.format(downscale))
+        if int(frame_start) >= self._db_data.size:
+            return iter(())
+        frame_start, _, _ = self._validate_frame_number(frame_start)
+        frame_end = min(int(frame_end), self._db_data.size - 1)
+
+        frames = self._decode_range(frame_start, frame_end, quality, out_type, step, downscale)
+        if prefetch > 0:
+            frames = _read_ahead(frames, prefetch)
+        return frames
 
     def current_milli_time(self):
         return int(round(time.time() * 1000))
 
     def get_frames_improved(self, frame_start, frame_end,quality=Quality.ORIGINAL,out_type=Type.BUFFER,skip=1):
-        frames = []
-        loader = self._loaders[quality]
-
-        _, chunk_number, frame_offset = self._validate_frame_number(frame_start)
-        chunk_reader = loader.load(chunk_number)
-
-        chunk_number_start = chunk_number
-        # print('frame start:',frame_start)
-        # print('end: ',frame_end)
-        i=frame_start
-        # print('i',i)
-        start_while = self.current_milli_time()
-        # print('start while',start_while)
-        while(i<frame_end+1):
-            while(chunk_number == chunk_number_start and i<frame_end+1):
-                frame, frame_name, _ = chunk_reader[frame_offset]
-                start_convert = self.current_milli_time()
-                frame = self._convert_frame(frame, loader.reader_class, out_type)
-                # print('convert time',self.current_milli_time()-start_convert)
-                frames.append(frame)
-                i+=skip
-                _, chunk_number, frame_offset = self._validate_frame_number(i)
-                # print('i',i)
-            chunk_number_start = chunk_number
-            chunk_reader = loader.load(chunk_number)
-            # print('LOAD CHUNK')
-        # print('end while',self.current_milli_time()-start_while)
-        # print('frames length: ',len(frames))
-        return frames
+        return [frame for _, frame in self.get_frame_range(
+            frame_start, frame_end, quality, out_type, skip)]
@@ -8,10 +8,17 @@ import shutil
 import zipfile
 import io
 import itertools
+import math
+import struct
 from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import av
+import cv2
 import numpy as np
+from av.filter import Graph as FilterGraph
+from av.video.reformatter import VideoReformatter
 from pyunpack import Archive
 from PIL import Image, ImageFile
 from cvat.apps.engine.utils import rotate_image
@@ -36,6 +43,59 @@ def delete_tmp_dir(tmp_dir):
     if tmp_dir:
         shutil.rmtree(tmp_dir)
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# SOF markers of JPEG except DHT (0xC4), JPG (0xC8) and DAC (0xCC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# markers without a length field: TEM, RSTn, SOI, EOI
+JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xDA))
+
+def _read_jpeg_size(fp):
+    while True:
+        byte = fp.read(1)
+        while byte and byte != b'\xff':
+            byte = fp.read(1)
+        while byte == b'\xff': # fill bytes
+            byte = fp.read(1)
+        if not byte:
+            return None
+
+        marker = byte[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        segment_header = fp.read(2)
+        if len(segment_header) < 2:
+            return None
+        length = struct.unpack('>H', segment_header)[0]
+        if marker in JPEG_SOF_MARKERS:
+            sof = fp.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = struct.unpack('>HH', sof[1:])
+            return width, height
+        if marker == 0xDA: # image data starts without a frame header
+            return None
+        fp.seek(length - 2, io.SEEK_CUR)
+
+def get_image_size_from_header(fp):
+    """Reads the size of a JPEG or PNG image from its header.
+    Returns None for other formats and damaged headers.
+    """
+    header = fp.read(24)
+    if header.startswith(PNG_SIGNATURE) and header[12:16] == b'IHDR':
+        return struct.unpack('>II', header[16:24])
+    if header.startswith(b'\xff\xd8'):
+        fp.seek(2)
+        return _read_jpeg_size(fp)
+    return None
+
+def get_image_size(fp):
+    size = get_image_size_from_header(fp)
+    if size is None or not all(size):
+        fp.seek(0)
+        img = Image.open(fp)
+        size = img.width, img.height
+    return size
+
 class IMediaReader(ABC):
     def __init__(self, source_path, step, start, stop):
         self._source_path = sorted(source_path)
@@ -114,8 +174,17 @@ class ImageListReader(IMediaReader):
         return self._get_preview(fp)
 
     def get_image_size(self, i):
-        img = Image.open(self._source_path[i])
-        return img.width, img.height
+        with open(self._source_path[i], 'rb') as image_file:
+            return get_image_size(image_file)
+
+    def get_image_sizes(self, frames, workers=1):
+        """Returns sizes of the frames in the same order.
+        Only headers of JPEG and PNG images are read.
+        """
+        if workers <= 1:
+            return [self.get_image_size(i) for i in frames]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(self.get_image_size, frames))
 
 class DirectoryReader(ImageListReader):
     def __init__(self, source_path, step=1, start=0, stop=None):
@@ -189,8 +258,10 @@ class ZipReader(ImageListReader):
         return self._get_preview(io_image)
 
     def get_image_size(self, i):
-        img = Image.open(io.BytesIO(self._zip_source.read(self._source_path[i])))
-        return img.width, img.height
+        # members of the archive are read through a shared file object,
+        # which can be used by several threads
+        with self._zip_source.open(self._source_path[i]) as image_file:
+            return get_image_size(image_file)
 
     def get_image(self, i):
         return io.BytesIO(self._zip_source.read(self._source_path[i]))
@@ -205,6 +276,120 @@ class ZipReader(ImageListReader):
         self._zip_source.extractall(os.path.dirname(self._zip_source.filename))
         os.remove(self._zip_source.filename)
 
+def get_video_rotation(video_stream):
+    """Returns the clockwise rotation of the video from the stream metadata"""
+    return int(video_stream.metadata.get('rotate', 0)) % 360
+
+def get_rotated_size(width, height, rotation):
+    # the same bounds as in rotate_image()
+    angle = math.radians(rotation)
+    abs_cos, abs_sin = abs(math.cos(angle)), abs(math.sin(angle))
+    return int(height * abs_sin + width * abs_cos), int(height * abs_cos + width * abs_sin)
+
+class VideoRotator:
+    """Rotates decoded frames of a video stream according to its metadata.
+    The rotation is read once, right angles are applied by an FFmpeg
+    filter graph without conversion of frames to numpy arrays.
+    """
+    FILTERS = {
+        90: [('transpose', 'clock')],
+        180: [('hflip', None), ('vflip', None)],
+        270: [('transpose', 'cclock')],
+    }
+
+    def __init__(self, video_stream):
+        self.rotation = get_video_rotation(video_stream)
+        self._graph = None
+        self._source = None
+        self._sink = None
+        self._input_format = None
+
+    def _configure(self, frame):
+        self._graph = FilterGraph()
+        self._source = self._graph.add_buffer(width=frame.width, height=frame.height,
+            format=frame.format.name)
+        last = self._source
+        for name, args in self.FILTERS[self.rotation]:
+            node = self._graph.add(name, args)
+            last.link_to(node)
+            last = node
+        self._sink = self._graph.add('buffersink')
+        last.link_to(self._sink)
+        self._graph.configure()
+        self._input_format = (frame.width, frame.height, frame.format.name)
+
+    def rotate(self, frame):
+        if not self.rotation:
+            return frame
+
+        if self.rotation not in self.FILTERS:
+            rotated = av.VideoFrame().from_ndarray(
+                rotate_image(frame.to_ndarray(format='bgr24'), 360 - self.rotation),
+                format ='bgr24'
+            )
+        else:
+            if self._input_format != (frame.width, frame.height, frame.format.name):
+                self._configure(frame)
+            self._source.push(frame)
+            rotated = self._sink.pull()
+        rotated.pts = frame.pts
+        return rotated
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'offset', 'size'])
+
+def get_manifest_path(chunk_path):
+    return os.path.splitext(chunk_path)[0] + '.manifest'
+
+def read_manifest(manifest_path):
+    """Returns entries of the manifest with absolute paths of the images"""
+    manifest_dir = os.path.dirname(manifest_path)
+    entries = []
+    with open(manifest_path, 'r') as manifest:
+        for line in manifest:
+            offset, size, path = line.rstrip('\n').split(' ', 2)
+            entries.append(ManifestEntry(os.path.normpath(os.path.join(manifest_dir, path)),
+                int(offset), int(size)))
+    return entries
+
+class ManifestReader(IMediaReader):
+    """Reads images of a chunk from the source files listed in its manifest"""
+    def __init__(self, source_path, step=1, start=0, stop=None):
+        self._entries = read_manifest(source_path[0])
+        super().__init__(
+            source_path=source_path,
+            step=max(step, 1),
+            start=start,
+            stop=len(self._entries) if stop is None else min(len(self._entries), stop + 1),
+        )
+
+    def __iter__(self):
+        for i in self.frame_range:
+            yield (self.get_image(i), self.get_path(i), i)
+
+    def get_entry(self, i):
+        return self._entries[i]
+
+    def get_path(self, i):
+        return self._entries[i].path
+
+    def get_image(self, i):
+        entry = self._entries[i]
+        with open(entry.path, 'rb') as image_file:
+            image_file.seek(entry.offset)
+            data = image_file.read(entry.size)
+        if len(data) != entry.size:
+            raise Exception('The source image {} was changed'.format(entry.path))
+        return io.BytesIO(data)
+
+    def get_progress(self, pos):
+        return (pos - self._start + 1) / (self._stop - self._start)
+
+    def get_preview(self):
+        return self._get_preview(self.get_image(0))
+
+    def get_image_size(self, i):
+        return get_image_size(self.get_image(i))
+
 class VideoReader(IMediaReader):
     def __init__(self, source_path, step=1, start=0, stop=None):
         super().__init__(
@@ -224,21 +409,13 @@ class VideoReader(IMediaReader):
 
     def _decode(self, container):
         frame_num = 0
+        rotator = VideoRotator(container.streams.video[0])
         for packet in container.demux():
             if packet.stream.type == 'video':
                 for image in packet.decode():
                     frame_num += 1
                     if self._has_frame(frame_num - 1):
-                        if packet.stream.metadata.get('rotate'):
-                            old_image = image
-                            image = av.VideoFrame().from_ndarray(
-                                rotate_image(
-                                    image.to_ndarray(format='bgr24'),
-                                    360 - int(container.streams.video[0].metadata.get('rotate'))
-                                ),
-                                format ='bgr24'
-                            )
-                            image.pts = old_image.pts
+                        image = rotator.rotate(image)
                         yield (image, self._source_path[0], image.pts)
 
     def __iter__(self):
@@ -263,42 +440,68 @@ class VideoReader(IMediaReader):
         container = self._get_av_container()
         stream = container.streams.video[0]
         preview = next(container.decode(stream))
-        return self._get_preview(preview.to_image() if not stream.metadata.get('rotate') \
-            else av.VideoFrame().from_ndarray(
-                rotate_image(
-                    preview.to_ndarray(format='bgr24'),
-                    360 - int(container.streams.video[0].metadata.get('rotate'))
-                ),
-                format ='bgr24'
-            ).to_image()
-        )
+        return self._get_preview(VideoRotator(stream).rotate(preview).to_image())
 
     def get_image_size(self, i):
         image = (next(iter(self)))[0]
         return image.width, image.height
 
 class IChunkWriter(ABC):
-    def __init__(self, quality):
+    def __init__(self, quality, encoding=None):
+        # encoding contains settings of the video encoder, image writers ignore them
         self._image_quality = quality
 
     @staticmethod
-    def _compress_image(image_path, quality):
-        image = image_path.to_image() if isinstance(image_path, av.VideoFrame) else Image.open(image_path)
-        # Ensure image data fits into 8bit per pixel before RGB conversion as PIL clips values on conversion
-        if image.mode == "I":
-            # Image mode is 32bit integer pixels.
-            # Autoscale pixels by factor 2**8 / im_data.max() to fit into 8bit
-            im_data = np.array(image)
-            im_data = im_data * (2**8 / im_data.max())
-            image = Image.fromarray(im_data.astype(np.int32))
-        converted_image = image.convert('RGB')
-        image.close()
-        buf = io.BytesIO()
-        converted_image.save(buf, format='JPEG', quality=quality, optimize=True)
-        buf.seek(0)
-        width, height = converted_image.size
-        converted_image.close()
-        return width, height, buf
+    def _to_8bit(image):
+        # Ensure image data fits into 8bit per pixel.
+        # Autoscale pixels of every channel by factor 2**8 / channel.max()
+        # to fit into 8bit with integer math. Float pixels are clipped as by
+        # the conversion of PIL.
+        if image.dtype == np.uint8:
+            return image
+        if np.issubdtype(image.dtype, np.integer):
+            max_value = np.maximum(image.max(axis=(0, 1), keepdims=True), 1)
+            image = (image.astype(np.int64) << 8) // max_value
+        return np.clip(image, 0, 255).astype(np.uint8)
+
+    @classmethod
+    def _read_image(cls, image_path):
+        """Returns the image as a BGR or grayscale 8bit array"""
+        if isinstance(image_path, av.VideoFrame):
+            return image_path.to_ndarray(format='bgr24')
+
+        if isinstance(image_path, io.BytesIO):
+            data = image_path.getvalue()
+        else:
+            with open(image_path, 'rb') as image_file:
+                data = image_file.read()
+        # EXIF orientation is ignored as before
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            # formats which are not supported by OpenCV
+            with Image.open(io.BytesIO(data)) as pil_image:
+                if pil_image.mode in ('I', 'I;16', 'F'):
+                    image = np.array(pil_image)
+                else:
+                    image = np.array(pil_image.convert('RGB'))[:, :, ::-1]
+        elif image.ndim == 3 and image.shape[2] == 4:
+            image = image[:, :, :3] # alpha is dropped as by PIL
+        return cls._to_8bit(image)
+
+    @classmethod
+    def _compress_image(cls, image_path, quality, optimize=False):
+        image = cls._read_image(image_path)
+        if image.ndim == 2:
+            # the client expects color images as before
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        success, result = cv2.imencode('.jpeg', image, [
+            cv2.IMWRITE_JPEG_QUALITY, quality,
+            cv2.IMWRITE_JPEG_OPTIMIZE, int(optimize),
+        ])
+        if not success:
+            raise Exception('Failed to encode image to JPEG format')
+        height, width = image.shape[:2]
+        return width, height, io.BytesIO(result.tobytes())
 
     @abstractmethod
     def save_as_chunk(self, images, chunk_path):
@@ -317,12 +520,74 @@ class ZipChunkWriter(IChunkWriter):
         # and does not decode it to know img size.
         return []
 
+class _StreamBuffer(io.RawIOBase):
+    """A write-only stream, which returns the written data by parts"""
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+def stream_zip_chunk(images):
+    """Yields parts of a zip chunk with the images as ZipChunkWriter writes it"""
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as zip_chunk:
+        for idx, (image, path, _) in enumerate(images):
+            arcname = '{:06d}{}'.format(idx, os.path.splitext(path)[1])
+            zip_chunk.writestr(arcname, image.getvalue())
+            yield buffer.pop()
+    yield buffer.pop()
+
+class ManifestChunkWriter(IChunkWriter):
+    """Writes a manifest with the source images of the chunk instead of
+    a zip with their copies. Chunks with images which are not files are
+    written as zip files. Relative paths of images (e.g. names of archive
+    members) are resolved against the upload directory.
+    """
+    def __init__(self, quality, encoding=None, upload_dir=None):
+        super().__init__(quality, encoding)
+        self._upload_dir = upload_dir
+
+    def _get_source_path(self, path):
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self._upload_dir, path) if self._upload_dir else None
+
+    def save_as_chunk(self, images, chunk_path):
+        paths = [self._get_source_path(path) for _, path, _ in images]
+        if not all(path and os.path.isfile(path) for path in paths):
+            return ZipChunkWriter(self._image_quality).save_as_chunk(images, chunk_path)
+
+        manifest_path = get_manifest_path(chunk_path)
+        manifest_dir = os.path.dirname(manifest_path)
+        with open(manifest_path, 'x') as manifest:
+            for path in paths:
+                manifest.write('{} {} {}\n'.format(0, os.path.getsize(path),
+                    os.path.relpath(path, manifest_dir)))
+        return []
+
 class ZipCompressedChunkWriter(IChunkWriter):
+    def __init__(self, quality, encoding=None):
+        super().__init__(quality, encoding)
+        # the second pass of optimization of Huffman tables makes images
+        # a few percent smaller, but encoding is noticeably slower
+        self._optimize = (encoding or {}).get('optimize', False)
+
     def save_as_chunk(self, images, chunk_path):
         image_sizes = []
         with zipfile.ZipFile(chunk_path, 'x') as zip_chunk:
             for idx, (image, _ , _) in enumerate(images):
-                w, h, image_buf = self._compress_image(image, self._image_quality)
+                w, h, image_buf = self._compress_image(image, self._image_quality, self._optimize)
                 image_sizes.append((w, h))
                 arcname = '{:06d}.jpeg'.format(idx)
                 zip_chunk.writestr(arcname, image_buf.getvalue())
@@ -330,9 +595,33 @@ class ZipCompressedChunkWriter(IChunkWriter):
         return image_sizes
 
 class Mpeg4ChunkWriter(IChunkWriter):
-    def __init__(self, _):
+    # libx264 settings: the number of threads (0 - automatic), the preset,
+    # the tune and the GOP size ('chunk' - one GOP per chunk, empty - the
+    # encoder default). The default encoder settings are used for empty values.
+    DEFAULT_ENCODING = {
+        'threads': 1,
+        'preset': 'ultrafast',
+        'tune': '',
+        'gop': '',
+    }
+
+    def __init__(self, _, encoding=None):
         super().__init__(17)
         self._output_fps = 25
+        self._encoding = dict(self.DEFAULT_ENCODING, **(encoding or {}))
+
+    def _get_encoding_options(self, frames):
+        options = {
+            'threads': str(self._encoding['threads']),
+        }
+        for option in ['preset', 'tune']:
+            if self._encoding[option]:
+                options[option] = self._encoding[option]
+
+        gop = self._encoding['gop']
+        if gop:
+            options['g'] = str(frames if gop == 'chunk' else int(gop))
+        return options
 
     @staticmethod
     def _create_av_container(path, w, h, rate, options, f='mp4'):
@@ -365,7 +654,7 @@ class Mpeg4ChunkWriter(IChunkWriter):
             rate=self._output_fps,
             options={
                 "crf": str(self._image_quality),
-                "preset": "ultrafast",
+                **self._get_encoding_options(len(images)),
             },
         )
 
@@ -388,10 +677,14 @@ class Mpeg4ChunkWriter(IChunkWriter):
             container.mux(packet)
 
 class Mpeg4CompressedChunkWriter(Mpeg4ChunkWriter):
-    def __init__(self, quality):
+    DEFAULT_ENCODING = dict(Mpeg4ChunkWriter.DEFAULT_ENCODING, preset='')
+
+    def __init__(self, quality, encoding=None):
+        super().__init__(quality, encoding)
         # translate inversed range [1:100] to [0:51]
         self._image_quality = round(51 * (100 - quality) / 99)
-        self._output_fps = 25
+        # frames of all chunks are scaled with the same swscale context
+        self._reformatter = VideoReformatter()
 
 
     def save_as_chunk(self, images, chunk_path):
@@ -418,11 +711,17 @@ class Mpeg4CompressedChunkWriter(Mpeg4ChunkWriter):
                 'coder': '0',
                 'crf': str(self._image_quality),
                 'wpredp': '0',
-                'flags': '-loop'
+                'flags': '-loop',
+                **self._get_encoding_options(len(images)),
             },
         )
 
-        self._encode_images(images, output_container, output_v_stream)
+        # odd sizes are rounded up by the container, the frames are scaled
+        # to the size of the stream
+        scaled_images = ((self._reformatter.reformat(frame, width=output_v_stream.width,
+            height=output_v_stream.height, format='yuv420p'), path, frame_number)
+            for frame, path, frame_number in images)
+        self._encode_images(scaled_images, output_container, output_v_stream)
         output_container.close()
         return [(input_w, input_h)]
 
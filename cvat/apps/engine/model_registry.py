@@ -0,0 +1,172 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from configparser import ConfigParser
+
+import torch
+
+from cvat.apps.engine.log import slogger
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+DEFAULT_MEMORY_BUDGET = 4096 * 1024 * 1024 # 4 GB
+
+ModelKey = namedtuple('ModelKey', ['family', 'compound_coef', 'device', 'dtype'])
+
+def _get_model_size(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+class ModelRegistry:
+    """Keeps loaded models in memory for the lifetime of a worker process.
+
+    Models are identified by (family, compound_coef, device, dtype). Every
+    family has a loader which builds the model on CPU and loads its weights.
+    The least recently used models are evicted when the total size of the
+    loaded models exceeds the memory budget.
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self._loaders = {}
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._load_locks = {}
+        self._lock = threading.RLock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'load_time': 0.0,
+            'hit_time': 0.0,
+        }
+
+    def register(self, family, loader):
+        self._loaders[family] = loader
+
+    def get(self, family, compound_coef=0, device='cpu', dtype=torch.float32):
+        key = ModelKey(family, int(compound_coef), str(device), dtype)
+        start = time.perf_counter()
+        with self._lock:
+            model = self._get_loaded(key, start)
+            if model is not None:
+                return model
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Models are built without the registry lock, so other models are
+        # served meanwhile. A model is loaded once by the first thread which
+        # requests it, other threads wait for it.
+        with load_lock:
+            try:
+                with self._lock:
+                    model = self._get_loaded(key, start)
+                    if model is not None:
+                        return model
+                    self._stats['misses'] += 1
+
+                model = self._load(key)
+                size = _get_model_size(model)
+                with self._lock:
+                    self._evict(size)
+                    self._models[key] = model
+                    self._sizes[key] = size
+                    elapsed = time.perf_counter() - start
+                    self._stats['load_time'] += elapsed
+            finally:
+                with self._lock:
+                    self._load_locks.pop(key, None)
+
+        slogger.glob.info('Model {} was loaded in {:.2f} s ({:.1f} MB)'.format(
+            key, elapsed, size / 2**20))
+        return model
+
+    def _get_loaded(self, key, start):
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+            self._stats['hits'] += 1
+            self._stats['hit_time'] += time.perf_counter() - start
+        return model
+
+    def _load(self, key):
+        if key.family not in self._loaders:
+            raise Exception('Unknown model family: {}'.format(key.family))
+
+        model = self._loaders[key.family](key.compound_coef)
+        model.requires_grad_(False)
+        model.eval()
+        return model.to(device=key.device, dtype=key.dtype)
+
+    def _evict(self, required_size):
+        while self._models and \
+                sum(self._sizes.values()) + required_size > self.memory_budget:
+            key, _ = self._models.popitem(last=False)
+            self._sizes.pop(key)
+            self._stats['evictions'] += 1
+            slogger.glob.info('Model {} was evicted from the registry'.format(key))
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['models'] = [
+                {'key': tuple(str(v) for v in key), 'size': self._sizes[key]}
+                for key in self._models
+            ]
+            stats['size'] = sum(self._sizes.values())
+            return stats
+
+def _read_config():
+    config = ConfigParser()
+    config.read(CONFIG_PATH)
+    return config
+
+def _create_registry():
+    config = _read_config()
+    memory_budget = DEFAULT_MEMORY_BUDGET
+    if config.has_option('models', 'memory_budget_mb'):
+        memory_budget = config.getint('models', 'memory_budget_mb') * 1024 * 1024
+    return ModelRegistry(memory_budget)
+
+registry = _create_registry()
+
+def get_model(family, compound_coef=0, device='cpu', dtype=torch.float32):
+    return registry.get(family, compound_coef, device, dtype)
+
+def prewarm():
+    """Loads the models which are enabled in config.ini"""
+    # Loaders are registered by the modules which use the models
+    from cvat.apps.engine.predict import predict_model_params
+    from cvat.apps.engine.efficientcut import efficientcut_model_params
+    from cvat.apps.engine.track import siamrpn_model_params
+
+    config = _read_config()
+    specs = [predict_model_params(config['main']['predict_bb_models'])]
+    if config.getboolean('main', 'autofit'):
+        specs.append(efficientcut_model_params())
+    if config['main']['tracker'] == 'siamrpn':
+        specs.append(siamrpn_model_params())
+
+    for family, compound_coef, device, dtype in specs:
+        try:
+            registry.get(family, compound_coef, device, dtype)
+        except Exception as ex:
+            slogger.glob.warning('Model {} d{} cannot be prewarmed: {}'.format(
+                family, compound_coef, str(ex)))
+
+def prewarm_enabled():
+    config = _read_config()
+    return config.getboolean('models', 'prewarm', fallback=False)
+
+def prewarm_async():
+    threading.Thread(target=prewarm, daemon=True).start()
@@ -11,6 +11,7 @@ from matplotlib import colors
 import cv2
 import numpy as np
 
+from cvat.apps.engine import model_registry
 from cvat.apps.engine.backbone import EfficientDetBackbone
 from cvat.apps.engine.efficientdet.utils import BBoxTransform, ClipBoxes
 from cvat.apps.engine.efficientdet_utils.utils import preprocess,preprocess_frame, invert_affine, postprocess, STANDARD_COLORS, standard_to_bgr, get_index_label, plot_one_box
@@ -46,33 +47,46 @@ color_list = standard_to_bgr(STANDARD_COLORS)
 
 # frame = cv2.imread(img_path)
 
+device = 'cuda' if use_cuda else 'cpu'
+dtype = torch.float16 if use_float16 else torch.float32
+
+def _load_model(compound_coef):
+    model = EfficientDetBackbone(compound_coef=compound_coef, num_classes=len(obj_list),
+                                ratios=anchor_ratios, scales=anchor_scales)
+    path = os.path.abspath("./")
+    model_path = os.path.join(path,f'cvat/apps/engine/weights/efficientdet-d{compound_coef}.pth')
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    return model
+
+model_registry.register('efficientdet', _load_model)
+
+def predict_model_params(compound_coef=0):
+    return 'efficientdet', int(compound_coef), device, dtype
+
 def predict(frame,compound_coef = 0):
+    return predict_batch([frame], compound_coef)[0]
+
+def predict_batch(frames, compound_coef = 0):
+    """Runs the detector on a list of RGB frames as a single batch.
+
+    Returns a list with one {'bbox': [...], 'labels': [...]} item per frame.
+    """
     compound_coef = int(compound_coef)
     # tf bilinear interpolation is different from any other's, just make do
     input_sizes = [512, 640, 768, 896, 1024, 1280, 1280, 1536, 1536]
     input_size = input_sizes[compound_coef] if force_input_size is None else force_input_size
-    ori_imgs, framed_imgs, framed_metas = preprocess_frame(frame, max_size=input_size)
 
-    if use_cuda:
-        x = torch.stack([torch.from_numpy(fi).cuda() for fi in framed_imgs], 0)
-    else:
-        x = torch.stack([torch.from_numpy(fi) for fi in framed_imgs], 0)
+    framed_imgs = []
+    framed_metas = []
+    for frame in frames:
+        _, framed_img, framed_meta = preprocess_frame(frame, max_size=input_size)
+        framed_imgs.extend(framed_img)
+        framed_metas.extend(framed_meta)
 
-    x = x.to(torch.float32 if not use_float16 else torch.float16).permute(0, 3, 1, 2)
+    x = torch.stack([torch.from_numpy(fi) for fi in framed_imgs], 0)
+    x = x.to(device=device, dtype=dtype).permute(0, 3, 1, 2)
 
-    model = EfficientDetBackbone(compound_coef=compound_coef, num_classes=len(obj_list),
-                                ratios=anchor_ratios, scales=anchor_scales)
-    path = os.path.abspath("./")
-    model_path = os.path.join(path,f'cvat/apps/engine/weights/efficientdet-d{compound_coef}.pth')
-    # print('path',model_path)
-    model.load_state_dict(torch.load(model_path, map_location='cpu'))
-    model.requires_grad_(False)
-    model.eval()
-
-    if use_cuda:
-        model = model.cuda()
-    if use_float16:
-        model = model.half()
+    model = model_registry.get_model(*predict_model_params(compound_coef))
 
     with torch.no_grad():
         features, regression, classification, anchors = model(x)
@@ -87,72 +101,51 @@ def predict(frame,compound_coef = 0):
     out = invert_affine(framed_metas, out)
     out = remove_undesired(out,desired_classes)
     out = remove_overlapping(out,0.9)
-    display(out, ori_imgs, imshow=False, imwrite=False)
 
-    result = {}
-    result['bbox'] = []
+    results = []
+    for pred in out:
+        results.append({
+            'bbox': [[int(coord) for coord in box] for box in pred['rois']],
+            'labels': [obj_list[int(class_id)] for class_id in pred['class_ids']],
+        })
+    return results
 
-    for box1 in out[0]['rois']:
-        temp = []
-        for coord in box1:
-            temp.append(int(coord))
-        result['bbox'].append(temp)
-    # print(result)
-    return result
+def _filter_prediction(pred, mask):
+    pred['rois'] = pred['rois'][mask]
+    pred['class_ids'] = pred['class_ids'][mask]
+    pred['scores'] = pred['scores'][mask]
 
 def remove_undesired(preds, desired_classes):
-    # print(preds)
-    length = len(preds[0]['rois'])
-    i=0
-    while i<length:
-        # print('counter ',i)
-        class_id = int(preds[0]['class_ids'][i])
-        try:
-            desired_classes.index(class_id)
-        except:
-            # print('delete',i)
-            preds[0]['rois']=np.delete(preds[0]['rois'],i,axis=0)
-            preds[0]['class_ids']=np.delete(preds[0]['class_ids'],i,axis=0)
-            preds[0]['scores']=np.delete(preds[0]['scores'],i,axis=0)
-            i-=1
-            length -= 1
-            # print('i,length',i,length)
-        i+=1
-    # print(preds)
-    # print(len(preds[0]['rois']))
-    # print(len(preds[0]['class_ids']))
-    # print(len(preds[0]['scores']))
+    for pred in preds:
+        if len(pred['rois']) == 0:
+            continue
+        _filter_prediction(pred, np.isin(pred['class_ids'].astype(np.int64), desired_classes))
     return preds
+
+def pairwise_intersection_over_union(boxes):
+    # the same formula as bb_intersection_over_union for all pairs of boxes at once
+    boxes = np.asarray(boxes, dtype=np.float64)
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    xA = np.maximum(x1[:, None], x1[None, :])
+    yA = np.maximum(y1[:, None], y1[None, :])
+    xB = np.minimum(x2[:, None], x2[None, :])
+    yB = np.minimum(y2[:, None], y2[None, :])
+    interArea = np.maximum(0, xB - xA + 1) * np.maximum(0, yB - yA + 1)
+    boxArea = (x2 - x1 + 1) * (y2 - y1 + 1)
+    return interArea / (boxArea[:, None] + boxArea[None, :] - interArea)
+
 def remove_overlapping(preds,iou_threshold):
-    index_to_delete = []
-    for box1 in preds[0]['rois']:
-        # print(type(box1))
-        for box2 in preds[0]['rois']:
-            if(not np.array_equal(box1,box2)):
-                IOU = bb_intersection_over_union(box1,box2)
-                if(IOU>iou_threshold):
-                    print('detected overlap more than threshold')
-                    index1 = np.where(preds[0]['rois']==box1)
-                    index2 = np.where(preds[0]['rois']==box2)
-                    print(index1)
-                    # print(preds[0]['scores'][index1[0]])
-                    # print(preds[0]['scores'][index2[0]])
-                    score1 = preds[0]['scores'][index1[0]]
-                    score2 = preds[0]['scores'][index2[0]]
-                    # print('score1',score1)
-                    # print(np.shape(preds[0]['scores'][index1[0]]))
-                    if(score1[0]>score2[0]):
-                        index_to_delete.append(index2[0][0])
-                    else:
-                        index_to_delete.append(index1[0][0])
-    index_to_delete = np.unique(index_to_delete)
-    index_to_delete = np.sort(index_to_delete)
-    index_to_delete = index_to_delete[::-1]
-    # print('index to delete',index_to_delete)
-    for i in index_to_delete:
-        preds[0]['rois']=np.delete(preds[0]['rois'],i,axis=0)
-        preds[0]['class_ids']=np.delete(preds[0]['class_ids'],i,axis=0)
-        preds[0]['scores']=np.delete(preds[0]['scores'],i,axis=0)
+    # Cross-class suppression: a box is removed if it overlaps another box
+    # with a higher or equal score. Identical boxes are not compared.
+    for pred in preds:
+        rois = pred['rois']
+        if len(rois) < 2:
+            continue
+        identical = np.all(rois[:, None, :] == rois[None, :, :], axis=2)
+        overlapping = (pairwise_intersection_over_union(rois) > iou_threshold) & ~identical
+        scores = pred['scores']
+        suppressed = np.any(overlapping & (scores[:, None] <= scores[None, :]), axis=1)
+        _filter_prediction(pred, ~suppressed)
     return preds
 
 
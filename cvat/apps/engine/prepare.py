@@ -3,10 +3,18 @@
 # SPDX-License-Identifier: MIT
 
 import av
-from collections import OrderedDict
-import hashlib
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import math
 import os
-from cvat.apps.engine.utils import rotate_image
+import threading
+import zlib
+
+import numpy as np
+
+from cvat.apps.engine.media_extractors import VideoRotator, get_rotated_size, get_video_rotation
 
 class WorkWithVideo:
     def __init__(self, **kwargs):
@@ -25,39 +33,152 @@ class WorkWithVideo:
         video_stream.thread_type = 'AUTO'
         return video_stream
 
-class AnalyzeVideo(WorkWithVideo):
-    def check_type_first_frame(self):
-        container = self._open_video_container(self.source_path, mode='r')
-        video_stream = self._get_video_stream(container)
+VideoInfo = namedtuple('VideoInfo', ['frames', 'key_frames', 'frame_size', 'checksums'])
 
-        for packet in container.demux(video_stream):
-            for frame in packet.decode():
-                self._close_video_container(container)
-                assert frame.pict_type.name == 'I', 'First frame is not key frame'
-                return
+# Number of threads which check seeking to key frames
+SEEK_CHECK_WORKERS = min(8, os.cpu_count() or 1)
+# Packets after a key frame which are checked for leading frames of an open GOP
+LEADING_FRAMES_CHECK = 16
+
+def packet_checksum(packet):
+    return zlib.crc32(bytes(packet))
+
+def _get_rotated_size(frame, video_stream):
+    return get_rotated_size(frame.width, frame.height, get_video_rotation(video_stream))
 
-    def check_video_timestamps_sequences(self):
+class AnalyzeVideo(WorkWithVideo):
+    def analyze(self):
+        """Checks the video and collects the key frames and the number of
+        frames in one pass over the packets. Only the first frame is decoded.
+        Returns VideoInfo with key frames as {frame number: pts} and
+        checksums of the key frame packets as {pts: crc32}.
+        """
         container = self._open_video_container(self.source_path, mode='r')
-        video_stream = self._get_video_stream(container)
+        try:
+            video_stream = self._get_video_stream(container)
+
+            first_frame = None
+            timestamps = []
+            key_frame_timestamps = []
+            checksums = {}
+            frame_dts = None
+            for packet in container.demux(video_stream):
+                if not packet.size:
+                    continue # packets which flush the decoder
+
+                if None not in [packet.dts, frame_dts] and packet.dts <= frame_dts:
+                    raise Exception('Invalid dts sequences')
+                frame_dts = packet.dts
+
+                if first_frame is None:
+                    first_frame = next(iter(packet.decode()), None)
+                    if first_frame is not None:
+                        assert first_frame.pict_type.name == 'I', 'First frame is not key frame'
+                        frame_size = _get_rotated_size(first_frame, video_stream)
+
+                timestamps.append(packet.pts)
+                if packet.is_keyframe:
+                    key_frame_timestamps.append(packet.pts)
+                    checksums[packet.pts] = packet_checksum(packet)
+            stream_frames = video_stream.frames
+        finally:
+            self._close_video_container(container)
 
-        frame_pts = -1
-        frame_dts = -1
-        for packet in container.demux(video_stream):
-            for frame in packet.decode():
+        # Frames are numbered in presentation order, which can differ from
+        # the order of packets. The numbers are found by the sorted timestamps
+        # if every packet has a timestamp and contains exactly one frame.
+        if None in timestamps or first_frame is None or \
+                (stream_frames and stream_frames != len(timestamps)):
+            return self._analyze_frames()
 
-                if None not in [frame.pts, frame_pts] and frame.pts <= frame_pts:
-                    self._close_video_container(container)
-                    raise Exception('Invalid pts sequences')
+        timestamps.sort()
+        if any(pts <= prev_pts for prev_pts, pts in zip(timestamps, timestamps[1:])):
+            raise Exception('Invalid pts sequences')
 
-                if None not in [frame.dts, frame_dts] and frame.dts <= frame_dts:
-                    self._close_video_container(container)
-                    raise Exception('Invalid dts sequences')
+        key_frames = OrderedDict(sorted(
+            (bisect_left(timestamps, pts), pts) for pts in key_frame_timestamps))
+        return VideoInfo(len(timestamps), key_frames, frame_size, checksums)
 
-                frame_pts, frame_dts = frame.pts, frame.dts
-        self._close_video_container(container)
+    def _analyze_frames(self):
+        container = self._open_video_container(self.source_path, mode='r')
+        try:
+            video_stream = self._get_video_stream(container)
+
+            frame_size = None
+            key_frames = OrderedDict()
+            frame_number = 0
+            frame_pts = -1
+            frame_dts = -1
+            for packet in container.demux(video_stream):
+                for frame in packet.decode():
+                    if frame_size is None:
+                        assert frame.pict_type.name == 'I', 'First frame is not key frame'
+                        frame_size = _get_rotated_size(frame, video_stream)
+
+                    if None not in [frame.pts, frame_pts] and frame.pts <= frame_pts:
+                        raise Exception('Invalid pts sequences')
+
+                    if None not in [frame.dts, frame_dts] and frame.dts <= frame_dts:
+                        raise Exception('Invalid dts sequences')
+
+                    frame_pts, frame_dts = frame.pts, frame.dts
+                    if frame.key_frame:
+                        key_frames[frame_number] = frame.pts
+                    frame_number += 1
+        finally:
+            self._close_video_container(container)
 
-def md5_hash(frame):
-    return hashlib.md5(frame.to_image().tobytes()).hexdigest()
+        # packets are not matched to the decoded frames here
+        return VideoInfo(frame_number, key_frames, frame_size, {})
+
+class KeyFrameIndex:
+    """Sorted numbers and timestamps of the key frames of a video"""
+    def __init__(self, frame_numbers, timestamps):
+        self.frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+
+    @classmethod
+    def from_meta_file(cls, meta_path):
+        with open(meta_path, 'r') as meta_file:
+            # the meta file of an uploaded video ends with the number of frames
+            key_frames = [line.split() for line in meta_file]
+        key_frames = sorted((int(frame_number), int(timestamp))
+            for frame_number, timestamp in filter(lambda x: len(x) == 2, key_frames))
+        if not key_frames:
+            return cls([], [])
+        return cls(*zip(*key_frames))
+
+    def __len__(self):
+        return len(self.frame_numbers)
+
+    def get_nearest_left(self, frame_number):
+        idx = int(np.searchsorted(self.frame_numbers, frame_number, side='right')) - 1
+        if idx < 0:
+            return 0, 0
+        return int(self.frame_numbers[idx]), int(self.timestamps[idx])
+
+_key_frame_indexes = OrderedDict()
+_key_frame_indexes_lock = threading.Lock()
+MAX_KEY_FRAME_INDEXES = 128
+
+def get_key_frame_index(meta_path):
+    """Returns the key frame index of the meta file. Indexes are parsed once
+    and reloaded only when the meta file changes.
+    """
+    mtime = os.path.getmtime(meta_path)
+    with _key_frame_indexes_lock:
+        cached = _key_frame_indexes.get(meta_path)
+        if cached is not None and cached[0] == mtime:
+            _key_frame_indexes.move_to_end(meta_path)
+            return cached[1]
+
+    index = KeyFrameIndex.from_meta_file(meta_path)
+    with _key_frame_indexes_lock:
+        _key_frame_indexes[meta_path] = (mtime, index)
+        _key_frame_indexes.move_to_end(meta_path)
+        while len(_key_frame_indexes) > MAX_KEY_FRAME_INDEXES:
+            _key_frame_indexes.popitem(last=False)
+    return index
 
 class PrepareInfo(WorkWithVideo):
 
@@ -68,114 +189,154 @@ class PrepareInfo(WorkWithVideo):
             raise Exception('No meta path')
 
         self.meta_path = kwargs.get('meta_path')
-        self.key_frames = {}
+        self.key_frames = OrderedDict() # {frame number: pts}
+        self.checksums = {} # {pts: crc32 of the key frame packet}
         self.frames = 0
+        self._frame_size = None
 
     def get_task_size(self):
         return self.frames
 
     @property
     def frame_sizes(self):
+        if self._frame_size is None:
+            self._frame_size = self._read_frame_size()
+        return self._frame_size
+
+    def _read_frame_size(self):
         container = self._open_video_container(self.source_path, 'r')
-        frame = next(iter(self.key_frames.values()))
-        if container.streams.video[0].metadata.get('rotate'):
-            frame = av.VideoFrame().from_ndarray(
-                rotate_image(
-                    frame.to_ndarray(format='bgr24'),
-                    360 - int(container.streams.video[0].metadata.get('rotate'))
-                ),
-                format ='bgr24'
-            )
-        self._close_video_container(container)
-        return (frame.width, frame.height)
+        try:
+            video_stream = self._get_video_stream(container)
+            container.seek(offset=next(iter(self.key_frames.values())), stream=video_stream)
+            frame = self._decode_first_frame(container, video_stream)
+            return _get_rotated_size(frame, video_stream)
+        finally:
+            self._close_video_container(container)
 
-    def check_key_frame(self, container, video_stream, key_frame):
+    @staticmethod
+    def _decode_first_frame(container, video_stream):
         for packet in container.demux(video_stream):
             for frame in packet.decode():
-                if md5_hash(frame) != md5_hash(key_frame[1]) or frame.pts != key_frame[1].pts:
-                    self.key_frames.pop(key_frame[0])
-                return
+                return frame
 
-    def check_seek_key_frames(self):
+    @staticmethod
+    def _demux_packets(container, video_stream, count):
+        packets = []
+        for packet in container.demux(video_stream):
+            if packet.size:
+                packets.append(packet)
+                if len(packets) == count:
+                    break
+        return packets
+
+    def _check_key_frame(self, container, video_stream, pts, decode=False):
+        """Checks that reading after seeking to the key frame starts from it.
+        A known checksum of the key frame packet is checked first. The first
+        decoded frame is checked if there is no checksum, if the key frame has
+        leading frames (an open GOP), which can be decoded before it, or if
+        decode is set.
+        """
+        checksum = self.checksums.get(pts)
+        if checksum is not None:
+            container.seek(offset=pts, stream=video_stream)
+            packets = self._demux_packets(container, video_stream, LEADING_FRAMES_CHECK)
+            if not packets or packets[0].pts != pts or packet_checksum(packets[0]) != checksum:
+                return False
+            has_leading_frames = any(packet.pts is not None and packet.pts < pts
+                for packet in packets[1:])
+            if not (decode or has_leading_frames):
+                return True
+
+        container.seek(offset=pts, stream=video_stream)
+        frame = self._decode_first_frame(container, video_stream)
+        return frame is not None and frame.pts == pts
+
+    def _find_invalid_key_frames(self, key_frames, decoded_key_frames=()):
+        invalid_key_frames = []
         container = self._open_video_container(self.source_path, mode='r')
-        video_stream = self._get_video_stream(container)
-
-        key_frames_copy = self.key_frames.copy()
+        try:
+            video_stream = self._get_video_stream(container)
+            for frame_number, pts in key_frames:
+                if not self._check_key_frame(container, video_stream, pts,
+                        decode=frame_number in decoded_key_frames):
+                    invalid_key_frames.append(frame_number)
+        finally:
+            self._close_video_container(container)
+        return invalid_key_frames
+
+    def find_invalid_key_frames(self):
+        """Seeks to every key frame and checks that the reading starts from it.
+        Key frames with a known packet checksum and without leading frames are
+        checked without decoding, except the first one. Contiguous parts of the
+        video are checked in parallel.
+        """
+        key_frames = list(self.key_frames.items())
+        if not key_frames:
+            return []
+
+        workers = min(SEEK_CHECK_WORKERS, len(key_frames))
+        part_size = math.ceil(len(key_frames) / workers)
+        parts = [key_frames[i:i + part_size] for i in range(0, len(key_frames), part_size)]
+        decoded_key_frames = (key_frames[0][0],)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(itertools.chain.from_iterable(
+                pool.map(lambda part: self._find_invalid_key_frames(part, decoded_key_frames), parts)))
 
-        for key_frame in key_frames_copy.items():
-            container.seek(offset=key_frame[1].pts, stream=video_stream)
-            self.check_key_frame(container, video_stream, key_frame)
+    def check_seek_key_frames(self):
+        for frame_number in self.find_invalid_key_frames():
+            self.key_frames.pop(frame_number)
 
     def check_frames_ratio(self, chunk_size):
         return (len(self.key_frames) and (self.frames // len(self.key_frames)) <= 2 * chunk_size)
 
     def save_key_frames(self):
-        container = self._open_video_container(self.source_path, mode='r')
-        video_stream = self._get_video_stream(container)
-        frame_number = 0
-
-        for packet in  container.demux(video_stream):
-            for frame in packet.decode():
-                if frame.key_frame:
-                    self.key_frames[frame_number] = frame
-                frame_number += 1
-
-        self.frames = frame_number
-        self._close_video_container(container)
+        video_info = AnalyzeVideo(source_path=self.source_path).analyze()
+        self.frames = video_info.frames
+        self.key_frames = video_info.key_frames
+        self.checksums = video_info.checksums
+        self._frame_size = video_info.frame_size
 
     def save_meta_info(self):
         with open(self.meta_path, 'w') as meta_file:
-            for index, frame in self.key_frames.items():
-                meta_file.write('{} {}\n'.format(index, frame.pts))
+            for index, pts in self.key_frames.items():
+                meta_file.write('{} {}\n'.format(index, pts))
 
     def get_nearest_left_key_frame(self, start_chunk_frame_number):
-        start_decode_frame_number = 0
-        start_decode_timestamp = 0
-
-        with open(self.meta_path, 'r') as file:
-            for line in file:
-                frame_number, timestamp = line.strip().split(' ')
-
-                if int(frame_number) <= start_chunk_frame_number:
-                    start_decode_frame_number = frame_number
-                    start_decode_timestamp = timestamp
-                else:
-                    break
+        return get_key_frame_index(self.meta_path).get_nearest_left(start_chunk_frame_number)
 
-        return int(start_decode_frame_number), int(start_decode_timestamp)
+    def _decode_frames(self, start_frame_number, end_frame_number, step):
+        start_decode_frame_number, start_decode_timestamp = self.get_nearest_left_key_frame(start_frame_number)
+        container = self._open_video_container(self.source_path, mode='r')
+        try:
+            video_stream = self._get_video_stream(container)
+            container.seek(offset=start_decode_timestamp, stream=video_stream)
+
+            rotator = VideoRotator(video_stream)
+            frame_number = start_decode_frame_number - 1
+            for packet in container.demux(video_stream):
+                for frame in packet.decode():
+                    frame_number += 1
+                    if frame_number < start_frame_number:
+                        continue
+                    elif frame_number < end_frame_number and not ((frame_number - start_frame_number) % step):
+                        yield rotator.rotate(frame)
+                    elif (frame_number - start_frame_number) % step:
+                        continue
+                    else:
+                        return
+        finally:
+            self._close_video_container(container)
 
     def decode_needed_frames(self, chunk_number, db_data):
         step = db_data.get_frame_step()
         start_chunk_frame_number = db_data.start_frame + chunk_number * db_data.chunk_size * step
         end_chunk_frame_number = min(start_chunk_frame_number + (db_data.chunk_size - 1) * step + 1, db_data.stop_frame + 1)
-        start_decode_frame_number, start_decode_timestamp = self.get_nearest_left_key_frame(start_chunk_frame_number)
-        container = self._open_video_container(self.source_path, mode='r')
-        video_stream = self._get_video_stream(container)
-        container.seek(offset=start_decode_timestamp, stream=video_stream)
+        return self._decode_frames(start_chunk_frame_number, end_chunk_frame_number, step)
 
-        frame_number = start_decode_frame_number - 1
-        for packet in container.demux(video_stream):
-            for frame in packet.decode():
-                frame_number += 1
-                if frame_number < start_chunk_frame_number:
-                    continue
-                elif frame_number < end_chunk_frame_number and not ((frame_number - start_chunk_frame_number) % step):
-                    if video_stream.metadata.get('rotate'):
-                        frame = av.VideoFrame().from_ndarray(
-                            rotate_image(
-                                frame.to_ndarray(format='bgr24'),
-                                360 - int(container.streams.video[0].metadata.get('rotate'))
-                            ),
-                            format ='bgr24'
-                        )
-                    yield frame
-                elif (frame_number - start_chunk_frame_number) % step:
-                    continue
-                else:
-                    self._close_video_container(container)
-                    return
-
-        self._close_video_container(container)
+    def decode_frame(self, frame_number, db_data):
+        """Decodes one frame of the task starting from the nearest key frame"""
+        source_frame_number = db_data.start_frame + frame_number * db_data.get_frame_step()
+        return next(self._decode_frames(source_frame_number, source_frame_number + 1, 1))
 
 class UploadedMeta(PrepareInfo):
     def __init__(self, **kwargs):
@@ -188,44 +349,8 @@ class UploadedMeta(PrepareInfo):
             key_frames = {int(line.split()[0]): int(line.split()[1]) for line in lines}
             self.key_frames = OrderedDict(sorted(key_frames.items(), key=lambda x: x[0]))
 
-    @property
-    def frame_sizes(self):
-        container = self._open_video_container(self.source_path, 'r')
-        video_stream = self._get_video_stream(container)
-        container.seek(offset=next(iter(self.key_frames.values())), stream=video_stream)
-        for packet in container.demux(video_stream):
-            for frame in packet.decode():
-                if video_stream.metadata.get('rotate'):
-                    frame = av.VideoFrame().from_ndarray(
-                        rotate_image(
-                            frame.to_ndarray(format='bgr24'),
-                            360 - int(container.streams.video[0].metadata.get('rotate'))
-                        ),
-                        format ='bgr24'
-                    )
-                self._close_video_container(container)
-                return (frame.width, frame.height)
-
-    def save_meta_info(self):
-        with open(self.meta_path, 'w') as meta_file:
-            for index, pts in self.key_frames.items():
-                meta_file.write('{} {}\n'.format(index, pts))
-
-    def check_key_frame(self, container, video_stream, key_frame):
-        for packet in container.demux(video_stream):
-            for frame in packet.decode():
-                assert frame.pts == key_frame[1], "Uploaded meta information does not match the video"
-                return
-
     def check_seek_key_frames(self):
-        container = self._open_video_container(self.source_path, mode='r')
-        video_stream = self._get_video_stream(container)
-
-        for key_frame in self.key_frames.items():
-            container.seek(offset=key_frame[1], stream=video_stream)
-            self.check_key_frame(container, video_stream, key_frame)
-
-        self._close_video_container(container)
+        assert not self.find_invalid_key_frames(), "Uploaded meta information does not match the video"
 
     def check_frames_numbers(self):
         container = self._open_video_container(self.source_path, mode='r')
@@ -242,10 +367,6 @@ def prepare_meta(media_file, upload_dir=None, meta_dir=None, chunk_size=None):
         'source_path': os.path.join(upload_dir, media_file) if upload_dir else media_file,
         'meta_path': os.path.join(meta_dir, 'meta_info.txt') if meta_dir else os.path.join(upload_dir, 'meta_info.txt'),
     }
-    analyzer = AnalyzeVideo(source_path=paths.get('source_path'))
-    analyzer.check_type_first_frame()
-    analyzer.check_video_timestamps_sequences()
-
     meta_info = PrepareInfo(source_path=paths.get('source_path'),
                             meta_path=paths.get('meta_path'))
     meta_info.save_key_frames()
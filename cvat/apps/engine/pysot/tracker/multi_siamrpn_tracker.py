@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+import torch
+
+from cvat.apps.engine.pysot.core.config import cfg
+from cvat.apps.engine.pysot.tracker.siamrpn_tracker import SiamRPNTracker
+
+
+class MultiSiamRPNTracker(SiamRPNTracker):
+    """ SiamRPN tracker for several targets in the same video.
+        Search regions of all targets are stacked into one batch, so
+        the backbone and the RPN head run once per frame.
+    """
+    def __init__(self, model):
+        super(MultiSiamRPNTracker, self).__init__(model)
+        self.targets = []
+        self.zf = None
+
+    def add_target(self, zf, center_pos, size, channel_average):
+        """
+        args:
+            zf(torch.Tensor): template features of the target
+            center_pos(np.ndarray): center of the target
+            size(np.ndarray): width and height of the target
+            channel_average(np.ndarray): channel average of the init image
+        """
+        self.targets.append({
+            'center_pos': center_pos,
+            'size': size,
+            'channel_average': channel_average,
+        })
+        self.zf = zf if self.zf is None else torch.cat([self.zf, zf])
+
+    def track(self, img):
+        """
+        args:
+            img(np.ndarray): BGR image
+        return:
+            list of dicts with bbox(list):[x, y, width, height]
+            and best_score for every target
+        """
+        if not self.targets:
+            return []
+
+        scales = []
+        x_crops = []
+        for target in self.targets:
+            size = target['size']
+            w_z = size[0] + cfg.TRACK.CONTEXT_AMOUNT * np.sum(size)
+            h_z = size[1] + cfg.TRACK.CONTEXT_AMOUNT * np.sum(size)
+            s_z = np.sqrt(w_z * h_z)
+            scales.append(cfg.TRACK.EXEMPLAR_SIZE / s_z)
+            s_x = s_z * (cfg.TRACK.INSTANCE_SIZE / cfg.TRACK.EXEMPLAR_SIZE)
+            x_crops.append(self.get_subwindow(img, target['center_pos'],
+                                              cfg.TRACK.INSTANCE_SIZE,
+                                              round(s_x), target['channel_average']))
+
+        self.model.zf = self.zf
+        outputs = self.model.track(torch.cat(x_crops))
+
+        results = []
+        for idx, target in enumerate(self.targets):
+            self.center_pos = target['center_pos']
+            self.size = target['size']
+            results.append(self._update_state({
+                    'cls': outputs['cls'][idx:idx + 1],
+                    'loc': outputs['loc'][idx:idx + 1],
+                }, scales[idx], img.shape[:2]))
+            target['center_pos'] = self.center_pos
+            target['size'] = self.size
+        return results
@@ -107,7 +107,17 @@ class SiamRPNTracker(SiameseTracker):
                                     round(s_x), self.channel_average)
 
         outputs = self.model.track(x_crop)
+        return self._update_state(outputs, scale_z, img.shape[:2])
 
+    def _update_state(self, outputs, scale_z, boundary):
+        """
+        args:
+            outputs(dict): model outputs for the search region of the target
+            scale_z(float): scale of the search region
+            boundary(tuple): height and width of the image
+        return:
+            bbox(list):[x, y, width, height]
+        """
         score = self._convert_score(outputs['cls'])
         pred_bbox = self._convert_bbox(outputs['loc'], self.anchors)
 
@@ -145,7 +155,7 @@ class SiamRPNTracker(SiameseTracker):
 
         # clip boundary
         cx, cy, width, height = self._bbox_clip(cx, cy, width,
-                                                height, img.shape[:2])
+                                                height, boundary)
 
         # udpate state
         self.center_pos = np.array([cx, cy])
@@ -37,3 +37,6 @@ def delete_task_files_on_delete_task(instance, **kwargs):
 @receiver(post_delete, sender=Data, dispatch_uid="delete_data_files_on_delete_data")
 def delete_data_files_on_delete_data(instance, **kwargs):
     shutil.rmtree(instance.get_data_dirname(), ignore_errors=True)
+    # chunks and statistics of the data in the cache
+    from cvat.apps.engine.cache import CacheInteraction
+    CacheInteraction().remove_data(instance.id)
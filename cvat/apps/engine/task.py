@@ -3,10 +3,21 @@
 #
 # SPDX-License-Identifier: MIT
 
+import errno
+import fcntl
 import itertools
+import math
+import multiprocessing
 import os
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
 from re import findall
+import requests
+from requests.adapters import HTTPAdapter
 import rq
 import shutil
 from traceback import print_exception
@@ -14,7 +25,7 @@ from urllib import error as urlerror
 from urllib import parse as urlparse
 from urllib import request as urlrequest
 
-from cvat.apps.engine.media_extractors import get_mime, MEDIA_TYPES, Mpeg4ChunkWriter, ZipChunkWriter, Mpeg4CompressedChunkWriter, ZipCompressedChunkWriter
+from cvat.apps.engine.media_extractors import get_mime, MEDIA_TYPES, ManifestChunkWriter, Mpeg4ChunkWriter, ZipChunkWriter, Mpeg4CompressedChunkWriter, ZipCompressedChunkWriter
 from cvat.apps.engine.models import DataChoice, StorageMethodChoice
 from cvat.apps.engine.utils import av_scan_paths
 from cvat.apps.engine.prepare import prepare_meta
@@ -22,7 +33,6 @@ from cvat.apps.engine.prepare import prepare_meta
 import django_rq
 from django.conf import settings
 from django.db import transaction
-from distutils.dir_util import copy_tree
 
 from . import models
 from .log import slogger
@@ -50,21 +60,96 @@ def rq_handler(job, exc_type, exc_value, traceback):
 
 ############################# Internal implementation for server API
 
+FICLONE = 0x40049409
+SHARE_COPY_WORKERS = 8
+
+def _reflink_file(source_path, target_path):
+    """Clones the file on filesystems with copy-on-write support (Btrfs, XFS)"""
+    try:
+        with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except OSError:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        raise
+
+# Ways to put share files into the upload directory, which are tried in order
+SHARE_INGESTION_METHODS = {
+    'copy': [shutil.copyfile],
+    'link': [os.link, _reflink_file, shutil.copyfile],
+    'symlink': [os.link, _reflink_file, os.symlink],
+}
+
+# Errors which mean that the method is not supported for the share at all
+UNSUPPORTED_METHOD_ERRORS = {errno.EXDEV, errno.EPERM, errno.EACCES,
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EROFS}
+
+def _ingest_share_file(source_path, target_path, methods, unsupported_methods):
+    if os.path.lexists(target_path):
+        os.remove(target_path)
+    for method in methods[:-1]:
+        if method in unsupported_methods:
+            continue
+        try:
+            method(source_path, target_path)
+            return
+        except OSError as err:
+            if err.errno in UNSUPPORTED_METHOD_ERRORS:
+                unsupported_methods.add(method)
+    methods[-1](source_path, target_path)
+
+def _walk_share_dir(path):
+    """Walks the directory following directory links. Every directory is
+    walked once, so that links to parent directories don't make loops.
+    """
+    visited = set()
+    for root, dirs, names in os.walk(path, followlinks=True):
+        root_stat = os.stat(root)
+        visited.add((root_stat.st_dev, root_stat.st_ino))
+        unvisited_dirs = []
+        for name in dirs:
+            dir_stat = os.stat(os.path.join(root, name))
+            if (dir_stat.st_dev, dir_stat.st_ino) not in visited:
+                unvisited_dirs.append(name)
+        dirs[:] = unvisited_dirs
+        yield root, names
+
 def _copy_data_from_share(server_files, upload_dir):
     job = rq.get_current_job()
     job.meta['status'] = 'Data are being copied from share..'
     job.save_meta()
 
+    files = []
+    target_dirs = set()
     for path in server_files:
         source_path = os.path.join(settings.SHARE_ROOT, os.path.normpath(path))
         target_path = os.path.join(upload_dir, path)
         if os.path.isdir(source_path):
-            copy_tree(source_path, target_path)
+            # directories are created and only files are linked, so that
+            # nothing is extracted or written into the share
+            for root, names in _walk_share_dir(source_path):
+                target_root = os.path.normpath(os.path.join(target_path, os.path.relpath(root, source_path)))
+                target_dirs.add(target_root)
+                files.extend((os.path.join(root, name), os.path.join(target_root, name))
+                    for name in names)
         else:
-            target_dir = os.path.dirname(target_path)
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir)
-            shutil.copyfile(source_path, target_path)
+            target_dirs.add(os.path.dirname(target_path))
+            files.append((source_path, target_path))
+
+    for target_dir in target_dirs:
+        os.makedirs(target_dir, exist_ok=True)
+
+    mode = settings.SHARE_INGESTION_MODE
+    if mode == 'symlink' and settings.ORIGINAL_CHUNK_PASSTHROUGH:
+        # original chunks would be manifests of files outside of the data
+        # directory, they are copied if they cannot be linked
+        slogger.glob.warning('Share files are not linked with symbolic links '
+            'when original chunks are manifests of the source images')
+        mode = 'link'
+    methods = SHARE_INGESTION_METHODS[mode]
+    unsupported_methods = set()
+    with ThreadPoolExecutor(max_workers=SHARE_COPY_WORKERS) as pool:
+        list(pool.map(lambda paths: _ingest_share_file(*paths, methods, unsupported_methods), files))
 
 def _save_task_to_db(db_task):
     job = rq.get_current_job()
@@ -183,6 +268,104 @@ def _validate_data(counter, meta_info_file=None):
 
     return counter, task_modes[0]
 
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+
+class _DownloadProgress:
+    def __init__(self, urls):
+        self._lock = threading.Lock()
+        self._downloaded = {}
+        self._sizes = {}
+        self._finished = 0
+        self._total = len(urls)
+
+    def start(self, url, size):
+        with self._lock:
+            self._sizes[url] = size
+            self._downloaded.setdefault(url, 0)
+
+    def update(self, url, downloaded):
+        with self._lock:
+            self._downloaded[url] = downloaded
+
+    def finish(self, url):
+        with self._lock:
+            self._downloaded.pop(url, None)
+            self._sizes.pop(url, None)
+            self._finished += 1
+
+    def get_status(self):
+        with self._lock:
+            files = ['{} ({})'.format(url, '{}%'.format(100 * downloaded // self._sizes[url]) \
+                    if self._sizes.get(url) else '{} KB'.format(downloaded // 1024))
+                for url, downloaded in self._downloaded.items()]
+        status = '{} of {} files are downloaded.'.format(self._finished, self._total)
+        if files:
+            status += ' {} {} being downloaded..'.format(', '.join(files),
+                'are' if len(files) > 1 else 'is')
+        return status
+
+def _download_file(session, url, path, progress):
+    if urlparse.urlparse(url).scheme.lower() in ('http', 'https'):
+        _download_http_file(session, url, path, progress)
+    else:
+        # requests supports only HTTP, other schemes (e.g. ftp) are downloaded by urllib
+        _download_urllib_file(url, path, progress)
+    progress.finish(url)
+
+def _download_urllib_file(url, path, progress):
+    req = urlrequest.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+    try:
+        with urlrequest.urlopen(req) as fp, open(path, 'wb') as tfp:
+            progress.start(url, None)
+            downloaded = 0
+            while True:
+                block = fp.read(DOWNLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                tfp.write(block)
+                downloaded += len(block)
+                progress.update(url, downloaded)
+    except urlerror.HTTPError as err:
+        raise Exception("Failed to download " + url + ". " + str(err.code) + ' - ' + err.reason)
+    except urlerror.URLError as err:
+        raise Exception("Invalid URL: " + url + ". " + str(err.reason))
+
+def _download_http_file(session, url, path, progress):
+    """Downloads the file and resumes the download with Range requests after failures"""
+    downloaded = 0
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        headers = {'Range': 'bytes={}-'.format(downloaded)} if downloaded else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # the server does not support ranges, start from the beginning
+                    downloaded = 0
+                size = response.headers.get('Content-Length')
+                progress.start(url, downloaded + int(size) if size else None)
+                with open(path, 'r+b' if downloaded else 'wb') as tfp:
+                    tfp.seek(downloaded)
+                    tfp.truncate()
+                    for block in response.iter_content(chunk_size=DOWNLOAD_BLOCK_SIZE):
+                        tfp.write(block)
+                        downloaded += len(block)
+                        progress.update(url, downloaded)
+            break
+        except requests.HTTPError as err:
+            if err.response.status_code < 500 or attempt == DOWNLOAD_RETRIES:
+                raise Exception("Failed to download " + url + ". " +
+                    str(err.response.status_code) + ' - ' + err.response.reason)
+        except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema,
+                requests.exceptions.InvalidURL) as err:
+            raise Exception("Invalid URL: " + url + ". " + str(err))
+        except requests.RequestException as err:
+            if attempt == DOWNLOAD_RETRIES:
+                raise Exception("Failed to download " + url + ". " + str(err))
+        slogger.glob.warning("Downloading of {} is interrupted, {} bytes are received. Retrying..".format(
+            url, downloaded))
+        time.sleep(2 ** attempt)
+
 def _download_data(urls, upload_dir):
     job = rq.get_current_job()
     local_files = {}
@@ -190,24 +373,32 @@ def _download_data(urls, upload_dir):
         name = os.path.basename(urlrequest.url2pathname(urlparse.urlparse(url).path))
         if name in local_files:
             raise Exception("filename collision: {}".format(name))
-        slogger.glob.info("Downloading: {}".format(url))
-        job.meta['status'] = '{} is being downloaded..'.format(url)
-        job.save_meta()
-
-        req = urlrequest.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+        local_files[name] = url
+
+    progress = _DownloadProgress(urls)
+    workers = max(1, min(settings.DOWNLOAD_WORKERS, len(urls)))
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = 'Mozilla/5.0'
+
+        pending = set()
+        for name, url in local_files.items():
+            slogger.glob.info("Downloading: {}".format(url))
+            pending.add(pool.submit(_download_file, session, url,
+                os.path.join(upload_dir, name), progress))
         try:
-            with urlrequest.urlopen(req) as fp, open(os.path.join(upload_dir, name), 'wb') as tfp:
-                while True:
-                    block = fp.read(8192)
-                    if not block:
-                        break
-                    tfp.write(block)
-        except urlerror.HTTPError as err:
-            raise Exception("Failed to download " + url + ". " + str(err.code) + ' - ' + err.reason)
-        except urlerror.URLError as err:
-            raise Exception("Invalid URL: " + url + ". " + err.reason)
-
-        local_files[name] = True
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                job.meta['status'] = progress.get_status()
+                job.save_meta()
+        finally:
+            for future in pending:
+                future.cancel()
+
     return list(local_files.keys())
 
 @transaction.atomic
@@ -274,10 +465,18 @@ def _create_thread(tid, data):
         update_progress.call_counter = (update_progress.call_counter + 1) % len(progress_animation)
 
     compressed_chunk_writer_class = Mpeg4CompressedChunkWriter if db_data.compressed_chunk_type == DataChoice.VIDEO else ZipCompressedChunkWriter
-    original_chunk_writer_class = Mpeg4ChunkWriter if db_data.original_chunk_type == DataChoice.VIDEO else ZipChunkWriter
+    if db_data.original_chunk_type == DataChoice.VIDEO:
+        original_chunk_writer_class = Mpeg4ChunkWriter
+    elif settings.ORIGINAL_CHUNK_PASSTHROUGH and db_data.storage_method == StorageMethodChoice.FILE_SYSTEM:
+        original_chunk_writer_class = partial(ManifestChunkWriter, upload_dir=upload_dir)
+    else:
+        original_chunk_writer_class = ZipChunkWriter
 
-    compressed_chunk_writer = compressed_chunk_writer_class(db_data.image_quality)
-    original_chunk_writer = original_chunk_writer_class(100)
+    compressed_chunk_writer = compressed_chunk_writer_class(db_data.image_quality,
+        settings.VIDEO_CHUNK_ENCODING['COMPRESSED'] \
+            if db_data.compressed_chunk_type == DataChoice.VIDEO else settings.IMAGE_CHUNK_ENCODING)
+    original_chunk_writer = original_chunk_writer_class(100,
+        settings.VIDEO_CHUNK_ENCODING['ORIGINAL'])
 
     # calculate chunk size if it isn't specified
     if db_data.chunk_size is None:
@@ -348,14 +547,17 @@ def _create_thread(tid, data):
             else:#images,archive
                 db_data.size = len(extractor)
 
+                job.meta['status'] = 'Sizes of images are being read...'
+                job.save_meta()
+                img_sizes = iter(extractor.get_image_sizes(extractor.frame_range,
+                    workers=settings.IMAGE_SIZE_WORKERS))
+
                 counter = itertools.count()
                 for chunk_number, chunk_frames in itertools.groupby(extractor.frame_range, lambda x: next(counter) // db_data.chunk_size):
                     chunk_paths = [(extractor.get_path(i), i) for i in chunk_frames]
-                    img_sizes = []
                     with open(db_data.get_dummy_chunk_path(chunk_number), 'w') as dummy_chunk:
-                        for path, frame_id in chunk_paths:
+                        for path, _ in chunk_paths:
                             dummy_chunk.write(path + '\n')
-                            img_sizes.append(extractor.get_image_size(frame_id))
 
                     db_images.extend([
                         models.Image(data=db_data,
@@ -367,14 +569,10 @@ def _create_thread(tid, data):
     if db_data.storage_method == StorageMethodChoice.FILE_SYSTEM or not settings.USE_CACHE:
         counter = itertools.count()
         generator = itertools.groupby(extractor, lambda x: next(counter) // db_data.chunk_size)
-        for chunk_idx, chunk_data in generator:
-            chunk_data = list(chunk_data)
-            original_chunk_path = db_data.get_original_chunk_path(chunk_idx)
-            original_chunk_writer.save_as_chunk(chunk_data, original_chunk_path)
-
-            compressed_chunk_path = db_data.get_compressed_chunk_path(chunk_idx)
-            img_sizes = compressed_chunk_writer.save_as_chunk(chunk_data, compressed_chunk_path)
+        chunks = ((chunk_idx, list(chunk_data)) for chunk_idx, chunk_data in generator)
 
+        def save_chunk_info(chunk_data, img_sizes):
+            nonlocal video_size, video_path
             if db_task.mode == 'annotation':
                 db_images.extend([
                     models.Image(
@@ -394,6 +592,52 @@ def _create_thread(tid, data):
             progress = extractor.get_progress(chunk_data[-1][2])
             update_progress(progress)
 
+        # Chunks can be written in any order, but their information is saved in order
+        def write_chunks(original_pool, compressed_pool, max_pending):
+            def save_next_chunk(pending):
+                chunk_data, original_chunk, compressed_chunk = pending.popleft()
+                original_chunk.result()
+                save_chunk_info(chunk_data, compressed_chunk.result())
+
+            pending = deque()
+            for chunk_idx, chunk_data in chunks:
+                pending.append((chunk_data,
+                    original_pool.submit(original_chunk_writer.save_as_chunk,
+                        chunk_data, db_data.get_original_chunk_path(chunk_idx)),
+                    compressed_pool.submit(compressed_chunk_writer.save_as_chunk,
+                        chunk_data, db_data.get_compressed_chunk_path(chunk_idx)),
+                ))
+                # limit the number of chunks in memory
+                while len(pending) > max_pending:
+                    save_next_chunk(pending)
+            while pending:
+                save_next_chunk(pending)
+
+        # Video frames cannot be passed to other processes, so only images
+        # are compressed in parallel by processes
+        # Every spawned process imports the engine again, so no more processes
+        # are started than there are chunks
+        chunk_workers = min(settings.CHUNK_WORKERS, math.ceil(len(extractor) / db_data.chunk_size))
+        if db_task.mode == 'annotation' and chunk_workers > 1:
+            # spawned processes don't inherit the database connection of the worker
+            with ProcessPoolExecutor(max_workers=chunk_workers,
+                    mp_context=multiprocessing.get_context('spawn')) as pool:
+                write_chunks(pool, pool, 2 * chunk_workers)
+        elif db_task.mode == 'interpolation':
+            # The video is decoded by this thread, while the previous chunk is
+            # encoded by the writer thread. Both writers get the same decoded
+            # frames, so original and compressed chunks are encoded one by one.
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                write_chunks(pool, pool, 1)
+        else:
+            for chunk_idx, chunk_data in chunks:
+                original_chunk_path = db_data.get_original_chunk_path(chunk_idx)
+                original_chunk_writer.save_as_chunk(chunk_data, original_chunk_path)
+
+                compressed_chunk_path = db_data.get_compressed_chunk_path(chunk_idx)
+                img_sizes = compressed_chunk_writer.save_as_chunk(chunk_data, compressed_chunk_path)
+                save_chunk_info(chunk_data, img_sizes)
+
     if db_task.mode == 'annotation':
         models.Image.objects.bulk_create(db_images)
         db_images = []
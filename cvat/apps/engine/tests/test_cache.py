@@ -0,0 +1,132 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO
+from unittest import TestCase, mock
+
+from django.test import override_settings
+
+from cvat.apps.engine import cache
+from cvat.apps.engine.cache import CacheInteraction
+
+
+class _Data:
+    id = 1
+    size = 50
+    chunk_size = 10
+
+def _run_now(target, *args):
+    target(*args)
+
+class ChunkSingleFlightTest(TestCase):
+    def setUp(self):
+        self._cache_root = tempfile.mkdtemp()
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self._cache_root)
+
+    def _prepare_chunk_buff(self, db_data, quality, chunk_number):
+        self.builds += 1
+        time.sleep(0.5)
+        return BytesIO(b'chunk'), 'application/zip'
+
+    def _get_chunks(self, count):
+        chunks = []
+        def get_chunk():
+            chunk_path, _ = CacheInteraction().get_chunk_path_mime(0, 'compressed', _Data())
+            with open(chunk_path, 'rb') as chunk:
+                chunks.append(chunk.read())
+
+        threads = [threading.Thread(target=get_chunk) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return chunks
+
+    def test_chunk_is_built_once(self):
+        with override_settings(CACHE_ROOT=self._cache_root), \
+                mock.patch.object(CacheInteraction, 'prepare_chunk_buff', self._prepare_chunk_buff):
+            chunks = self._get_chunks(4)
+
+        self.assertEqual(chunks, [b'chunk'] * 4)
+        self.assertEqual(self.builds, 1)
+
+    def test_chunk_is_built_if_lock_is_not_released(self):
+        with override_settings(CACHE_ROOT=self._cache_root), \
+                mock.patch.object(CacheInteraction, 'prepare_chunk_buff', self._prepare_chunk_buff), \
+                mock.patch.object(cache, 'CHUNK_LOCK_TIMEOUT', 1):
+            # a lock of a dead worker
+            CacheInteraction()._cache.add('1_0_compressed_lock', 0, expire=60)
+            chunks = self._get_chunks(1)
+
+        self.assertEqual(chunks, [b'chunk'])
+        self.assertEqual(self.builds, 1)
+
+    def test_task_quota(self):
+        quota = {'COMPRESSED': 12, 'ORIGINAL': 12}
+        with override_settings(CACHE_ROOT=self._cache_root, CHUNK_CACHE_TASK_QUOTA=quota), \
+                mock.patch.object(CacheInteraction, 'prepare_chunk_buff', self._prepare_chunk_buff), \
+                mock.patch.object(cache, 'CHUNK_PIN_TIMEOUT', 0.1), \
+                mock.patch.object(cache, '_run_in_background', _run_now):
+            # chunks are built longer than they are pinned
+            cache_interaction = CacheInteraction()
+            for chunk_number in range(3):
+                cache_interaction.get_chunk_path_mime(chunk_number, 'compressed', _Data())
+
+            # the chunk which is the farthest from the requested one is evicted
+            self.assertEqual([cache_interaction.is_cached(chunk_number, 'compressed', _Data.id)
+                for chunk_number in range(3)], [False, True, True])
+            stats = cache_interaction.get_stats()['disk']['data'][_Data.id]
+            self.assertEqual(stats['size']['COMPRESSED'], 10)
+            self.assertEqual((stats['misses'], stats['evictions']), (3, 1))
+
+    def test_chunk_built_twice_is_counted_once(self):
+        with override_settings(CACHE_ROOT=self._cache_root), \
+                mock.patch.object(CacheInteraction, 'prepare_chunk_buff', self._prepare_chunk_buff):
+            cache_interaction = CacheInteraction()
+            # two workers build the chunk after the lock of a dead worker expired
+            for _ in range(2):
+                cache_interaction._build_chunk('1_0_compressed', 0, 'compressed', _Data())
+
+            stats = cache_interaction.get_stats()['disk']
+            self.assertEqual(stats['size'], 5)
+            self.assertEqual(stats['data'][_Data.id]['size']['COMPRESSED'], 5)
+
+    def test_data_is_removed(self):
+        with override_settings(CACHE_ROOT=self._cache_root), \
+                mock.patch.object(CacheInteraction, 'prepare_chunk_buff', self._prepare_chunk_buff):
+            cache_interaction = CacheInteraction()
+            chunk_path, _ = cache_interaction.get_chunk_path_mime(0, 'compressed', _Data())
+            cache_interaction.remove_data(_Data.id)
+
+            self.assertFalse(cache_interaction.is_cached(0, 'compressed', _Data.id))
+            self.assertFalse(os.path.exists(chunk_path))
+            stats = cache_interaction.get_stats()['disk']
+            self.assertEqual((stats['size'], stats['data']), (0, {}))
+
+    def test_pinned_chunk_is_not_evicted(self):
+        quota = {'COMPRESSED': 12, 'ORIGINAL': 12}
+        with override_settings(CACHE_ROOT=self._cache_root, CHUNK_CACHE_TASK_QUOTA=quota), \
+                mock.patch.object(CacheInteraction, 'prepare_chunk_buff', self._prepare_chunk_buff), \
+                mock.patch.object(cache, '_run_in_background', _run_now):
+            cache_interaction = CacheInteraction()
+            for chunk_number in range(3):
+                cache_interaction.get_chunk_path_mime(chunk_number, 'compressed', _Data())
+
+            # the path of the first chunk can still be sent by the web server
+            self.assertTrue(cache_interaction.is_cached(0, 'compressed', _Data.id))
+
+    def test_chunk_is_sought_once(self):
+        with override_settings(CACHE_ROOT=self._cache_root):
+            self.assertTrue(CacheInteraction().mark_sought(0, 'original', _Data.id))
+            # the next request builds the chunk, even in another worker
+            self.assertFalse(CacheInteraction().mark_sought(0, 'original', _Data.id))
+            self.assertTrue(CacheInteraction().mark_sought(1, 'original', _Data.id))
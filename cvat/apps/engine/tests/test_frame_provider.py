@@ -0,0 +1,182 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import zipfile
+from io import BytesIO
+from unittest import TestCase, mock
+
+import numpy as np
+from PIL import Image
+
+from cvat.apps.engine import frame_provider
+from cvat.apps.engine.frame_provider import FrameCache, FrameProvider, _read_ahead
+from cvat.apps.engine.media_extractors import ManifestChunkWriter, stream_zip_chunk
+from cvat.apps.engine.models import DataChoice, StorageMethodChoice
+
+
+class _ChunkedData:
+    def __init__(self, root, size, chunk_size):
+        self.id = id(self) # a unique key in the frame cache
+        self.size = size
+        self.chunk_size = chunk_size
+        self.storage_method = StorageMethodChoice.FILE_SYSTEM
+        self.compressed_chunk_type = DataChoice.IMAGESET
+        self.original_chunk_type = DataChoice.IMAGESET
+        self._root = root
+
+        for chunk_number in range(0, (size - 1) // chunk_size + 1):
+            with zipfile.ZipFile(self.get_compressed_chunk_path(chunk_number), 'w') as zip_chunk:
+                for frame in range(chunk_number * chunk_size, min(size, (chunk_number + 1) * chunk_size)):
+                    buf = BytesIO()
+                    # the frame number is encoded in the pixel values
+                    Image.new('L', (16, 8), color=frame).save(buf, format='png')
+                    zip_chunk.writestr('{:06d}.png'.format(frame), buf.getvalue())
+
+    def get_compressed_chunk_path(self, chunk_number):
+        return os.path.join(self._root, '{}.zip'.format(chunk_number))
+
+    def get_original_chunk_path(self, chunk_number):
+        return self.get_compressed_chunk_path(chunk_number)
+
+class _PassthroughData(_ChunkedData):
+    def __init__(self, root, size, chunk_size):
+        super().__init__(root, size, chunk_size)
+        upload_dir = os.path.join(root, 'raw')
+        os.makedirs(upload_dir)
+        self.images = []
+        for frame in range(size):
+            path = os.path.join(upload_dir, '{:06d}.png'.format(frame))
+            Image.new('L', (16, 8), color=frame).save(path)
+            self.images.append(path)
+
+        writer = ManifestChunkWriter(100)
+        for chunk_number in range(0, (size - 1) // chunk_size + 1):
+            writer.save_as_chunk([(path, path, None) for path in
+                self.images[chunk_number * chunk_size:(chunk_number + 1) * chunk_size]],
+                self.get_original_chunk_path(chunk_number))
+
+    def get_original_chunk_path(self, chunk_number):
+        return os.path.join(self._root, 'original_{}.zip'.format(chunk_number))
+
+class FrameRangeTest(TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self.provider = FrameProvider(_ChunkedData(self._root, size=23, chunk_size=5))
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _read(self, *args, **kwargs):
+        return [(frame_number, int(frame[0, 0, 0]))
+            for frame_number, frame in self.provider.get_frame_range(*args,
+                out_type=FrameProvider.Type.NUMPY_ARRAY, **kwargs)]
+
+    def test_frame_range(self):
+        for start, end, step in [(0, 22, 1), (3, 17, 2), (4, 5, 1), (2, 22, 7), (6, 6, 1)]:
+            expected = [(frame, frame) for frame in range(start, end + 1, step)]
+            self.assertEqual(self._read(start, end, step=step), expected)
+            self.assertEqual(self._read(start, end, step=step, prefetch=2), expected)
+
+    def test_frame_range_is_clipped_to_task_size(self):
+        self.assertEqual(self._read(20, 40, step=2), [(20, 20), (22, 22)])
+        self.assertEqual(len(self.provider.get_frames_improved(20, 40,
+            out_type=FrameProvider.Type.NUMPY_ARRAY, skip=2)), 2)
+
+    def test_frame_range_beyond_last_frame_is_empty(self):
+        self.assertEqual(self._read(23, 30), [])
+        self.assertEqual(self._read(40, 45, step=2, prefetch=2), [])
+        self.assertEqual(self.provider.get_frames_improved(23, 30,
+            out_type=FrameProvider.Type.NUMPY_ARRAY), [])
+        with self.assertRaises(Exception):
+            self._read(-1, 5)
+
+    def test_frames_are_decoded_to_bgr(self):
+        _, frame = next(self.provider.get_frame_range(7, 7,
+            out_type=FrameProvider.Type.NUMPY_ARRAY))
+        self.assertEqual(frame.shape, (8, 16, 3))
+        self.assertTrue((frame == 7).all())
+
+        _, frame = next(self.provider.get_frame_range(7, 7,
+            out_type=FrameProvider.Type.NUMPY_ARRAY, downscale=4))
+        self.assertEqual(frame.shape, (2, 4, 3))
+
+    def test_compressed_frames_are_cached(self):
+        with mock.patch.object(frame_provider, 'frame_cache', FrameCache(size_limit=2**20)) as cache:
+            for _ in range(2):
+                frame, _ = self.provider.get_frame(7, FrameProvider.Quality.COMPRESSED,
+                    FrameProvider.Type.NUMPY_ARRAY)
+            self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+            self.provider.get_frame(7, FrameProvider.Quality.ORIGINAL, FrameProvider.Type.NUMPY_ARRAY)
+            self.provider.get_frame(7, FrameProvider.Quality.COMPRESSED, FrameProvider.Type.PIL)
+            self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+        self.assertEqual(frame.shape, (8, 16, 3))
+
+    def test_pil_frames_keep_image_mode(self):
+        for quality in [FrameProvider.Quality.COMPRESSED, FrameProvider.Quality.ORIGINAL]:
+            image, _ = self.provider.get_frame(7, quality, FrameProvider.Type.PIL)
+            self.assertEqual((image.mode, image.getpixel((0, 0))), ('L', 7))
+
+    def test_read_ahead_propagates_errors(self):
+        def frames():
+            yield 0
+            raise ValueError('cannot decode')
+
+        with self.assertRaises(ValueError):
+            list(_read_ahead(frames(), 1))
+
+class PassthroughChunkTest(TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self.data = _PassthroughData(self._root, size=12, chunk_size=5)
+        self.provider = FrameProvider(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_frames_are_read_from_source_images(self):
+        self.assertFalse(os.path.exists(self.data.get_original_chunk_path(0)))
+        frames = [int(frame[0, 0, 0]) for _, frame in self.provider.get_frame_range(0, 11,
+            FrameProvider.Quality.ORIGINAL, FrameProvider.Type.NUMPY_ARRAY)]
+        self.assertEqual(frames, list(range(12)))
+        self.assertEqual(self.provider.get_passthrough_frame(7), self.data.images[7])
+        self.assertIsNone(self.provider.get_passthrough_frame(7, FrameProvider.Quality.COMPRESSED))
+
+    def test_chunk_is_streamed_as_zip(self):
+        chunk = BytesIO(b''.join(stream_zip_chunk(self.provider.get_passthrough_chunk(2))))
+        with zipfile.ZipFile(chunk) as zip_chunk:
+            self.assertEqual(zip_chunk.namelist(), ['000000.png', '000001.png'])
+            with open(self.data.images[11], 'rb') as image:
+                self.assertEqual(zip_chunk.read('000001.png'), image.read())
+
+class FrameCacheTest(TestCase):
+    def test_least_recently_used_frames_are_evicted(self):
+        cache = FrameCache(size_limit=250)
+        for frame in range(3):
+            cache.put(frame, np.full((10, 10), frame, dtype=np.uint8), 'image/png')
+        cache.get(1)
+        cache.put(3, np.zeros((10, 10), dtype=np.uint8), 'image/png')
+
+        self.assertIsNone(cache.get(0))
+        self.assertIsNotNone(cache.get(1))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['size'], 200)
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    def test_cached_frames_are_not_shared(self):
+        cache = FrameCache(size_limit=1000)
+        frame = np.zeros((10, 10), dtype=np.uint8)
+        cache.put(0, frame, 'image/png')
+        frame[:] = 1
+        cached, _ = cache.get(0)
+        cached[:] = 2
+
+        self.assertEqual(cache.get(0)[0].max(), 0)
+
+        cache.put(1, BytesIO(b'data'), 'image/png')
+        self.assertEqual(cache.get(1)[0].read(), b'data')
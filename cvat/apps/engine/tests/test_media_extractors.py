@@ -0,0 +1,201 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import zipfile
+from io import BytesIO
+from unittest import TestCase
+
+import av
+import numpy as np
+from PIL import Image
+
+from cvat.apps.engine.media_extractors import (ImageListReader,
+    ManifestChunkWriter, Mpeg4ChunkWriter, Mpeg4CompressedChunkWriter,
+    VideoReader, ZipCompressedChunkWriter, ZipReader,
+    get_image_size_from_header, get_manifest_path, get_rotated_size,
+    read_manifest)
+
+
+class ImageSizeTest(TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self.images = []
+        for i, (image_format, extension) in enumerate([('jpeg', 'jpg'), ('png', 'png'), ('bmp', 'bmp')] * 3):
+            path = os.path.join(self._root, '{:02d}.{}'.format(i, extension))
+            size = (10 + i, 20 + 2 * i)
+            Image.new('RGB', size).save(path, format=image_format, progressive=(i % 2 == 0))
+            self.images.append((path, size))
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_size_is_read_from_header(self):
+        for path, size in self.images:
+            with open(path, 'rb') as image_file:
+                header_size = get_image_size_from_header(image_file)
+            self.assertEqual(header_size, None if path.endswith('.bmp') else size)
+
+    def test_image_sizes_are_ordered(self):
+        expected = [size for _, size in self.images]
+        reader = ImageListReader([path for path, _ in self.images])
+        for workers in [1, 4]:
+            self.assertEqual(reader.get_image_sizes(reader.frame_range, workers), expected)
+
+        archive_path = os.path.join(self._root, 'images.zip')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            for path, _ in self.images:
+                archive.write(path, os.path.basename(path))
+        reader = ZipReader([archive_path])
+        self.assertEqual(reader.get_image_sizes(reader.frame_range, 4), expected)
+
+class VideoRotationTest(TestCase):
+    def setUp(self):
+        fd, self.video_path = tempfile.mkstemp(suffix='.mp4')
+        os.close(fd)
+        container = av.open(self.video_path, mode='w')
+        stream = container.add_stream('mpeg4', rate=25)
+        stream.width, stream.height = 64, 32
+        stream.pix_fmt = 'yuv420p'
+        stream.metadata['rotate'] = '90'
+        # the left half of the frames is white
+        image = np.zeros((32, 64, 3), dtype=np.uint8)
+        image[:, :32] = 255
+        for _ in range(5):
+            for packet in stream.encode(av.VideoFrame.from_ndarray(image, format='rgb24')):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+
+    def tearDown(self):
+        os.remove(self.video_path)
+
+    def test_frames_are_rotated(self):
+        frames = [(frame, pts) for frame, _, pts in VideoReader([self.video_path])]
+
+        self.assertEqual(len(frames), 5)
+        for frame, pts in frames:
+            self.assertEqual(frame.pts, pts)
+            image = frame.to_ndarray(format='gray')
+            self.assertEqual(image.shape, (64, 32))
+            # after the clockwise rotation the white half is on the top
+            self.assertGreater(image[:24].mean(), 200)
+            self.assertLess(image[40:].mean(), 50)
+
+    def test_rotated_size(self):
+        self.assertEqual(get_rotated_size(64, 32, 90), (32, 64))
+        self.assertEqual(get_rotated_size(64, 32, 180), (64, 32))
+
+class ChunkEncodingTest(TestCase):
+    def test_encoding_options(self):
+        self.assertEqual(Mpeg4ChunkWriter(100)._get_encoding_options(36),
+            {'threads': '1', 'preset': 'ultrafast'})
+        self.assertEqual(Mpeg4CompressedChunkWriter(50)._get_encoding_options(36),
+            {'threads': '1'})
+
+        writer = Mpeg4CompressedChunkWriter(50, {'preset': 'veryfast', 'threads': 4,
+            'tune': 'fastdecode', 'gop': 'chunk'})
+        self.assertEqual(writer._get_encoding_options(36), {'threads': '4',
+            'preset': 'veryfast', 'tune': 'fastdecode', 'g': '36'})
+
+    def test_chunk_is_encoded(self):
+        frames = [av.VideoFrame.from_ndarray(np.full((32, 64, 3), i * 10, dtype=np.uint8),
+            format='rgb24') for i in range(10)]
+        for writer in [Mpeg4ChunkWriter(100, {'gop': 'chunk', 'threads': 2}),
+                Mpeg4CompressedChunkWriter(50, {'preset': 'veryfast', 'gop': '5'})]:
+            buff = BytesIO()
+            writer.save_as_chunk([(frame, None, None) for frame in frames], buff)
+            buff.seek(0)
+            with av.open(buff) as container:
+                self.assertEqual(len(list(container.decode(video=0))), 10)
+
+    def test_odd_sizes_are_rounded_up(self):
+        frames = [av.VideoFrame.from_ndarray(np.zeros((33, 65, 3), dtype=np.uint8),
+            format='rgb24') for _ in range(3)]
+        for writer in [Mpeg4ChunkWriter(100), Mpeg4CompressedChunkWriter(50)]:
+            buff = BytesIO()
+            sizes = writer.save_as_chunk([(frame, None, None) for frame in frames], buff)
+            self.assertEqual(sizes, [(65, 33)])
+            buff.seek(0)
+            with av.open(buff) as container:
+                frame = next(container.decode(video=0))
+                self.assertEqual((frame.width, frame.height), (66, 34))
+
+class ManifestChunkTest(TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self.upload_dir = os.path.join(self._root, 'raw')
+        os.makedirs(os.path.join(self.upload_dir, 'images'))
+        self.names = [os.path.join('images', '{}.png'.format(i)) for i in range(3)]
+        for name in self.names:
+            Image.new('RGB', (8, 4)).save(os.path.join(self.upload_dir, name))
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _save(self, writer):
+        chunk_path = os.path.join(self._root, '0.zip')
+        writer.save_as_chunk([(os.path.join(self.upload_dir, name), name, i)
+            for i, name in enumerate(self.names)], chunk_path)
+        return chunk_path
+
+    def test_relative_paths_are_resolved_against_upload_dir(self):
+        chunk_path = self._save(ManifestChunkWriter(100, upload_dir=self.upload_dir))
+        self.assertFalse(os.path.exists(chunk_path))
+        self.assertEqual([entry.path for entry in read_manifest(get_manifest_path(chunk_path))],
+            [os.path.join(self.upload_dir, name) for name in self.names])
+
+    def test_relative_paths_without_upload_dir_are_zipped(self):
+        chunk_path = self._save(ManifestChunkWriter(100))
+        self.assertFalse(os.path.exists(get_manifest_path(chunk_path)))
+        with zipfile.ZipFile(chunk_path) as zip_chunk:
+            self.assertEqual(len(zip_chunk.namelist()), 3)
+
+class CompressedChunkTest(TestCase):
+    def _compress(self, image, **kwargs):
+        buf = BytesIO()
+        image.save(buf, format='png')
+        width, height, jpeg = ZipCompressedChunkWriter._compress_image(buf, 90, **kwargs)
+        return (width, height), Image.open(jpeg)
+
+    def test_images_are_compressed(self):
+        color = Image.new('RGB', (40, 30), color=(200, 100, 50))
+        for image in [color, color.convert('RGBA'), color.convert('L')]:
+            size, jpeg = self._compress(image)
+            self.assertEqual(size, (40, 30))
+            self.assertEqual(jpeg.format, 'JPEG')
+            self.assertEqual(jpeg.mode, 'RGB')
+            self.assertEqual(jpeg.size, (40, 30))
+            difference = np.array(jpeg.convert('RGB'), dtype=int) - np.array(image.convert('RGB'))
+            self.assertLess(np.abs(difference).max(), 4)
+
+        _, optimized = self._compress(color, optimize=True)
+        self.assertEqual(optimized.size, (40, 30))
+
+    def test_16bit_images_are_scaled(self):
+        data = np.zeros((30, 40), dtype=np.int32)
+        data[:, 20:] = 40000
+        data[:, 30:] = 20000
+        _, jpeg = self._compress(Image.fromarray(data, mode='I'))
+        row = np.array(jpeg.convert('L'))[15]
+        self.assertLess(row[5], 5)
+        self.assertGreater(row[25], 250)
+        self.assertTrue(120 < row[35] < 135)
+
+    def test_channels_are_scaled_separately(self):
+        data = np.zeros((2, 2, 3), dtype=np.uint16)
+        data[0, 0] = (1000, 20000, 0)
+        data[1, 1] = (500, 40000, 0)
+        image = ZipCompressedChunkWriter._to_8bit(data)
+        self.assertEqual(image.dtype, np.uint8)
+        self.assertEqual(image[0, 0].tolist(), [255, 128, 0])
+        self.assertEqual(image[1, 1].tolist(), [128, 255, 0])
+
+    def test_float_images_are_clipped(self):
+        data = np.array([[-1.5, 100.5], [200.0, 300.0]], dtype=np.float32)
+        self.assertEqual(ZipCompressedChunkWriter._to_8bit(data).tolist(),
+            [[0, 100], [200, 255]])
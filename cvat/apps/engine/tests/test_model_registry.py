@@ -0,0 +1,54 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+import threading
+from unittest import TestCase
+
+import torch
+
+from cvat.apps.engine.model_registry import ModelRegistry
+
+
+class ModelRegistryTest(TestCase):
+    def setUp(self):
+        self.registry = ModelRegistry()
+        self.loading = threading.Event()
+        self.release = threading.Event()
+        self.loads = []
+
+        def slow_loader(compound_coef):
+            self.loads.append(compound_coef)
+            self.loading.set()
+            self.release.wait(5)
+            return torch.nn.Linear(2, 2)
+
+        self.registry.register('slow', slow_loader)
+        self.registry.register('fast', lambda compound_coef: torch.nn.Linear(2, 2))
+
+    def _get_in_background(self, family):
+        thread = threading.Thread(target=self.registry.get, args=(family,))
+        thread.start()
+        return thread
+
+    def test_loading_does_not_block_other_models(self):
+        self.registry.get('fast')
+        thread = self._get_in_background('slow')
+        self.assertTrue(self.loading.wait(5))
+
+        self.assertIsNotNone(self.registry.get('fast'))
+        self.assertTrue(thread.is_alive())
+        self.release.set()
+        thread.join()
+
+    def test_model_is_loaded_once(self):
+        threads = [self._get_in_background('slow') for _ in range(4)]
+        self.assertTrue(self.loading.wait(5))
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.loads, [0])
+        stats = self.registry.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 3)
@@ -0,0 +1,67 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+from unittest import TestCase
+
+import numpy as np
+
+from cvat.apps.engine.predict import (bb_intersection_over_union,
+    remove_overlapping, remove_undesired)
+
+
+def _generate_prediction(rng, count):
+    xy = rng.uniform(0, 500, (count, 2))
+    wh = rng.uniform(5, 150, (count, 2))
+    return {
+        'rois': np.concatenate([xy, xy + wh], axis=1).astype(np.float32),
+        'class_ids': rng.randint(0, 10, count),
+        'scores': rng.uniform(0, 1, count).astype(np.float32),
+    }
+
+def _copy_prediction(pred):
+    return { key: value.copy() for key, value in pred.items() }
+
+def _remove_overlapping_pairwise(pred, iou_threshold):
+    suppressed = set()
+    for i, box1 in enumerate(pred['rois']):
+        for j, box2 in enumerate(pred['rois']):
+            if i != j and not np.array_equal(box1, box2) and \
+                    bb_intersection_over_union(box1, box2) > iou_threshold:
+                suppressed.add(j if pred['scores'][i] > pred['scores'][j] else i)
+    keep = [i for i in range(len(pred['rois'])) if i not in suppressed]
+    return pred['rois'][keep]
+
+class PredictFiltersTest(TestCase):
+    def test_remove_undesired(self):
+        rng = np.random.RandomState(0)
+        pred = _generate_prediction(rng, 100)
+        expected = pred['rois'][np.isin(pred['class_ids'], [1, 2, 3])]
+
+        result = remove_undesired([_copy_prediction(pred)], [1, 2, 3])[0]
+
+        self.assertTrue(np.array_equal(result['rois'], expected))
+        self.assertTrue(np.isin(result['class_ids'], [1, 2, 3]).all())
+        self.assertEqual(len(result['scores']), len(expected))
+
+    def test_remove_overlapping(self):
+        rng = np.random.RandomState(0)
+        for count in [0, 1, 2, 10, 50]:
+            pred = _generate_prediction(rng, count)
+            expected = _remove_overlapping_pairwise(pred, 0.3)
+
+            result = remove_overlapping([_copy_prediction(pred)], 0.3)[0]
+
+            self.assertTrue(np.array_equal(result['rois'], expected))
+            self.assertEqual(len(result['scores']), len(expected))
+
+    def test_empty_prediction(self):
+        pred = {
+            'rois': np.array(()),
+            'class_ids': np.array(()),
+            'scores': np.array(()),
+        }
+
+        result = remove_overlapping(remove_undesired([pred], [1]), 0.9)[0]
+
+        self.assertEqual(len(result['rois']), 0)
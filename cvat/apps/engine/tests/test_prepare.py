@@ -0,0 +1,81 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from cvat.apps.engine.prepare import AnalyzeVideo, PrepareInfo, get_key_frame_index, prepare_meta
+from cvat.apps.engine.tests.test_rest_api import generate_video_file
+
+
+class KeyFrameIndexTest(TestCase):
+    def setUp(self):
+        fd, self.meta_path = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'w') as meta_file:
+            # the meta file of an uploaded video ends with the number of frames
+            meta_file.write('0 0\n25 12800\n50 25600\n75 38400\n90')
+
+    def tearDown(self):
+        os.remove(self.meta_path)
+
+    def test_nearest_left_key_frame(self):
+        index = get_key_frame_index(self.meta_path)
+
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.get_nearest_left(0), (0, 0))
+        self.assertEqual(index.get_nearest_left(24), (0, 0))
+        self.assertEqual(index.get_nearest_left(25), (25, 12800))
+        self.assertEqual(index.get_nearest_left(89), (75, 38400))
+
+    def test_index_is_parsed_once(self):
+        self.assertIs(get_key_frame_index(self.meta_path), get_key_frame_index(self.meta_path))
+
+class AnalyzeVideoTest(TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        _, video = generate_video_file('video.mp4', width=64, height=64, duration=2)
+        self.video_path = os.path.join(self._root, 'video.mp4')
+        with open(self.video_path, 'wb') as video_file:
+            video_file.write(video.getvalue())
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_analyze(self):
+        video_info = AnalyzeVideo(source_path=self.video_path).analyze()
+
+        self.assertEqual(video_info.frames, 50)
+        self.assertEqual(video_info.frame_size, (64, 64))
+        self.assertEqual(next(iter(video_info.key_frames)), 0)
+        self.assertEqual(video_info.key_frames,
+            AnalyzeVideo(source_path=self.video_path)._analyze_frames().key_frames)
+
+    def test_prepare_meta(self):
+        meta_info, smooth_decoding = prepare_meta('video.mp4', upload_dir=self._root, chunk_size=36)
+
+        self.assertTrue(smooth_decoding)
+        self.assertEqual(meta_info.get_task_size(), 50)
+        self.assertEqual(meta_info.frame_sizes, (64, 64))
+        index = get_key_frame_index(meta_info.meta_path)
+        self.assertEqual(len(index), len(meta_info.key_frames))
+        self.assertEqual(index.get_nearest_left(49), list(meta_info.key_frames.items())[-1])
+
+    def test_key_frames_are_checked_by_packet_checksums(self):
+        meta_info, _ = prepare_meta('video.mp4', upload_dir=self._root)
+        self.assertEqual(set(meta_info.checksums), set(meta_info.key_frames.values()))
+        self.assertEqual(meta_info.find_invalid_key_frames(), [])
+
+        # the first key frame is decoded even if its checksum is known
+        with mock.patch.object(PrepareInfo, '_decode_first_frame', return_value=None):
+            self.assertEqual(meta_info.find_invalid_key_frames(), [0])
+
+        pts = next(iter(meta_info.checksums))
+        meta_info.checksums[pts] += 1
+        self.assertEqual(meta_info.find_invalid_key_frames(), [0])
+
+        # without checksums the first frame after seeking is decoded
+        meta_info.checksums = {}
+        self.assertEqual(meta_info.find_invalid_key_frames(), [])
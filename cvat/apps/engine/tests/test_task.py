@@ -0,0 +1,160 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock
+from urllib.request import pathname2url
+
+from django.test import override_settings
+
+from cvat.apps.engine import task
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    files = {}
+    # names of the files which are interrupted on the first request
+    flaky_files = set()
+    requests = []
+
+    def do_GET(self):
+        name = self.path.lstrip('/')
+        self.requests.append((name, self.headers.get('Range')))
+        if name not in self.files:
+            self.send_error(404)
+            return
+
+        data = self.files[name]
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'][len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+
+        if name in self.flaky_files:
+            self.flaky_files.remove(name)
+            self.wfile.write(data[start:start + len(data) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+class DownloadDataTest(TestCase):
+    def setUp(self):
+        self._upload_dir = tempfile.mkdtemp()
+        _FileHandler.files = {'{}.bin'.format(i): os.urandom(100000 + i) for i in range(10)}
+        _FileHandler.flaky_files = {'3.bin'}
+        _FileHandler.requests = []
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _FileHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._upload_dir)
+
+    def _download(self, names):
+        urls = ['http://127.0.0.1:{}/{}'.format(self._server.server_port, name) for name in names]
+        with override_settings(DOWNLOAD_WORKERS=4), \
+                mock.patch.object(task.rq, 'get_current_job'), \
+                mock.patch.object(task.time, 'sleep'):
+            return task._download_data(urls, self._upload_dir)
+
+    def test_files_are_downloaded(self):
+        names = sorted(_FileHandler.files)
+        self.assertEqual(self._download(names), names)
+
+        for name in names:
+            with open(os.path.join(self._upload_dir, name), 'rb') as downloaded_file:
+                self.assertEqual(downloaded_file.read(), _FileHandler.files[name])
+        # the interrupted download is resumed from the received part
+        self.assertIn(('3.bin', 'bytes={}-'.format(len(_FileHandler.files['3.bin']) // 2)),
+            _FileHandler.requests)
+
+    def test_missing_file(self):
+        with self.assertRaisesRegex(Exception, '404'):
+            self._download(['0.bin', 'missing.bin'])
+
+    def test_file_urls_are_downloaded(self):
+        source_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir)
+        source_path = os.path.join(source_dir, 'local.bin')
+        with open(source_path, 'wb') as source_file:
+            source_file.write(_FileHandler.files['0.bin'])
+        urls = ['file://' + pathname2url(source_path),
+            'http://127.0.0.1:{}/1.bin'.format(self._server.server_port)]
+
+        with mock.patch.object(task.rq, 'get_current_job'):
+            self.assertEqual(task._download_data(urls, self._upload_dir), ['local.bin', '1.bin'])
+        for name, data_name in [('local.bin', '0.bin'), ('1.bin', '1.bin')]:
+            with open(os.path.join(self._upload_dir, name), 'rb') as downloaded_file:
+                self.assertEqual(downloaded_file.read(), _FileHandler.files[data_name])
+
+class ShareIngestionTest(TestCase):
+    def setUp(self):
+        self._share_root = tempfile.mkdtemp()
+        self._upload_dir = tempfile.mkdtemp()
+        self.files = ['images/0.jpg', 'images/nested/1.jpg', '2.jpg']
+        for path in self.files:
+            os.makedirs(os.path.join(self._share_root, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(self._share_root, path), 'w') as share_file:
+                share_file.write(path)
+
+    def tearDown(self):
+        shutil.rmtree(self._share_root)
+        shutil.rmtree(self._upload_dir)
+
+    def _ingest(self, mode, passthrough=False):
+        with override_settings(SHARE_ROOT=self._share_root, SHARE_INGESTION_MODE=mode,
+                    ORIGINAL_CHUNK_PASSTHROUGH=passthrough), \
+                mock.patch.object(task.rq, 'get_current_job'):
+            task._copy_data_from_share(['images/', '2.jpg'], self._upload_dir)
+
+        for path in self.files:
+            with open(os.path.join(self._upload_dir, path)) as task_file:
+                self.assertEqual(task_file.read(), path)
+        return [os.path.samefile(os.path.join(self._upload_dir, path),
+            os.path.join(self._share_root, path)) for path in self.files]
+
+    def test_files_are_copied(self):
+        self.assertEqual(self._ingest('copy'), [False] * 3)
+
+    def test_directory_link_loops_are_walked_once(self):
+        os.symlink(os.path.join(self._share_root, 'images'),
+            os.path.join(self._share_root, 'images', 'nested', 'loop'))
+        self.assertEqual(self._ingest('copy'), [False] * 3)
+        self.assertFalse(os.path.exists(os.path.join(self._upload_dir, 'images', 'nested', 'loop')))
+
+    def test_files_are_linked(self):
+        self.assertEqual(self._ingest('link'), [True] * 3)
+        # directories are not linked, so that archives are not extracted into the share
+        self.assertFalse(os.path.islink(os.path.join(self._upload_dir, 'images', 'nested')))
+
+    def test_symlinks_are_used_if_files_cannot_be_linked(self):
+        def link(source_path, target_path):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        with mock.patch.dict(task.SHARE_INGESTION_METHODS,
+                {'symlink': [link, os.symlink]}):
+            self.assertEqual(self._ingest('symlink'), [True] * 3)
+        self.assertTrue(all(os.path.islink(os.path.join(self._upload_dir, path))
+            for path in self.files))
+
+    def test_files_are_copied_instead_of_symlinks_with_passthrough(self):
+        def link(source_path, target_path):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        with mock.patch.dict(task.SHARE_INGESTION_METHODS,
+                {'link': [link, shutil.copyfile], 'symlink': [link, os.symlink]}):
+            self.assertEqual(self._ingest('symlink', passthrough=True), [False] * 3)
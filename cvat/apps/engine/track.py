@@ -1,4 +1,43 @@
+import os
+import threading
+
 import cv2
+import torch
+
+from cvat.apps.engine import model_registry
+from cvat.apps.engine.pysot.core.config import cfg
+from cvat.apps.engine.pysot.models.model_builder import ModelBuilder
+from cvat.apps.engine.pysot.tracker.multi_siamrpn_tracker import MultiSiamRPNTracker
+from cvat.apps.engine.pysot.tracker.tracker_builder import build_tracker
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pysot', 'siamrpn_alex_dwxcorr')
+config_path = os.path.join(path, 'config.yaml')
+model_path = os.path.join(path, 'model.pth')
+
+_config_lock = threading.Lock()
+_config_loaded = False
+
+def _load_config():
+    # the config is loaded when SiamRPN is used for the first time,
+    # so CSRT works without the SiamRPN files
+    global _config_loaded
+    with _config_lock:
+        if not _config_loaded:
+            cfg.merge_from_file(config_path)
+            cfg.CUDA = torch.cuda.is_available() and cfg.CUDA
+            _config_loaded = True
+
+def _load_siamrpn_model(compound_coef):
+    model = ModelBuilder()
+    model.load_state_dict(torch.load(model_path,
+        map_location=lambda storage, loc: storage.cpu()))
+    return model
+
+model_registry.register('siamrpn', _load_siamrpn_model)
+
+def siamrpn_model_params():
+    _load_config()
+    return 'siamrpn', 0, 'cuda' if cfg.CUDA else 'cpu', torch.float32
 
 class Tracker:
     def __init__(self):
@@ -6,7 +45,7 @@ class Tracker:
 
     def init(self):
         pass
-        
+
     def update(self):
         pass
 
@@ -24,3 +63,46 @@ class CSRT(Tracker):
             return box
 
 
+class SiamRPN(Tracker):
+    # The model is shared between all trackers of the process, but
+    # the template features belong to the tracked object
+    _model_lock = threading.Lock()
+
+    def __init__(self):
+        self.tracker = build_tracker(model_registry.get_model(*siamrpn_model_params()))
+        self.zf = None
+
+    def init(self, frame, initBB):
+        with self._model_lock, torch.no_grad():
+            self.tracker.init(frame, initBB)
+            self.zf = self.tracker.model.zf
+
+    def update(self, frame):
+        with self._model_lock, torch.no_grad():
+            self.tracker.model.zf = self.zf
+            outputs = self.tracker.track(frame)
+        return outputs['bbox']
+
+    @classmethod
+    def track_batch(cls, trackers, frames):
+        """Tracks several objects on the same frames with one forward pass
+        of the model per frame. Returns a list of boxes for every tracker.
+        """
+        multi_tracker = MultiSiamRPNTracker(model_registry.get_model(*siamrpn_model_params()))
+        for tracker in trackers:
+            multi_tracker.add_target(tracker.zf, tracker.tracker.center_pos,
+                tracker.tracker.size, tracker.tracker.channel_average)
+
+        boxes = [[] for _ in trackers]
+        for frame in frames:
+            # the lock is taken per frame, so other tracking requests
+            # are not blocked for the whole batch
+            with cls._model_lock, torch.no_grad():
+                outputs = multi_tracker.track(frame)
+            for idx, target_outputs in enumerate(outputs):
+                boxes[idx].append(target_outputs['bbox'])
+
+        for tracker, target in zip(trackers, multi_tracker.targets):
+            tracker.tracker.center_pos = target['center_pos']
+            tracker.tracker.size = target['size']
+        return boxes
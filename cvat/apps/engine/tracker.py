@@ -14,126 +14,292 @@ import torch
 import numpy as np
 from glob import glob
 
-from cvat.apps.engine.pysot.core.config import cfg
-from cvat.apps.engine.pysot.models.model_builder import ModelBuilder
-from cvat.apps.engine.pysot.tracker.tracker_builder import build_tracker
+import threading
+import time
+from collections import OrderedDict
+from configparser import ConfigParser
+
+from diskcache import Cache
+from django.conf import settings
+
+from cvat.apps.engine.track import CSRT, SiamRPN
+
+TRACKERS = {
+    'CSRT': CSRT,
+    'pysot': CSRT,
+    'siamrpn': SiamRPN,
+}
+
 class Tracker:
     results = []
     def track(self, frameList, initBB, tracker):
-        if(tracker == 'CSRT'):
-            results = track_CSRT(frameList,initBB)
-        elif(tracker == 'pysot'):
-            results = track_CSRT(frameList,initBB)
+        session = TrackingSession(tracker)
+        session.init(frameList[0], initBB)
+        results = session.track(frameList[1:])
         self.results = results
         return results
 def track_CSRT(frameList, initBB):
-    start = 0
-    coords = []
-    tracker = cv2.TrackerCSRT_create()
-
-    # loop over frames from the video stream
-    for frame in frameList:
-        # grab the current frame, then handle if we are using a
-        # VideoStream or VideoCapture object
-        if start == 0:
-            tracker.init(frame, initBB)
-
-        # check to see if we are currently tracking an object
-        if (start % 1 == 0) and start > 0:
-            # grab the new bounding box coordinates of the object
-            (success, box) = tracker.update(frame)
+    return Tracker().track(frameList, initBB, 'CSRT')
+
+
+def track_pysot(frameList, initBB):
+    return Tracker().track(frameList, initBB, 'pysot')
+
+class TrackingSession:
+    """Keeps the state of a tracker for one object between requests,
+    so that extending a track only processes new frames.
+    """
+    def __init__(self, tracker):
+        if tracker not in TRACKERS:
+            raise Exception('Unknown tracker: {}'.format(tracker))
+        self.tracker_name = tracker
+        self._tracker = TRACKERS[tracker]()
+        self.frame = None # the last processed frame number
+        self.bbox = None # the last known [xtl, ytl, xbr, ybr] of the object
+        self.last_access = time.monotonic()
+
+    def init(self, frame, initBB, frame_number=None):
+        self._tracker.init(frame, initBB)
+        (x, y, w, h) = [int(v) for v in initBB]
+        self.bbox = [x, y, x + w, y + h]
+        self.frame = frame_number
+
+    def track(self, frames, frame_numbers=None):
+        boxes = [self._tracker.update(frame) for frame in frames]
+        return self._update(boxes, frame_numbers)
+
+    def track_frames(self, frames):
+        """Tracks the object on (frame number, frame) pairs, for example
+        while the following frames are still being decoded.
+        """
+        coords = []
+        for frame_number, frame in frames:
+            coords += self._update([self._tracker.update(frame)], [frame_number])
+        return coords
 
+    def _update(self, boxes, frame_numbers):
+        coords = []
+        for box in boxes:
             # check to see if the tracking was a success
-            if success:
+            if box is not None:
                 (x, y, w, h) = [int(v) for v in box]
                 coords.append([x, y, x + w, y + h])
+                self.bbox = coords[-1]
 
-        start = start + 1
+        if frame_numbers:
+            self.frame = frame_numbers[-1]
+        return coords
 
-    return coords
+    def can_continue(self, frame_number, bbox):
+        return self.frame is not None and self.frame == frame_number and \
+            self.bbox == [int(v) for v in bbox]
 
+def track_sessions(sessions, frames, frame_numbers=None):
+    """Tracks several objects on the same frames. SiamRPN sessions are
+    processed together, so the model runs once per frame for all of them.
+    """
+    results = {}
+    batched = [session for session in sessions if isinstance(session._tracker, SiamRPN)]
+    if batched:
+        boxes = SiamRPN.track_batch([session._tracker for session in batched], frames)
+        for session, session_boxes in zip(batched, boxes):
+            results[id(session)] = session._update(session_boxes, frame_numbers)
 
-def track_pysot(frameList, initBB):
+    for session in sessions:
+        if id(session) not in results:
+            results[id(session)] = session.track(frames, frame_numbers)
+    return [results[id(session)] for session in sessions]
+
+class TrackingSessionManager:
+    """Process-wide storage of tracking sessions by (task id, user id, object id).
+
+    Sessions are dropped after an idle timeout, and the least recently used
+    session is dropped when the number of sessions exceeds the limit.
+    """
+    def __init__(self, max_sessions=200, idle_timeout=600):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(task_id, user_id, object_id):
+        return (int(task_id), int(user_id), int(object_id))
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [key for key, session in self._sessions.items()
+            if now - session.last_access > self.idle_timeout]
+        for key in expired:
+            self._sessions.pop(key)
+
+    def get(self, task_id, user_id, object_id):
+        key = self._key(task_id, user_id, object_id)
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(key)
+            if session is not None:
+                session.last_access = time.monotonic()
+                self._sessions.move_to_end(key)
+            return session
+
+    def create(self, task_id, user_id, object_id, tracker):
+        key = self._key(task_id, user_id, object_id)
+        session = TrackingSession(tracker)
+        with self._lock:
+            self._expire()
+            self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def remove(self, task_id, user_id, object_id):
+        with self._lock:
+            self._sessions.pop(self._key(task_id, user_id, object_id), None)
+
+    def flush(self, task_id, user_id):
+        with self._lock:
+            for key in [key for key in self._sessions
+                    if key[:2] == (int(task_id), int(user_id))]:
+                self._sessions.pop(key)
 
-    path = os.path.abspath("./")
-    config_path = os.path.join(path,'cvat/apps/engine/pysot/siamrpn_alex_dwxcorr/config.yaml')
-    model_path = os.path.join(path,'cvat/apps/engine/pysot/siamrpn_alex_dwxcorr/model.pth')
-    coords = []
-    # load config
-    cfg.merge_from_file(config_path)
-    cfg.CUDA = torch.cuda.is_available() and cfg.CUDA
-    device = torch.device('cuda')
-
-    # create model
-    model = ModelBuilder()
-
-    # load model
-    model.load_state_dict(torch.load(model_path,
-        map_location=lambda storage, loc: storage.cpu()))
-    model.eval().to(device)
-
-    # build tracker
-    tracker = build_tracker(model)
-
-    first_frame = True
-
-    for frame in frameList:
-        if first_frame:
-            tracker.init(frame, initBB)
-            first_frame = False
-        else:
-            outputs = tracker.track(frame)
-            if 'polygon' in outputs:
-                polygon = np.array(outputs['polygon']).astype(np.int32)
-                # print(polygon)
-                # cv2.polylines(frame, [polygon.reshape((-1, 1, 2))],
-                #               True, (0, 255, 0), 3)
-                mask = ((outputs['mask'] > cfg.TRACK.MASK_THERSHOLD) * 255)
-                mask = mask.astype(np.uint8)
-                mask = np.stack([mask, mask*255, mask]).transpose(1, 2, 0)
-                frame = cv2.addWeighted(frame, 0.77, mask, 0.23, -1)
-            else:
-                bbox = list(map(int, outputs['bbox']))
-                coords.append([bbox[0],bbox[1],bbox[0]+bbox[2],bbox[1]+bbox[3]])
-                # print(bbox)
-                # cv2.rectangle(frame, (bbox[0], bbox[1]),
-                #               (bbox[0]+bbox[2], bbox[1]+bbox[3]),
-                #               (0, 255, 0), 3)
-            # cv2.imshow(video_name, frame)
-            # cv2.waitKey(40)
-    return coords
+def _create_session_manager():
+    config = ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'))
+    if not config.has_section('tracking'):
+        return TrackingSessionManager()
+    return TrackingSessionManager(
+        max_sessions=config.getint('tracking', 'max_sessions', fallback=200),
+        idle_timeout=config.getint('tracking', 'session_timeout', fallback=600))
+
+sessions = _create_session_manager()
 
 class TrackResultsStorage:
-    results = []
-    updated = False
-    def check(self):
-        size = len(self.results)
-        if(size>0):
-            return True
-        else:
-            return False
-
-    def flush(self):
-        self.results = []
-    def get(self,objectID):
-        for result in self.results:
-            if(result['objectID']==objectID):
-                return result['data']
-    def store(self, entry):
-        self.results.append(entry)
-        self.updated = True
-    def update(self, entry):
-        for result in self.results:
-            if(result['objectID']==entry['objectID']):
-                result['data']=result['data']+entry['data']
-                result['frameEnd']=entry['frameEnd']
-    def edit(self,objectID,slice_index,bbox,crop):
-        for result in self.results:
-            if(result['objectID']==objectID):
-                print('before',result['data'][slice_index]['bbox'])
-                result['data'][slice_index]['bbox']=bbox
-                result['data'][slice_index]['crop']=crop
-                print('after',result['data'][slice_index]['bbox'])
-                print(slice_index)
-                print('last index',len(result['data']))
-                print(result['data'][-1]['bbox'])
\ No newline at end of file
+    """Tracking results of every (task, user, object).
+
+    The results are kept in a disk cache, so that all worker processes
+    share them, and the least recently used results are evicted when the
+    cache exceeds its size limit. Boxes and crops of an object are stored
+    under separate keys, so the boxes are read without the crops. Crops
+    are stored as JPEG images.
+    """
+    def __init__(self, directory, size_limit):
+        self._directory = directory
+        self._size_limit = size_limit
+        self._cache = None
+        self._pid = None
+
+    @property
+    def cache(self):
+        # the connection to the cache must not be shared with forked workers
+        if self._cache is None or self._pid != os.getpid():
+            self._cache = Cache(self._directory, size_limit=self._size_limit,
+                eviction_policy='least-recently-used', tag_index=True)
+            self._pid = os.getpid()
+        return self._cache
+
+    @staticmethod
+    def _tag(task_id, user_id):
+        return 'tracking_{}_{}'.format(task_id, user_id)
+
+    @staticmethod
+    def _key(task_id, user_id, objectID):
+        return 'tracking_{}_{}_{}'.format(task_id, user_id, objectID)
+
+    @staticmethod
+    def _crops_key(task_id, user_id, objectID):
+        return 'tracking_{}_{}_{}_crops'.format(task_id, user_id, objectID)
+
+    @staticmethod
+    def _encode_crop(crop):
+        crop = np.ascontiguousarray(crop)
+        if crop.size:
+            success, buf = cv2.imencode('.jpg', crop, [int(cv2.IMWRITE_JPEG_QUALITY), 95])
+            if success:
+                return buf.tobytes(), crop.shape
+        return None, crop.shape
+
+    @staticmethod
+    def _decode_crop(encoded_crop):
+        crop, shape = encoded_crop
+        if crop is None:
+            return np.zeros(shape, dtype=np.uint8)
+        return cv2.imdecode(np.frombuffer(crop, dtype=np.uint8),
+            cv2.IMREAD_UNCHANGED).reshape(shape)
+
+    @staticmethod
+    def _split_items(items):
+        boxes = [{k: v for k, v in item.items() if k != 'crop'} for item in items]
+        crops = [TrackResultsStorage._encode_crop(item['crop']) for item in items]
+        return boxes, crops
+
+    def flush(self, task_id, user_id):
+        self.cache.evict(self._tag(task_id, user_id))
+
+    def get(self, task_id, user_id, objectID, with_crops=True):
+        entry = self.cache.get(self._key(task_id, user_id, objectID))
+        if entry is None:
+            return None
+        if not with_crops:
+            return entry['data']
+
+        crops = self.cache.get(self._crops_key(task_id, user_id, objectID))
+        if crops is None or len(crops) != len(entry['data']):
+            # the crops were evicted separately from the boxes
+            return None
+        return [dict(item, crop=self._decode_crop(crop))
+            for item, crop in zip(entry['data'], crops)]
+
+    def store(self, task_id, user_id, entry):
+        entry = dict(entry)
+        entry['data'], crops = self._split_items(entry['data'])
+        tag = self._tag(task_id, user_id)
+        with self.cache.transact():
+            self.cache.set(self._key(task_id, user_id, entry['objectID']), entry, tag=tag)
+            self.cache.set(self._crops_key(task_id, user_id, entry['objectID']), crops, tag=tag)
+
+    def update(self, task_id, user_id, entry):
+        key = self._key(task_id, user_id, entry['objectID'])
+        crops_key = self._crops_key(task_id, user_id, entry['objectID'])
+        tag = self._tag(task_id, user_id)
+        boxes, new_crops = self._split_items(entry['data'])
+        with self.cache.transact():
+            result = self.cache.get(key)
+            if result is not None:
+                result['data'] += boxes
+                result['frameEnd'] = entry['frameEnd']
+                self.cache.set(key, result, tag=tag)
+                crops = self.cache.get(crops_key)
+                if crops is not None:
+                    self.cache.set(crops_key, crops + new_crops, tag=tag)
+
+    def edit(self, task_id, user_id, objectID, slice_index, bbox, crop):
+        key = self._key(task_id, user_id, objectID)
+        crops_key = self._crops_key(task_id, user_id, objectID)
+        tag = self._tag(task_id, user_id)
+        with self.cache.transact():
+            result = self.cache.get(key)
+            if result is not None:
+                result['data'][slice_index]['bbox'] = bbox
+                self.cache.set(key, result, tag=tag)
+                crops = self.cache.get(crops_key)
+                if crops is not None:
+                    crops[slice_index] = self._encode_crop(crop)
+                    self.cache.set(crops_key, crops, tag=tag)
+
+def _create_results_storage():
+    config = ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'))
+    size_limit = config.getint('tracking', 'results_size_mb', fallback=512) * 1024 * 1024
+    return TrackResultsStorage(os.path.join(settings.CACHE_ROOT, 'tracking'), size_limit)
+
+_results_storage = None
+_results_storage_lock = threading.Lock()
+
+def get_results_storage():
+    global _results_storage
+    with _results_storage_lock:
+        if _results_storage is None:
+            _results_storage = _create_results_storage()
+        return _results_storage
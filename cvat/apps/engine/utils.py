@@ -70,7 +70,9 @@ def execute_python_code(source_code, global_vars=None, local_vars=None):
 
 def av_scan_paths(*paths):
     if 'yes' == os.environ.get('CLAM_AV'):
-        command = ['clamscan', '--no-summary', '-i', '-o']
+        # files of the share can be symbolic links in the upload directory
+        command = ['clamscan', '--no-summary', '-i', '-o',
+            '--follow-dir-symlinks=2', '--follow-file-symlinks=2']
         command.extend(paths)
         res = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if res.returncode:
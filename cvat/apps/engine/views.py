@@ -2,6 +2,8 @@
 #
 # SPDX-License-Identifier: MIT
 
+import itertools
+import mimetypes
 import os
 import os.path as osp
 import shutil
@@ -11,11 +13,12 @@ from distutils.util import strtobool
 from tempfile import mkstemp
 
 import django_rq
+import rq
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import IntegrityError
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django_filters import rest_framework as filters
@@ -35,7 +38,10 @@ import cvat.apps.dataset_manager as dm
 import cvat.apps.dataset_manager.views # pylint: disable=unused-import
 from cvat.apps.authentication import auth
 from cvat.apps.dataset_manager.serializers import DatasetFormatsSerializer
-from cvat.apps.engine.frame_provider import FrameProvider
+from cvat.apps.engine.cache import CacheInteraction, prefetch_chunks
+from cvat.apps.engine import model_registry
+from cvat.apps.engine.frame_provider import FrameProvider, frame_cache
+from cvat.apps.engine.media_extractors import stream_zip_chunk
 from cvat.apps.engine.models import Job, StatusChoice, Task, StorageMethodChoice
 from cvat.apps.engine.serializers import (
     AboutSerializer, AnnotationFileSerializer, BasicUserSerializer,
@@ -57,7 +63,9 @@ from PIL import Image
 import numpy as np
 # ISL END
 
-from cvat.apps.engine.tracker import Tracker,TrackResultsStorage# ISL TRACKING
+from cvat.apps.engine.tracker import Tracker,TrackingSession# ISL TRACKING
+from cvat.apps.engine.tracker import get_results_storage
+from cvat.apps.engine.tracker import sessions as tracking_sessions, track_sessions
 from cvat.apps.engine.efficientcut import efficientcut #ISL EFFICIENTCUT
 
 import json # ISL GLOBAL ATTRIBUTES
@@ -71,7 +79,7 @@ config_path = os.path.join(path,'cvat/apps/engine/config.ini')
 config.read(config_path)
 # mabe end
 # mabe predict bbs
-from cvat.apps.engine.predict import predict
+from cvat.apps.engine.predict import predict, predict_batch
 # mabe end
 
 # mabe trackall
@@ -79,7 +87,6 @@ import io
 import cv2
 from math import floor
 previews = []
-storage = TrackResultsStorage()
 # mabe end
 
 # drf-yasg component doesn't handle correctly URL_FORMAT_OVERRIDE and
@@ -168,6 +175,23 @@ class ServerViewSet(viewsets.ViewSet):
                     clogger.glob.info(message)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @staticmethod
+    @swagger_auto_schema(method='get', operation_summary='Returns statistics of the frame and chunk caches')
+    @action(detail=False, methods=['GET'], permission_classes=[IsAuthenticated, auth.AdminRolePermission])
+    def cache(request):
+        chunks = CacheInteraction().get_stats()
+        tasks = dict(Task.objects.filter(data_id__in=chunks['disk']['data'].keys()) \
+            .values_list('data_id', 'id'))
+        chunks['disk']['tasks'] = [
+            dict(stats, task_id=tasks.get(data_id), data_id=data_id)
+            for data_id, stats in chunks['disk'].pop('data').items()
+        ]
+        return Response(data={
+            'frames': frame_cache.stats(),
+            'chunks': chunks,
+            'models': model_registry.registry.stats(),
+        })
+
     @staticmethod
     @swagger_auto_schema(
         method='get', operation_summary='Returns all files and folders that are on the server along specified path',
@@ -442,9 +466,8 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
         db_task = self.get_object()
         frame_provider = FrameProvider(db_task.data)
         data_quality = FrameProvider.Quality.COMPRESSED
-        img, mime = frame_provider.get_frame(int(frame), data_quality)
-        img = Image.open(img)
-        orig_img = np.array(img)
+        img, mime = frame_provider.get_frame(int(frame), data_quality, FrameProvider.Type.NUMPY_ARRAY)
+        orig_img = img[:, :, ::-1] # BGR to RGB
         try:
             data = efficientcut(orig_img, [xtl, ytl, xbr, ybr])
             # data = [100,100,200,200]
@@ -516,6 +539,16 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
 
             skip = 2
             out_type = FrameProvider.Type.NUMPY_ARRAY
+            tracker_name = config['main']['tracker']
+
+            # continue the track of the object if the request starts where the previous one ended
+            session = None
+            if(not useCroppedBG and objectID is not None):
+                session = tracking_sessions.get(pk, request.user.id, objectID)
+                if(session is not None and (session.tracker_name != tracker_name or
+                        not session.can_continue(frameStart, [xtl, ytl, xbr, ybr]))):
+                    session = None
+
             if(useCroppedBG):
                 for x in range(frameStart, frameEnd+1):
                     if((x-frameStart) % 2 == 1):
@@ -527,10 +560,18 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
                     if(useCroppedBG):
                         image = image[cropped_ytl:cropped_ybr,cropped_xtl:cropped_xbr,:]
                     frameList.append(image)
+                print('frameList length: %d' % len(frameList))
             else:
-                frameList = frame_provider.get_frames_improved(frameStart,frameEnd,data_quality,out_type,skip)
-
-            print('frameList length: %d' % len(frameList))
+                # frames are decoded ahead on a background thread while the tracker runs
+                prefetch = config.getint('tracking', 'frame_prefetch', fallback=16)
+                lastFrame = min(frameEnd, db_task.data.size - 1)
+                frames = iter(())
+                if(session is not None):
+                    # the session is already initialized on frameStart, only new frames are needed
+                    if(frameStart+skip <= lastFrame):
+                        frames = frame_provider.get_frame_range(frameStart+skip,lastFrame,data_quality,out_type,skip,prefetch)
+                else:
+                    frames = frame_provider.get_frame_range(frameStart,lastFrame,data_quality,out_type,skip,prefetch)
             if(useCroppedBG):
                 data = (new_xtl, new_ytl, new_xbr-new_xtl, new_ybr-new_ytl)
             else:
@@ -538,8 +579,22 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
             print('Frame fetching time: %d' % (current_milli_time() - start_frame_fetch))
             start_csrt = current_milli_time()
             print(data)
-            tracker = Tracker()
-            results = tracker.track(frameList, data,config['main']['tracker'])
+            if(useCroppedBG):
+                tracker = Tracker()
+                results = tracker.track(frameList, data,tracker_name)
+            elif(session is not None):
+                results = session.track_frames(frames)
+            else:
+                if(objectID is not None):
+                    session = tracking_sessions.create(pk, request.user.id, objectID, tracker_name)
+                else:
+                    session = TrackingSession(tracker_name)
+                first = next(frames, None)
+                results = []
+                if(first is not None):
+                    frameNumber, frame = first
+                    session.init(frame, data, frameNumber)
+                    results = session.track_frames(frames)
             print('results length',len(results))
             # enable/disable grabcut on the results
             # for result,frame in zip(results,frameList):
@@ -592,6 +647,7 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
     )
     @action(detail=True, methods=['POST','GET'])
     def trackall(self, request, pk):
+        storage = get_results_storage()
         if request.method == 'POST':
         # try:
             print('request.data',request.data)
@@ -611,22 +667,21 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
             data_quality = FrameProvider.Quality.COMPRESSED
             skip = 2
             out_type = FrameProvider.Type.NUMPY_ARRAY
-
-            #initiate tracker
-            tracker = Tracker()
+            tracker_name = config['main']['tracker']
 
             #track based on the mode
             print('tracking in mode',mode)
             if(mode=='NORMAL'):
-                storage.flush()
+                storage.flush(pk, request.user.id)
+                tracking_sessions.flush(pk, request.user.id)
                 bboxes = data['bboxes']
                 # get the frames
 
                 frameList = frame_provider.get_frames_improved(frameStart,frameEnd,data_quality,out_type,skip)
+                frameNumbers = list(range(frameStart, min(frameEnd, db_task.data.size - 1)+1, skip))
 
-                for bbox in bboxes:
-                    index = bboxes.index(bbox)
-                    print('tracking item ',index)
+                sessions = []
+                for index, bbox in enumerate(bboxes):
                     bbox[0]=int(bbox[0])
                     bbox[1]=int(bbox[1])
                     bbox[2]=int(bbox[2])
@@ -636,7 +691,16 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
                     xbr = bbox[2]
                     ybr = bbox[3]
                     data = (xtl, ytl, xbr-xtl, ybr-ytl)
-                    result = tracker.track(frameList, data,'pysot')
+                    # keep the tracker state to extend the track in APPEND mode
+                    session = tracking_sessions.create(pk, request.user.id, objectIDs[index], tracker_name)
+                    session.init(frameList[0], data, frameStart)
+                    sessions.append(session)
+                # all objects are tracked together, one model pass per frame
+                track_results = track_sessions(sessions, frameList[1:], frameNumbers[1:])
+
+                for index, bbox in enumerate(bboxes):
+                    print('tracking item ',index)
+                    result = track_results[index]
                     int_result = []
                     for idx, bbox in enumerate(result):
                         temp_bbox = [int(bbox[0]),int(bbox[1]),int(bbox[2]),int(bbox[3])]
@@ -686,21 +750,31 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
                         "frameStart":frameStart,
                         "frameEnd":frameEnd
                     }
-                    storage.store(store_entry)
+                    storage.store(pk, request.user.id, store_entry)
             elif(mode =='APPEND'):
                 bboxes = []
-                new_frame_start = storage.get(objectIDs[0])[-1]['frame']
+                tracked_items = [storage.get(pk, request.user.id, objectID, with_crops=False)
+                    for objectID in objectIDs]
+                if any(not items for items in tracked_items):
+                    return Response(data='tracking results are not available, track the objects again',
+                        status=status.HTTP_400_BAD_REQUEST)
+                new_frame_start = tracked_items[0][-1]['frame']
                 print(new_frame_start)
-                for objectID in objectIDs:
-                    items = storage.get(objectID)
+                for items in tracked_items:
                     bbox = items[-1]['bbox']
                     bboxes.append(bbox)
                     print(bbox)
-                frameList = frame_provider.get_frames_improved(new_frame_start,frameEnd,data_quality,out_type,skip)
-
-                for bbox in bboxes:
-                    index = bboxes.index(bbox)
-                    print('tracking item ',index)
+                # only the frames after the last tracked one are decoded,
+                # the frame new_frame_start is needed just to re-initialize lost sessions
+                frameList = []
+                lastFrame = min(frameEnd, db_task.data.size - 1)
+                if(new_frame_start+skip <= lastFrame):
+                    frameList = frame_provider.get_frames_improved(new_frame_start+skip,lastFrame,data_quality,out_type,skip)
+                frameNumbers = list(range(new_frame_start+skip, lastFrame+1, skip))
+                initFrame = None
+
+                sessions = []
+                for index, bbox in enumerate(bboxes):
                     bbox[0]=int(bbox[0])
                     bbox[1]=int(bbox[1])
                     bbox[2]=int(bbox[2])
@@ -710,7 +784,18 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
                     xbr = bbox[2]
                     ybr = bbox[3]
                     data = (xtl, ytl, xbr-xtl, ybr-ytl)
-                    result = tracker.track(frameList, data,'pysot')
+                    session = tracking_sessions.get(pk, request.user.id, objectIDs[index])
+                    if(session is None or not session.can_continue(new_frame_start, bbox)):
+                        if(initFrame is None):
+                            initFrame, _ = frame_provider.get_frame(new_frame_start, data_quality, out_type)
+                        session = tracking_sessions.create(pk, request.user.id, objectIDs[index], tracker_name)
+                        session.init(initFrame, data, new_frame_start)
+                    sessions.append(session)
+                track_results = track_sessions(sessions, frameList, frameNumbers)
+
+                for index, bbox in enumerate(bboxes):
+                    print('tracking item ',index)
+                    result = track_results[index]
                     print('result length',len(result))
                     print('frameList length', len(frameList))
                     # print(result)
@@ -718,15 +803,9 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
                     crops = []
 
                     for i in range(0,len(frameList)):
-                        if(i==0):
-                            continue
-                        else:
-                            temp_result = result[i-1] #a bbox
-                            for coord in temp_result:
-                                coord = int(coord)
-                            crop = frameList[i][temp_result[1]:temp_result[3],temp_result[0]:temp_result[2]]
-                            crops.append(crop)
-                        # frameList[-1][ytl:yrb,xtl:xbr]
+                        temp_result = result[i] #a bbox
+                        crop = frameList[i][temp_result[1]:temp_result[3],temp_result[0]:temp_result[2]]
+                        crops.append(crop)
 
                     print('crops length', len(crops))
                     store_data = []
@@ -746,7 +825,7 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
                         "frameStart":frameStart,
                         "frameEnd":frameEnd
                     }
-                    storage.update(store_entry)
+                    storage.update(pk, request.user.id, store_entry)
             elif(mode=='EDIT'):
                 print('EDIT MODE DETECTED')
                 selectedObjectID = data['selectedObjectID']
@@ -758,11 +837,12 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
                 bbox_slice[2]=int(bbox_slice[2])
                 bbox_slice[3]=int(bbox_slice[3])
                 print(bbox_slice)
-                img, mime = frame_provider.get_frame(slice_index*2+2, data_quality)
-                img = Image.open(img)
-                orig_img = np.array(img)
+                img, mime = frame_provider.get_frame(slice_index*2+2, data_quality, out_type)
+                orig_img = img[:, :, ::-1] # BGR to RGB
                 crop = orig_img[bbox_slice[1]:bbox_slice[3],bbox_slice[0]:bbox_slice[2]]
-                storage.edit(selectedObjectID,slice_index,bbox_slice,crop)
+                storage.edit(pk, request.user.id, selectedObjectID, slice_index, bbox_slice, crop)
+                # the tracker state doesn't correspond to the edited track anymore
+                tracking_sessions.remove(pk, request.user.id, selectedObjectID)
                 return Response([0,0,0,0])
             return Response(results)
         else:
@@ -795,15 +875,11 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
 
                 data_id = int(data_id)
                 data_quality = FrameProvider.Quality.COMPRESSED
-                buf, mime = frame_provider.get_frame(data_id, data_quality)
-
 
-                # bytes_image=buf.getvalue()
-
-                if(storage.check()):
-                    img = Image.open(buf)
-                    img = np.array(img)
-                    items = storage.get(object_id)
+                items = storage.get(pk, request.user.id, object_id)
+                if(items):
+                    img, mime = frame_provider.get_frame(data_id, data_quality, FrameProvider.Type.NUMPY_ARRAY)
+                    img = np.ascontiguousarray(img[:, :, ::-1]) # BGR to RGB
                     print('object id',object_id)
                     skip = 3
                     i=0
@@ -842,6 +918,7 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
                     new_im.save(b,format="jpeg")
                     return HttpResponse(b.getvalue(), content_type=mime)
                 else:
+                    buf, mime = frame_provider.get_frame(data_id, data_quality)
                     return HttpResponse(buf.getvalue(), content_type=mime)
             except APIException as e:
                 return Response(data=e.default_detail, status=e.status_code)
@@ -970,9 +1047,8 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
         db_task = self.get_object()
         frame_provider = FrameProvider(db_task.data)
         data_quality = FrameProvider.Quality.ORIGINAL
-        img, mime = frame_provider.get_frame(int(frame), data_quality)
-        img = Image.open(img)
-        orig_img = np.array(img)
+        img, mime = frame_provider.get_frame(int(frame), data_quality, FrameProvider.Type.NUMPY_ARRAY)
+        orig_img = img[:, :, ::-1] # BGR to RGB
         try:
             print()
             data = predict(orig_img,config['main']['predict_bb_models'])
@@ -985,6 +1061,73 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
             msg = "Error occured while predicting."
             return Response(data='%s %s' %(msg , str(e)), status=status.HTTP_400_BAD_REQUEST)
 
+    @swagger_auto_schema(method='post', operation_summary='Starts prediction of bounding boxes for a range of frames',
+        request_body=openapi.Schema(type=openapi.TYPE_OBJECT, properties={
+            'params': openapi.Schema(type=openapi.TYPE_OBJECT, properties={
+                'frameStart': openapi.Schema(type=openapi.TYPE_INTEGER),
+                'frameEnd': openapi.Schema(type=openapi.TYPE_INTEGER),
+                'step': openapi.Schema(type=openapi.TYPE_INTEGER),
+                'batchSize': openapi.Schema(type=openapi.TYPE_INTEGER),
+                'save': openapi.Schema(type=openapi.TYPE_BOOLEAN,
+                    description="Write predicted boxes as shapes instead of returning them"),
+                'labelID': openapi.Schema(type=openapi.TYPE_INTEGER,
+                    description="Label of all saved shapes whatever the predicted class is. " \
+                        "By default the label with the same name as the predicted class is used " \
+                        "and boxes of classes without such a label are skipped"),
+            })
+        }),
+        responses={'202': openapi.Response(description='Prediction has been started')})
+    @swagger_auto_schema(method='get', operation_summary='Returns the status or the results of the prediction',
+        responses={
+            '200': openapi.Response(description='Predicted boxes of every frame or the number of processed frames'),
+            '202': openapi.Response(description='Prediction is in progress'),
+            '404': openapi.Response(description='Prediction was not started'),
+        })
+    @action(detail=True, methods=['POST', 'GET'])
+    def predictBBsBatch(self, request, pk):
+        db_task = self.get_object() # force to call check_object_permissions
+        queue = django_rq.get_queue("default")
+        rq_id = "{}@/api/v1/tasks/{}/predictBBsBatch".format(request.user, pk)
+        rq_job = queue.fetch_job(rq_id)
+
+        if request.method == 'GET':
+            if rq_job is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            if rq_job.is_finished:
+                result = rq_job.return_value
+                rq_job.delete()
+                return Response(data=result)
+            if rq_job.is_failed:
+                exc_info = str(rq_job.exc_info)
+                rq_job.delete()
+                return Response(data=exc_info, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return Response(data=self._get_rq_response("default", rq_id),
+                status=status.HTTP_202_ACCEPTED)
+
+        if rq_job is not None and not (rq_job.is_finished or rq_job.is_failed):
+            return Response(status=status.HTTP_202_ACCEPTED)
+
+        try:
+            data = request.data['params']
+            frame_start = int(data.get('frameStart', 0))
+            frame_end = min(int(data.get('frameEnd', db_task.data.size - 1)), db_task.data.size - 1)
+            step = max(int(data.get('step', 1)), 1)
+            batch_size = max(int(data.get('batchSize', 8)), 1)
+            save = bool(strtobool(str(data.get('save', False))))
+            label_id = data.get('labelID', None)
+            if label_id is not None:
+                label_id = int(label_id)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            return Response(data='Invalid prediction parameters: {}'.format(str(e)),
+                status=status.HTTP_400_BAD_REQUEST)
+
+        if rq_job is not None:
+            rq_job.delete()
+        queue.enqueue_call(func=_predict_bbs_batch,
+            args=(int(pk), frame_start, frame_end, step, batch_size, save, label_id),
+            job_id=rq_id)
+        return Response(status=status.HTTP_202_ACCEPTED)
+
     # ISL END
 
     @swagger_auto_schema(method='get', operation_summary='Returns a list of jobs for a specific task',
@@ -1064,20 +1207,29 @@ class TaskViewSet(auth.TaskGetQuerySetMixin, viewsets.ModelViewSet):
 
                     #TODO: av.FFmpegError processing
                     if settings.USE_CACHE and db_data.storage_method == StorageMethodChoice.CACHE:
-                        buff, mime_type = frame_provider.get_chunk(data_id, data_quality)
-                        return HttpResponse(buff.getvalue(), content_type=mime_type)
+                        path, mime_type = frame_provider.get_chunk(data_id, data_quality)
+                        try:
+                            prefetch_chunks(db_data, data_id)
+                        except Exception:
+                            slogger.task[pk].warning('cannot prefetch chunks', exc_info=True)
+                        return sendfile(request, path, mimetype=mime_type)
+
+                    chunk_images = frame_provider.get_passthrough_chunk(data_id, data_quality)
+                    if chunk_images is not None:
+                        return StreamingHttpResponse(stream_zip_chunk(chunk_images),
+                            content_type='application/zip')
 
-                    # Follow symbol links if the chunk is a link on a real image otherwise
-                    # mimetype detection inside sendfile will work incorrectly.
-                    path = os.path.realpath(frame_provider.get_chunk(data_id, data_quality))
-                    return sendfile(request, path)
+                    return _send_file(request, frame_provider.get_chunk(data_id, data_quality))
 
                 elif data_type == 'frame':
                     data_id = int(data_id)
                     data_quality = FrameProvider.Quality.COMPRESSED \
                         if data_quality == 'compressed' else FrameProvider.Quality.ORIGINAL
+                    path = frame_provider.get_passthrough_frame(data_id, data_quality)
+                    if path:
+                        return _send_file(request, path)
+
                     buf, mime = frame_provider.get_frame(data_id, data_quality)
-                    print(mime)
                     return HttpResponse(buf.getvalue(), content_type=mime)
 
                 elif data_type == 'preview':
@@ -1408,7 +1560,83 @@ def rq_handler(job, exc_type, exc_value, tb):
 #     responses={'202': openapi.Response(description='Load of annotations has been started'),
 #         '201': openapi.Response(description='Annotations have been uploaded')},
 #     tags=['tasks'])
+def _predict_bbs_batch(tid, frame_start, frame_end, step, batch_size, save, label_id):
+    job = rq.get_current_job()
+    db_task = Task.objects.select_related('data').get(pk=tid)
+    config = ConfigParser()
+    config.read(config_path)
+    labels = {db_label.name: db_label.id for db_label in db_task.label_set.all()}
+
+    frame_provider = FrameProvider(db_task.data)
+    frame_count = 0
+    total_count = len(range(frame_start, frame_end + 1, step))
+    results = []
+    shapes = []
+    # the next batch is decoded while the current one is processed
+    frames = frame_provider.get_frame_range(frame_start, frame_end,
+        FrameProvider.Quality.ORIGINAL, FrameProvider.Type.NUMPY_ARRAY, step, prefetch=batch_size)
+    while True:
+        batch = list(itertools.islice(frames, batch_size))
+        if not batch:
+            break
+        # the detector expects RGB frames like in predictBBs
+        predictions = predict_batch([image[..., ::-1] for _, image in batch],
+            config['main']['predict_bb_models'])
+
+        for (frame, _), prediction in zip(batch, predictions):
+            if not save:
+                results.append({
+                    "frame": frame,
+                    "bboxes": prediction['bbox'],
+                    "labels": prediction['labels'],
+                })
+                continue
+
+            for bbox, label in zip(prediction['bbox'], prediction['labels']):
+                shape_label_id = label_id if label_id is not None else labels.get(label)
+                if shape_label_id is None:
+                    continue
+                shapes.append({
+                    "frame": frame,
+                    "label_id": shape_label_id,
+                    "type": "rectangle",
+                    "occluded": False,
+                    "points": bbox,
+                    "z_order": 0,
+                    "group": None,
+                    "attributes": [],
+                    "source": "auto",
+                })
+
+        frame_count += len(batch)
+        job.meta['status'] = '{} of {} frames are processed'.format(frame_count, total_count)
+        job.save_meta()
+
+    if not save:
+        return {"frames": results}
+
+    # all shapes are saved in one transaction, so a failed prediction
+    # does not leave a part of them in the task
+    serializer = LabeledDataSerializer(data={
+        "version": 0, "tags": [], "shapes": shapes, "tracks": []})
+    serializer.is_valid(raise_exception=True)
+    dm.task.patch_task_data(tid, serializer.data, dm.task.PatchAction.CREATE)
+    return {"frames": frame_count}
+
 # @api_view(['PUT'])
+def _send_file(request, path):
+    # Follow symbol links if the file is a link on a real image otherwise
+    # mimetype detection will work incorrectly. The link itself is sent,
+    # because the web server sends only files under the data directory.
+    real_path = os.path.realpath(path)
+    mime_type = mimetypes.guess_type(real_path)[0] or 'application/octet-stream'
+    data_root = os.path.join(os.path.realpath(settings.DATA_ROOT), '')
+    if real_path.startswith(data_root):
+        return sendfile(request, path, mimetype=mime_type)
+
+    # Files linked from the share are streamed by the application
+    return FileResponse(open(real_path, 'rb'), content_type=mime_type)
+
 def _import_annotations(request, rq_id, rq_func, pk, format_name):
     format_desc = {f.DISPLAY_NAME: f
         for f in dm.views.get_import_formats()}.get(format_name)
@@ -251,6 +251,12 @@ RQ_QUEUES = {
         'PORT': 6379,
         'DB': 0,
         'DEFAULT_TIMEOUT': '24h'
+    },
+    'prefetch': {
+        'HOST': 'localhost',
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': '10m'
     }
 }
 
@@ -349,6 +355,14 @@ os.makedirs(TASKS_ROOT, exist_ok=True)
 SHARE_ROOT = os.path.join(BASE_DIR, 'share')
 os.makedirs(SHARE_ROOT, exist_ok=True)
 
+# How files of the share are put into tasks:
+# 'copy' - files are copied
+# 'link' - hard links or reflinks, files are copied if the filesystem does not support them
+# 'symlink' - hard links or reflinks, symbolic links otherwise. Symbolically
+#   linked data stays in the share: tasks break if the files of the share are
+#   changed or removed. With ORIGINAL_CHUNK_PASSTHROUGH 'link' is used instead.
+SHARE_INGESTION_MODE = os.getenv('CVAT_SHARE_INGESTION_MODE', 'copy')
+
 MODELS_ROOT = os.path.join(DATA_ROOT, 'models')
 os.makedirs(MODELS_ROOT, exist_ok=True)
 
@@ -453,3 +467,61 @@ CACHES = {
 
 USE_CACHE = True
 
+# Original chunks of image tasks are stored as manifests of the uploaded
+# images instead of zip files with their copies
+ORIGINAL_CHUNK_PASSTHROUGH = os.getenv('CVAT_ORIGINAL_CHUNK_PASSTHROUGH', 'no') == 'yes'
+
+# Chunks of tasks in the cache mode: the in-memory cache of every worker
+# process, the disk cache and the limits of one task by chunk quality
+CHUNK_MEMORY_CACHE_SIZE = int(os.getenv('CVAT_CHUNK_MEMORY_CACHE_SIZE', 128 * 1024 * 1024))
+CHUNK_CACHE_SIZE = int(os.getenv('CVAT_CHUNK_CACHE_SIZE', 2 ** 40))
+CHUNK_CACHE_TASK_QUOTA = {
+    'COMPRESSED': int(os.getenv('CVAT_CHUNK_CACHE_COMPRESSED_QUOTA', 64 * 2 ** 30)),
+    'ORIGINAL': int(os.getenv('CVAT_CHUNK_CACHE_ORIGINAL_QUOTA', 32 * 2 ** 30)),
+}
+
+# Settings of JPEG images in compressed zip chunks: optimize - the second pass
+# of optimization of Huffman tables, images are a few percent smaller
+IMAGE_CHUNK_ENCODING = {
+    'optimize': os.getenv('CVAT_IMAGE_CHUNK_OPTIMIZE', 'no') == 'yes',
+}
+
+# libx264 settings of video chunks by chunk quality: the number of threads
+# (0 - automatic), the preset, the tune and the GOP size ('chunk' - one GOP
+# per chunk). Empty values keep the encoder defaults. Chunks are already
+# encoded by CHUNK_WORKERS processes, so each encoder uses one thread by
+# default as before.
+VIDEO_CHUNK_ENCODING = {
+    'COMPRESSED': {
+        'threads': int(os.getenv('CVAT_VIDEO_CHUNK_THREADS', 1)),
+        'preset': os.getenv('CVAT_VIDEO_CHUNK_COMPRESSED_PRESET', ''),
+        'tune': os.getenv('CVAT_VIDEO_CHUNK_COMPRESSED_TUNE', ''),
+        'gop': os.getenv('CVAT_VIDEO_CHUNK_GOP', ''),
+    },
+    'ORIGINAL': {
+        'threads': int(os.getenv('CVAT_VIDEO_CHUNK_THREADS', 1)),
+        'preset': os.getenv('CVAT_VIDEO_CHUNK_ORIGINAL_PRESET', 'ultrafast'),
+        'tune': os.getenv('CVAT_VIDEO_CHUNK_ORIGINAL_TUNE', ''),
+        'gop': os.getenv('CVAT_VIDEO_CHUNK_GOP', ''),
+    },
+}
+
+# Number of the following chunks which are prepared in the background when
+# a chunk of a task in the cache mode is requested, and the maximum number
+# of such jobs for one task
+CHUNK_PREFETCH_COUNT = int(os.getenv('CVAT_CHUNK_PREFETCH_COUNT', 2))
+CHUNK_PREFETCH_MAX_JOBS = int(os.getenv('CVAT_CHUNK_PREFETCH_MAX_JOBS', 4))
+
+# Size of the in-memory cache of decoded frames of every worker process
+FRAME_CACHE_SIZE = int(os.getenv('CVAT_FRAME_CACHE_SIZE', 256 * 1024 * 1024))
+
+# Number of processes which write chunks of an image task. Every rq worker
+# which creates a task starts its own processes, so the default is small.
+CHUNK_WORKERS = int(os.getenv('CVAT_CHUNK_WORKERS', min(4, os.cpu_count() or 1)))
+
+# Number of threads which read sizes of images of a task in the cache mode
+IMAGE_SIZE_WORKERS = int(os.getenv('CVAT_IMAGE_SIZE_WORKERS', 16))
+
+# Number of remote files of a task which are downloaded at the same time
+DOWNLOAD_WORKERS = int(os.getenv('CVAT_DOWNLOAD_WORKERS', 8))
+
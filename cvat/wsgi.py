@@ -20,3 +20,9 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cvat.settings.{}" \
     .format(os.environ.get("DJANGO_CONFIGURATION", "development")))
 
 application = get_wsgi_application()
+
+# Only web server processes serve predictions, so the models are not
+# loaded by rq workers and management commands
+from cvat.apps.engine import model_registry # pylint: disable=wrong-import-position
+if model_registry.prewarm_enabled():
+    model_registry.prewarm_async()
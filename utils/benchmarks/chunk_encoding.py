@@ -0,0 +1,84 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+import argparse
+import itertools
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-resolution', type=int, nargs=2, default=[1920, 1080],
+        help='Width and height of the synthetic video')
+    parser.add_argument('-chunk_size', type=int, default=36,
+        help='Number of frames in a chunk')
+    parser.add_argument('-chunks', type=int, default=3,
+        help='Number of encoded chunks for every profile')
+    parser.add_argument('-presets', type=str, nargs='+', default=['ultrafast', 'veryfast', 'medium'],
+        help='libx264 presets')
+    parser.add_argument('-threads', type=int, nargs='+', default=[1, 0],
+        help='Numbers of encoder threads, 0 - automatic')
+    parser.add_argument('-gops', type=str, nargs='+', default=['', 'chunk'],
+        help='GOP sizes, empty - the encoder default, chunk - one GOP per chunk')
+    parser.add_argument('-tune', type=str, default='',
+        help='libx264 tune')
+    parser.add_argument('-quality', type=int, default=50,
+        help='Image quality of compressed chunks')
+
+    return parser.parse_args()
+
+def generate_frames(width, height, count):
+    # a moving texture with some noise, which is closer to real videos
+    # than random frames
+    rng = np.random.RandomState(0)
+    x = np.linspace(0, 8 * np.pi, width)
+    y = np.linspace(0, 4 * np.pi, height)[:, np.newaxis]
+    frames = []
+    for i in range(count):
+        image = 127 + 60 * np.sin(x + i / 5) * np.cos(y - i / 7)
+        image = image[:, :, np.newaxis] + rng.normal(0, 8, (height, width, 3))
+        image = np.clip(image, 0, 255).astype(np.uint8)
+        frames.append(av.VideoFrame.from_ndarray(image, format='rgb24').reformat(format='yuv420p'))
+    return frames
+
+def measure(writer, frames, chunk_size, chunks):
+    size = 0
+    start = time.perf_counter()
+    for chunk_number in range(chunks):
+        chunk = frames[chunk_number * chunk_size:(chunk_number + 1) * chunk_size]
+        buff = BytesIO()
+        writer.save_as_chunk([(frame, None, None) for frame in chunk], buff)
+        size += buff.tell()
+    elapsed = time.perf_counter() - start
+    return chunk_size * chunks / elapsed, size / chunks
+
+def main():
+    args = get_args()
+    width, height = args.resolution
+    frames = generate_frames(width, height, args.chunk_size * args.chunks)
+
+    print('{:>10} {:>10} {:>7} {:>7} {:>10} {:>14}'.format(
+        'chunk', 'preset', 'threads', 'gop', 'fps', 'chunk size, KB'))
+    writers = [('original', Mpeg4ChunkWriter), ('compressed', Mpeg4CompressedChunkWriter)]
+    for (name, writer_class), preset, threads, gop in itertools.product(
+            writers, args.presets, args.threads, args.gops):
+        writer = writer_class(args.quality, {
+            'preset': preset,
+            'threads': threads,
+            'tune': args.tune,
+            'gop': gop,
+        })
+        fps, size = measure(writer, frames, args.chunk_size, args.chunks)
+        print('{:>10} {:>10} {:>7} {:>7} {:>10.1f} {:>14.1f}'.format(
+            name, preset, threads or 'auto', gop or 'default', fps, size / 1024))
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.append(base_dir)
+    import av
+    from cvat.apps.engine.media_extractors import Mpeg4ChunkWriter, Mpeg4CompressedChunkWriter
+    main()
@@ -0,0 +1,102 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-images', type=str, nargs='+', default=[],
+        help='Image files, a synthetic corpus is generated if they are not specified')
+    parser.add_argument('-quality', type=int, default=70,
+        help='Image quality of compressed chunks')
+    parser.add_argument('-repeat', type=int, default=3,
+        help='Number of runs for every measurement')
+
+    return parser.parse_args()
+
+def generate_corpus():
+    # the same images for every run: smooth content with noise in different
+    # formats, including 16bit and grayscale images
+    rng = np.random.RandomState(0)
+    corpus = []
+    for width, height in [(640, 480), (1920, 1080), (4000, 3000)]:
+        x = np.linspace(0, 6 * np.pi, width)
+        y = np.linspace(0, 4 * np.pi, height)[:, np.newaxis]
+        base = 127 + 80 * np.sin(x) * np.cos(y)
+        image = np.clip(base[:, :, np.newaxis] + rng.normal(0, 10, (height, width, 3)), 0, 255)
+        image = image.astype(np.uint8)
+        for image_format, pil_image in [
+                ('jpeg', Image.fromarray(image)),
+                ('png', Image.fromarray(image)),
+                ('png', Image.fromarray(image).convert('RGBA')),
+                ('png', Image.fromarray(image[:, :, 0]))]:
+            buf = io.BytesIO()
+            pil_image.save(buf, format=image_format, quality=95)
+            corpus.append(buf.getvalue())
+        image_16bit = (base * 200).astype(np.int32)
+        buf = io.BytesIO()
+        Image.fromarray(image_16bit, mode='I').save(buf, format='png')
+        corpus.append(buf.getvalue())
+    return corpus
+
+# The implementation which was used before the OpenCV encoder
+def legacy_compress_image(image_path, quality):
+    image = Image.open(image_path)
+    if image.mode == "I":
+        im_data = np.array(image)
+        im_data = im_data * (2**8 / im_data.max())
+        image = Image.fromarray(im_data.astype(np.int32))
+    converted_image = image.convert('RGB')
+    image.close()
+    buf = io.BytesIO()
+    converted_image.save(buf, format='JPEG', quality=quality, optimize=True)
+    buf.seek(0)
+    width, height = converted_image.size
+    converted_image.close()
+    return width, height, buf
+
+def measure(compress, corpus, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        size = 0
+        start = time.perf_counter()
+        for data in corpus:
+            size += len(compress(io.BytesIO(data)).getvalue())
+        best = min(best, time.perf_counter() - start)
+    return len(corpus) / best, size
+
+def main():
+    args = get_args()
+    if args.images:
+        corpus = []
+        for path in args.images:
+            with open(path, 'rb') as image_file:
+                corpus.append(image_file.read())
+    else:
+        corpus = generate_corpus()
+
+    writers = [
+        ('legacy', lambda image: legacy_compress_image(image, args.quality)[2]),
+        ('opencv', lambda image: ZipCompressedChunkWriter._compress_image(image, args.quality)[2]),
+        ('opencv, optimize', lambda image: ZipCompressedChunkWriter._compress_image(
+            image, args.quality, optimize=True)[2]),
+    ]
+
+    print('{} images, {:.1f} MB'.format(len(corpus), sum(map(len, corpus)) / 2 ** 20))
+    print('{:>18} {:>12} {:>12}'.format('writer', 'images/s', 'size, KB'))
+    for name, compress in writers:
+        throughput, size = measure(compress, corpus, args.repeat)
+        print('{:>18} {:>12.1f} {:>12.1f}'.format(name, throughput, size / 1024))
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.append(base_dir)
+    from cvat.apps.engine.media_extractors import ZipCompressedChunkWriter
+    main()
@@ -0,0 +1,94 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-boxes', type=int, nargs='+', default=[10, 100, 300, 1000],
+        help='Numbers of candidate boxes per frame')
+    parser.add_argument('-repeat', type=int, default=5,
+        help='Number of runs for every measurement')
+    parser.add_argument('-iou_threshold', type=float, default=0.9,
+        help='IoU threshold for cross-class suppression')
+
+    return parser.parse_args()
+
+def generate_prediction(rng, count):
+    xy = rng.uniform(0, 1920, (count, 2))
+    wh = rng.uniform(10, 300, (count, 2))
+    return {
+        'rois': np.concatenate([xy, xy + wh], axis=1).astype(np.float32),
+        'class_ids': rng.randint(0, 90, count),
+        'scores': rng.uniform(0.2, 1, count).astype(np.float32),
+    }
+
+# The implementation which was used before the vectorized filters
+def legacy_remove_undesired(preds, desired_classes):
+    length = len(preds[0]['rois'])
+    i = 0
+    while i < length:
+        class_id = int(preds[0]['class_ids'][i])
+        if class_id not in desired_classes:
+            preds[0]['rois'] = np.delete(preds[0]['rois'], i, axis=0)
+            preds[0]['class_ids'] = np.delete(preds[0]['class_ids'], i, axis=0)
+            preds[0]['scores'] = np.delete(preds[0]['scores'], i, axis=0)
+            i -= 1
+            length -= 1
+        i += 1
+    return preds
+
+def legacy_remove_overlapping(preds, iou_threshold):
+    index_to_delete = []
+    for box1 in preds[0]['rois']:
+        for box2 in preds[0]['rois']:
+            if not np.array_equal(box1, box2):
+                if bb_intersection_over_union(box1, box2) > iou_threshold:
+                    index1 = np.where(preds[0]['rois'] == box1)
+                    index2 = np.where(preds[0]['rois'] == box2)
+                    score1 = preds[0]['scores'][index1[0]]
+                    score2 = preds[0]['scores'][index2[0]]
+                    if score1[0] > score2[0]:
+                        index_to_delete.append(index2[0][0])
+                    else:
+                        index_to_delete.append(index1[0][0])
+    for i in np.sort(np.unique(index_to_delete))[::-1]:
+        preds[0]['rois'] = np.delete(preds[0]['rois'], i, axis=0)
+        preds[0]['class_ids'] = np.delete(preds[0]['class_ids'], i, axis=0)
+        preds[0]['scores'] = np.delete(preds[0]['scores'], i, axis=0)
+    return preds
+
+def measure(func, pred, repeat):
+    def run():
+        func([{ key: value.copy() for key, value in pred.items() }])
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+def main():
+    args = get_args()
+    rng = np.random.RandomState(0)
+    desired_classes = [1, 2, 3, 5, 6, 7]
+
+    print('{:>6} {:>14} {:>14} {:>9}'.format('boxes', 'legacy, ms', 'vectorized, ms', 'speedup'))
+    for count in args.boxes:
+        pred = generate_prediction(rng, count)
+        legacy = measure(lambda preds: legacy_remove_overlapping(
+            legacy_remove_undesired(preds, desired_classes), args.iou_threshold), pred, args.repeat)
+        vectorized = measure(lambda preds: remove_overlapping(
+            remove_undesired(preds, desired_classes), args.iou_threshold), pred, args.repeat)
+        print('{:>6} {:>14.3f} {:>14.3f} {:>8.1f}x'.format(
+            count, legacy * 1000, vectorized * 1000, legacy / vectorized))
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.append(base_dir)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cvat.settings.development')
+    import django
+    django.setup()
+    from cvat.apps.engine.predict import (bb_intersection_over_union,
+        remove_overlapping, remove_undesired)
+    main()
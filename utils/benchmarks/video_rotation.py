@@ -0,0 +1,98 @@
+# Copyright (C) 2020 Intel Corporation
+#
+# SPDX-License-Identifier: MIT
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-resolution', type=int, nargs=2, default=[1920, 1080],
+        help='Width and height of the generated video')
+    parser.add_argument('-frames', type=int, default=300,
+        help='Number of frames in the generated video')
+    parser.add_argument('-repeat', type=int, default=3,
+        help='Number of runs for every measurement')
+
+    return parser.parse_args()
+
+def generate_video(path, width, height, frames, rotation):
+    container = av.open(path, mode='w')
+    stream = container.add_stream('libx264', rate=25)
+    stream.width = width
+    stream.height = height
+    stream.pix_fmt = 'yuv420p'
+    if rotation:
+        stream.metadata['rotate'] = str(rotation)
+
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    for i in range(frames):
+        frame = av.VideoFrame.from_ndarray(np.roll(image, 8 * i, axis=1), format='rgb24')
+        for packet in stream.encode(frame):
+            container.mux(packet)
+    for packet in stream.encode():
+        container.mux(packet)
+    container.close()
+
+# The implementation which was used before the filter graph
+def legacy_decode(path):
+    container = av.open(path)
+    stream = container.streams.video[0]
+    stream.thread_type = 'AUTO'
+    for packet in container.demux(stream):
+        for image in packet.decode():
+            if packet.stream.metadata.get('rotate'):
+                old_image = image
+                image = av.VideoFrame().from_ndarray(
+                    rotate_image(
+                        image.to_ndarray(format='bgr24'),
+                        360 - int(container.streams.video[0].metadata.get('rotate'))
+                    ),
+                    format ='bgr24'
+                )
+                image.pts = old_image.pts
+            yield image
+    container.close()
+
+def decode(path):
+    for image, _, _ in VideoReader([path]):
+        yield image
+
+def measure(func, path, frames, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        decoded = sum(1 for _ in func(path))
+        best = min(best, time.perf_counter() - start)
+        assert decoded == frames
+    return frames / best
+
+def main():
+    args = get_args()
+    width, height = args.resolution
+
+    print('{:>8} {:>12} {:>12} {:>9}'.format('rotation', 'legacy, fps', 'filter, fps', 'speedup'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for rotation in [0, 90, 180, 270]:
+            path = os.path.join(tmp_dir, 'video_{}.mp4'.format(rotation))
+            generate_video(path, width, height, args.frames, rotation)
+            legacy = measure(legacy_decode, path, args.frames, args.repeat)
+            current = measure(decode, path, args.frames, args.repeat)
+            print('{:>8} {:>12.1f} {:>12.1f} {:>8.1f}x'.format(
+                rotation, legacy, current, current / legacy))
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.append(base_dir)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cvat.settings.development')
+    import django
+    django.setup()
+    import av
+    from cvat.apps.engine.media_extractors import VideoReader
+    from cvat.apps.engine.utils import rotate_image
+    main()